@@ -3,6 +3,7 @@ import torch.utils.data
 import torch.nn as nn
 import activation_functions as actfuns
 import util
+from timm.models.layers import GroupedLinear
 import math
 import numpy as np
 
@@ -27,7 +28,6 @@ class MLP(nn.Module):
         self.p, self.k, self.g = p, k, g
         self.permute_type = permute_type
         self.alpha_dist = alpha_dist
-        self.shuffle_maps = []
         self.reduce_actfuns = reduce_actfuns
         self.iris = True if input_dim == 4 else False
 
@@ -60,9 +60,7 @@ class MLP(nn.Module):
 
         self.linear_layers = nn.ModuleDict()
         self.linear_layers['l1'] = nn.Linear(input_dim, pre_acts[0])
-        self.linear_layers['l2'] = nn.ModuleList()
-        for group in range(g):
-            self.linear_layers['l2'].append(nn.Linear(int(post_acts[0] / g), int(pre_acts[1] / g)))
+        self.linear_layers['l2'] = GroupedLinear(post_acts[0], pre_acts[1], groups=g)
         self.linear_layers['l3'] = nn.Linear(post_acts[1], output_dim)
 
         if not self.iris:
@@ -71,8 +69,20 @@ class MLP(nn.Module):
                 'l2': nn.BatchNorm1d(pre_acts[1])
             })
 
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, pre_acts[0], self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, pre_acts[1], self.p)
+        for layer, pre_act in enumerate(pre_acts):
+            shuffle_maps = util.add_shuffle_map(self, 'shuffle_maps_{}'.format(layer), pre_act, self.p)
+            self.register_buffer('permute_index_{}'.format(layer), actfuns.get_permutation_index(
+                pre_act, self.p, self.k, self.permute_type, shuffle_maps))
+
+        # Actfun and number of permutations used by each layer, and the actfuns combined by combinact layers (see
+        # collapse_combinact and fold_permutations)
+        self.layer_actfuns = [actfun, actfun]
+        self.layer_ps = [self.p, self.p]
+        # Layers whose permutations are folded into the linear layer before them, saved so folded models reload
+        self.register_buffer('folded', torch.zeros(2, dtype=torch.bool))
+        self.combinact_actfuns = [actfuns.get_combinact_actfuns(reduce_actfuns)] * 2
+        # In eval mode, coin flip actfuns return their expected output instead of drawing
+        self.deterministic_eval = False
 
         self.all_alpha_primes = nn.ParameterList()
         self.alpha_dist = alpha_dist
@@ -84,6 +94,24 @@ class MLP(nn.Module):
             if alpha_dist == "per_perm":
                 for layer in range(2):
                     self.all_alpha_primes.append(nn.Parameter(torch.zeros(self.p, self.num_combinact_actfuns)))
+            # Which of the combinact actfuns each layer still combines, saved so collapsed models can be reloaded
+            self.register_buffer('combinact_mask', torch.ones(2, self.num_combinact_actfuns, dtype=torch.bool))
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        combinact_mask = state_dict.get(prefix + 'combinact_mask')
+        if combinact_mask is not None and self.actfun == 'combinact':
+            self._set_combinact_mask(combinact_mask)
+        # Folded layers output more (gathered) channels, fold the same layers before their weights are loaded
+        folded = state_dict.get(prefix + 'folded')
+        if folded is not None:
+            for layer in folded.nonzero().flatten().tolist():
+                if not self.folded[layer]:
+                    self._fold_layer(layer)
+        actfuns.keep_missing_buffers(self, state_dict, prefix, ['folded', 'combinact_mask'] + [
+            '{}_{}'.format(name, layer) for name in ['shuffle_maps', 'permute_index'] for layer in range(2)])
+        super(MLP, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
 
     def forward(self, x):
 
@@ -94,17 +122,7 @@ class MLP(nn.Module):
         x = self.activate(x, 0)
         x = x.unsqueeze(0) if len(x.shape) == 1 else x
 
-        all_outputs = None
-        for group_idx, group_fc in enumerate(self.linear_layers['l2']):
-            group_idx_start = group_idx * int(x.shape[1] / self.g)
-            group_idx_end = (group_idx + 1) * int(x.shape[1] / self.g)
-            curr_inputs = x[:, group_idx_start:group_idx_end]
-            curr_outputs = group_fc(curr_inputs)
-            if group_idx == 0:
-                all_outputs = curr_outputs
-            else:
-                all_outputs = torch.cat((all_outputs, curr_outputs), dim=1)
-        x = all_outputs
+        x = self.linear_layers['l2'](x)
         x = self.batch_norms['l2'](x) if not self.iris else x
         x = self.activate(x, 1)
         x = x.unsqueeze(0) if len(x.shape) == 1 else x
@@ -113,16 +131,90 @@ class MLP(nn.Module):
 
         return x
 
+    def collapse_combinact(self, threshold=0.05):
+        """
+        Prunes, per layer, the combinact actfuns whose alpha is below threshold for every cluster (or permutation).
+        A layer left with a single actfun is rewritten to use that actfun directly. The kept actfuns are saved in
+        the state dict (combinact_mask), so the collapsed model's state dict loads into a freshly built MLP.
+        :param threshold: minimum alpha an actfun needs in at least one cluster / permutation to be kept
+        :return: list with the kept and pruned actfuns of each layer
+        """
+        report = []
+        for layer, alpha_primes in enumerate(self.all_alpha_primes):
+            if self.layer_actfuns[layer] != 'combinact':
+                continue
+            layer_alphas = torch.softmax(alpha_primes.data, dim=1)
+            keep = (layer_alphas >= threshold).any(dim=0)
+            keep[layer_alphas.mean(dim=0).argmax()] = True
+            kept = [name for name, k in zip(self.combinact_actfuns[layer], keep.tolist()) if k]
+            pruned = [name for name, k in zip(self.combinact_actfuns[layer], keep.tolist()) if not k]
+
+            self.all_alpha_primes[layer] = nn.Parameter(alpha_primes.data[:, keep].clone())
+            self._set_combinact_actfuns(layer, kept)
+            report.append({'layer': layer, 'actfun': self.layer_actfuns[layer], 'kept': kept, 'pruned': pruned})
+        return report
+
+    def _set_combinact_actfuns(self, layer, names):
+        all_actfuns = actfuns.get_combinact_actfuns(self.reduce_actfuns)
+        self.combinact_mask[layer] = torch.tensor([name in names for name in all_actfuns])
+        self.combinact_actfuns[layer] = names
+        self.layer_actfuns[layer] = names[0] if len(names) == 1 else 'combinact'
+
+    def _set_combinact_mask(self, combinact_mask):
+        # Rebuilds the combinact layout of a (collapsed) checkpoint, its alpha primes are loaded afterwards
+        all_actfuns = actfuns.get_combinact_actfuns(self.reduce_actfuns)
+        for layer, mask in enumerate(combinact_mask.tolist()):
+            names = [name for name, keep in zip(all_actfuns, mask) if keep]
+            if names == self.combinact_actfuns[layer]:
+                continue
+            alpha_primes = self.all_alpha_primes[layer]
+            self.all_alpha_primes[layer] = nn.Parameter(alpha_primes.data.new_zeros(len(alpha_primes), len(names)))
+            self._set_combinact_actfuns(layer, names)
+
+    def fold_permutations(self):
+        """
+        Folds the channel permutations of each layer's activation into the linear layer and batch norm before it,
+        so that they directly output the permuted copies of their nodes in cluster order. For inference only.
+        Grouped second layers (g > 1) and per-permutation combinact layers keep gathering at runtime. The folded
+        layers are saved in the state dict, so the folded model's state dict loads into a freshly built MLP.
+        :return: list of the layers whose permutations were folded
+        """
+        folded = []
+        for layer, name in enumerate(['l1', 'l2']):
+            if self.layer_ps[layer] == 1:
+                continue
+            if name == 'l2' and self.g > 1:
+                continue
+            if self.layer_actfuns[layer] == 'combinact' and self.alpha_dist == 'per_perm':
+                continue
+            self._fold_layer(layer)
+            folded.append(layer)
+        return folded
+
+    def _fold_layer(self, layer):
+        name = 'l{}'.format(layer + 1)
+        norm = self.batch_norms[name] if not self.iris else None
+        actfuns.gather_output_channels(
+            self.linear_layers[name], norm, getattr(self, 'permute_index_{}'.format(layer)))
+        setattr(self, 'shuffle_maps_{}'.format(layer), None)
+        setattr(self, 'permute_index_{}'.format(layer), None)
+        self.layer_ps[layer] = 1
+        self.folded[layer] = True
+
     def activate(self, x, layer):
-        if self.actfun == 'combinact':
+        actfun = self.layer_actfuns[layer]
+        if actfun == 'combinact':
             alpha_primes = self.all_alpha_primes[layer]
         else:
             alpha_primes = None
-        return actfuns.activate(x, actfun=self.actfun,
-                                k=self.k, p=self.p, M=x.shape[1],
+        return actfuns.activate(x, actfun=actfun,
+                                k=self.k, p=self.layer_ps[layer], M=x.shape[1],
                                 layer_type='linear',
                                 permute_type=self.permute_type,
-                                shuffle_maps=self.shuffle_maps[layer],
+                                shuffle_maps=getattr(self, 'shuffle_maps_{}'.format(layer)),
+                                permute_index=getattr(self, 'permute_index_{}'.format(layer)),
                                 alpha_primes=alpha_primes,
                                 alpha_dist=self.alpha_dist,
-                                reduce_actfuns=self.reduce_actfuns)
\ No newline at end of file
+                                reduce_actfuns=self.reduce_actfuns,
+                                combinact_actfuns=self.combinact_actfuns[layer],
+                                deterministic=self.deterministic_eval and not self.training)
\ No newline at end of file
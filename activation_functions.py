@@ -2,32 +2,110 @@ import torch
 import torch.nn.functional as F
 from torch import logsumexp
 from torch import Tensor
+from torch.autograd.function import once_differentiable
 import torch.nn as nn
+import torch.utils.checkpoint as cp
 
+import functools
 import math
 import numbers
-import time
+from typing import Optional
 
 
 class HigherOrderActivation(nn.Module):
 
-    actfun = None
-    p = None
-    k = None
-    g = None
-    shuffle_maps = None
-
-    def __init__(self, inplace=False):
+    def __init__(self, inplace=False, actfun=None, p=None, k=None, g=None):
         super(HigherOrderActivation, self).__init__()
         self.inplace = inplace
+        # Configured per instance, so that different layers / stages of a model can use different actfuns and p, k
+        self.actfun = actfun
+        self.p = p
+        self.k = k
+        self.g = g
+        # In eval mode, coin flip actfuns return their expected output instead of drawing
+        self.deterministic_eval = False
+        # Recompute the p-expanded activation in backward instead of keeping it alive, see set_grad_checkpointing
+        self.grad_checkpointing = False
+        # Permutations are buffers so they move with the module, are saved in checkpoints, and never
+        # need a host-to-device copy in forward
+        self.register_buffer('shuffle_maps', None)
+        self.register_buffer('permute_index', None)
+        self.binary_ops_plan = None
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        keep_missing_buffers(self, state_dict, prefix, ['shuffle_maps', 'permute_index'])
+        super(HigherOrderActivation, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
 
     def forward(self, input: Tensor) -> Tensor:
-        return activate(input, self.actfun, p=self.p, k=self.k, shuffle_maps=self.shuffle_maps)
+        if torch.jit.is_scripting():
+            # see activate_scriptable for the actfuns supported in TorchScript
+            return activate_scriptable(input, self.actfun, self.k, self.permute_index if self.p > 1 else None)
+        return self._forward_eager(input)
+
+    @torch.jit.unused
+    def _forward_eager(self, input: Tensor) -> Tensor:
+        if input.is_quantized:
+            return self._activate_quantized(input)
+        # Coin flips drawn from a set generator would pick different elements when recomputed
+        if self.grad_checkpointing and torch.is_grad_enabled() and input.requires_grad and not (
+                self.actfun in ('cf_relu', 'cf_abs') and _coin_flip_generator is not None):
+            return cp.checkpoint(self._activate, input)
+        return self._activate(input)
+
+    def _activate(self, input: Tensor) -> Tensor:
+        # Under mixed precision, actfuns that are not safe in the input's dtype are evaluated in float32 (see
+        # get_compute_dtype) so that autocast can stay enabled for the rest of the network
+        compute_dtype = get_compute_dtype(self.actfun, input.dtype)
+        output = activate(input.to(compute_dtype), self.actfun, p=self.p, k=self.k, shuffle_maps=self.shuffle_maps,
+                          permute_index=self.permute_index, binary_ops_plan=self.binary_ops_plan,
+                          deterministic=self.deterministic_eval and not self.training)
+        return output.to(input.dtype)
+
+    def _activate_quantized(self, input: Tensor) -> Tensor:
+        # Selections commute with the (monotonic) per tensor affine quantization, so they run on the integer values
+        # and the output keeps the input's scale and zero point. linf selects on the distance to the zero point.
+        assert self.supports_quantized(), '{} must be dequantized around, see timm.utils.prepare_int8'.format(
+            self.actfun)
+        scale, zero_point = input.q_scale(), input.q_zero_point()
+        values = input.int_repr()
+        int_dtype = values.dtype
+        if self.actfun == 'linf':
+            values = values.to(torch.int32) - zero_point
+        output = activate(values, self.actfun, p=self.p, k=self.k, permute_index=self.permute_index)
+        if self.actfun == 'linf':
+            info = torch.iinfo(int_dtype)
+            output = output.add(zero_point).clamp_(info.min, info.max).to(int_dtype)
+        return torch._make_per_tensor_quantized_tensor(output, scale, zero_point)
+
+    def supports_quantized(self):
+        """ True if this activation can run on quantized tensors as is, otherwise it has to run in float """
+        return self.actfun in _QUANTIZED_ACTFUNS
 
     def init_shuffle_maps(self, num_channels):
-        self.shuffle_maps = []
-        for i in range(self.p):
-            self.shuffle_maps.append(torch.randperm(num_channels))
+        self.shuffle_maps = torch.stack([torch.randperm(num_channels) for _ in range(self.p)])
+        self.permute_index = get_permutation_index(num_channels, self.p, self.k, shuffle_maps=self.shuffle_maps)
+        if self.actfun in _BINARY_OPS:
+            self.binary_ops_plan = get_binary_ops_plan(self.actfun, num_channels * self.p // self.k, self.k)
+
+    def fold_into(self, layer, norm=None):
+        """
+        Folds this activation's channel permutations into the dense conv / linear layer (and batch norm) in front
+        of it for inference, see gather_output_channels. The activation then clusters its input as it comes.
+        :param layer: nn.Conv2d (without groups) or nn.Linear whose output feeds norm, then this activation
+        :param norm: optional batch norm between layer and this activation
+        :return: True if the permutations were folded, False if there was nothing to fold or the layer is grouped
+        """
+        if self.p is None or self.p == 1 or self.permute_index is None:
+            return False
+        if not (isinstance(layer, nn.Linear) or (isinstance(layer, nn.Conv2d) and layer.groups == 1)):
+            return False
+        gather_output_channels(layer, norm, self.permute_index)
+        self.p = 1
+        self.shuffle_maps = None
+        self.permute_index = None
+        return True
 
     def get_actfun_multiplier(self):
         if self.actfun is not None and self.p is not None and self.k is not None:
@@ -41,6 +119,21 @@ class HigherOrderActivation(nn.Module):
         )
 
 
+def keep_missing_buffers(module, state_dict, prefix, names):
+    """
+    Fills in the entries of state_dict missing for module's buffers names with their current values, so that
+    checkpoints saved before the permutations were buffers still load (strictly), keeping the freshly generated ones
+    :param module: module the state_dict is loaded into, from _load_from_state_dict
+    :param state_dict: state dict being loaded, modified in place
+    :param prefix: prefix of module's entries in state_dict
+    :param names: names of the buffers
+    """
+    for name in names:
+        buffer = getattr(module, name)
+        if buffer is not None and prefix + name not in state_dict:
+            state_dict[prefix + name] = buffer
+
+
 def permute(x, method, layer_type, k, offset, num_groups=2, shuffle_map=None):
     if method == "roll":
         return torch.cat((x[:, offset:, ...], x[:, :offset, ...]), dim=1)
@@ -92,60 +185,248 @@ def get_pk_ratio(actfun, p, k, g):
     return pk_ratio
 
 
-def activate(x, actfun, p=1, k=2, M=None,
-             layer_type='conv',
-             permute_type='shuffle',
-             shuffle_maps=None,
-             alpha_primes=None,
-             alpha_dist=None,
-             reduce_actfuns=False,
-             **kwargs
-             ):
-    if permute_type == 'invert':
-        assert p % k == 0, 'k must divide p if you use the invert shuffle type ya big dummy.'
-
-    # Unsqueeze a dimension and populate it with permutations of our inputs
-    x = x.unsqueeze(2)
-    curr_permute = permute_type
-    permute_base = 0
+def _sort_flops(k):
+    # compare-exchanges cost a max and a min, see _SORTING_NETWORKS
+    if k in _SORTING_NETWORKS:
+        return 2 * len(_SORTING_NETWORKS[k])
+    return int(math.ceil(k * math.log2(k)))
+
+
+# Forward FLOPs per cluster of k for actfuns that reduce each cluster to one value. Exp / log / sqrt and other
+# elementwise functions count as one FLOP.
+_REDUCTION_FLOPS = {
+    'max': lambda k: k - 1,
+    'min': lambda k: k - 1,
+    'median': _sort_flops,
+    'prod': lambda k: k - 1,
+    'l1': lambda k: 2 * k - 1,
+    'l2': lambda k: 2 * k,
+    'linf': lambda k: 2 * k - 1,
+    'lse': lambda k: 4 * k,
+    'lae': lambda k: 4 * k + 1,
+    'nlsen': lambda k: 6 * k,
+    'nlaen': lambda k: 6 * k + 1,
+    'signed_geomean': lambda k: 5 * k,
+    'swishk': lambda k: 4 * k + 1,
+    'swishy': lambda k: 4 * k - 2,
+    'l3-signed': lambda k: 10,
+    'lse-approx': lambda k: 7,
+    'lae-approx': lambda k: 6,
+    'nlsen-approx': lambda k: 9,
+    'nlaen-approx': lambda k: 8,
+    'multi_relu': lambda k: k,
+    'ail_or': lambda k: 4 * k - 2,
+    'ail_and': lambda k: 4 * k - 2,
+    'ail_xnor': lambda k: 4 * k - 1,
+    'nail_or': lambda k: 4 * k - 1,
+    'nail_and': lambda k: 4 * k - 1,
+    'nail_xnor': lambda k: 4 * k,
+}
+# Forward FLOPs per element for actfuns applied elementwise
+_ELEMENTWISE_FLOPS = {'relu': 1, 'abs': 1, 'leaky_relu': 2, 'tanh': 1, 'swish': 3, 'cf_relu': 1, 'cf_abs': 1}
+
+
+def get_actfun_cost(actfun, p, k, g, input_shape, element_size=4):
+    """
+    Analytical cost of evaluating actfun on a pre-activation tensor, as computed by activate()
+    :param actfun: activation function
+    :param p: number of permutations
+    :param k: cluster size
+    :param g: number of groups (does not change the cost of the actfun itself)
+    :param input_shape: shape of the pre-activation tensor, (B, C, ...)
+    :param element_size: bytes per element
+    :return: dict with the output shape, and the FLOPs, bytes read and written and bytes of intermediate tensors
+             for 'forward' and 'backward' ('backward' also has the bytes saved by forward for it)
+    """
+    batch_size, num_channels, spatial = input_shape[0], input_shape[1], tuple(input_shape[2:])
+    num_spatial = functools.reduce(lambda a, b: a * b, spatial, 1)
+    num_in = batch_size * num_channels * num_spatial
+    num_z = num_in * p
+    num_clusters = num_z // k
+
+    if actfun in _ELEMENTWISE_FLOPS:
+        num_out = num_clusters if actfun in ('cf_relu', 'cf_abs') else num_z
+        flops = _ELEMENTWISE_FLOPS[actfun] * num_out
+    elif actfun == 'groupsort':
+        num_out = num_z
+        flops = _sort_flops(k) * num_clusters
+    elif actfun == 'combinact':
+        num_out = num_clusters
+        flops = sum(_REDUCTION_FLOPS[a](k) + 2 for a in get_combinact_actfuns()) * num_clusters
+    elif actfun in _BINARY_OPS:
+        plan = get_binary_ops_plan(actfun, num_channels * p // k, k)
+        num_positions = batch_size * num_spatial
+        num_out = plan.num_outputs * num_positions
+        flops = sum(_REDUCTION_FLOPS[reduction](k) * (end - start)
+                    for reduction, (_, _, start, end, _, _) in zip(_BINARY_OPS[actfun][0], plan.steps)) * num_positions
+    else:
+        num_out = num_clusters
+        flops = _REDUCTION_FLOPS[actfun](k) * num_clusters
+
+    # With p > 1, the p permuted copies are gathered into an intermediate tensor that is then read by the actfun
+    gathered = num_z * element_size if p > 1 else 0
+    forward = {
+        'flops': flops,
+        'bytes_read': num_in * element_size + gathered,
+        'bytes_written': num_out * element_size + gathered,
+        'intermediate_bytes': gathered,
+    }
+
+    # Selections scatter the gradient to the selected elements, everything else is counted as twice the forward
+    # FLOPs. The gradient w.r.t. the clustered tensor is summed back into the input channels when p > 1.
+    index_bytes = num_channels * p * 8 if p > 1 else 0
+    if actfun in _SELECTION_ACTFUNS:
+        backward_flops = num_out
+        saved = num_clusters * (2 if actfun == 'linf' else 1) + index_bytes
+    elif actfun == 'groupsort':
+        backward_flops = 0
+        saved = num_z + index_bytes
+    elif p > 1 and actfun in _GROUPED_REDUCTIONS:
+        # GroupedReduction recomputes the forward in backward
+        backward_flops = 3 * flops
+        saved = num_in * element_size + index_bytes
+    else:
+        backward_flops = 2 * flops
+        saved = num_z * element_size
+    grad_z = num_z * element_size if p > 1 or actfun in _SELECTION_ACTFUNS + ['groupsort'] else 0
+    backward = {
+        'flops': backward_flops + (num_z if p > 1 else 0),
+        'bytes_read': num_out * element_size + saved + grad_z,
+        'bytes_written': num_in * element_size + grad_z,
+        'intermediate_bytes': grad_z,
+        'saved_bytes': saved,
+    }
+
+    num_out_channels = num_out // (batch_size * num_spatial)
+    return {'output_shape': (batch_size, num_out_channels) + spatial, 'forward': forward, 'backward': backward}
+
+
+def get_permutation_index(num_channels, p, k=2, permute_type='shuffle', shuffle_maps=None):
+    """Builds the channel index that lays out all p permutations of a layer's inputs one after another.
+
+    Gathering channels with this index and reshaping to (B, C*p/k, k, ...) gives the same clusters as
+    building each permutation separately, but only needs a single index_select per forward pass.
+    """
+    device = shuffle_maps[0].device if shuffle_maps is not None else None
+    base = torch.arange(num_channels, device=device).unsqueeze(0)
+    all_perms = [base]
     for i in range(1, p):
-        curr_shuffle = shuffle_maps[i]
+        curr_permute = permute_type
+        curr_shuffle = shuffle_maps[i] if shuffle_maps is not None else None
+        permute_base = base
         if permute_type == 'invert':
             if i % k == 0:
                 curr_permute = 'shuffle'
-                permute_base = 0
             else:
                 curr_permute = 'invert'
-                permute_base = x.shape[2] - 1
-                curr_shuffle = torch.arange(k)
+                permute_base = all_perms[-1]
+                curr_shuffle = torch.arange(k, device=device)
                 curr_shuffle[0] = i % k
                 curr_shuffle[i % k] = 0
-        permutation = permute(x[:, :, permute_base, ...], curr_permute, layer_type, k,
-                              offset=i, shuffle_map=curr_shuffle).unsqueeze(2)
-        x = torch.cat((x[:, :, :i, ...], permutation), dim=2)
+        all_perms.append(permute(permute_base, curr_permute, 'linear', k, offset=i, shuffle_map=curr_shuffle))
+    return torch.cat(all_perms, dim=1).squeeze(0)
+
+
+def cluster(x, permute_index, k):
+    """Gathers the permuted copies of x's channels and groups them into clusters of size k along dim 2."""
+    if permute_index is not None and x.dim() == 2:
+        # Gather (B, k, N) and view it as (B, N, k), so that the i-th elements of all clusters form one contiguous
+        # row. Reductions over k then combine k long rows instead of reducing many k-element rows.
+        x = x.index_select(1, permute_index.reshape(-1, k).t().reshape(-1))
+        return x.reshape(x.shape[0], k, -1).transpose(1, 2)
+    if permute_index is not None:
+        x = x.index_select(1, permute_index)
+    return x.reshape(x.shape[0], -1, k, *x.shape[2:])
+
+
+def gather_output_channels(layer, norm, index):
+    """
+    Rewrites a conv / linear layer, and the batch norm after it, to output its channels gathered by index. Any
+    channel gather that follows the two, such as the permutations of activate(), can then be dropped: the
+    filters and per-channel norm parameters are simply copied in the gathered order.
+    :param layer: nn.Conv2d (without groups), nn.Linear or a single group GroupedLinear
+    :param norm: batch norm applied to the layer's output, or None
+    :param index: output channels to gather
+    :return:
+    """
+    with torch.no_grad():
+        if layer.weight.dim() == 3:
+            # GroupedLinear, weight stored as (1, in_features, out_features)
+            layer.weight = nn.Parameter(layer.weight[:, :, index].clone())
+        else:
+            layer.weight = nn.Parameter(layer.weight[index].clone())
+        if layer.bias is not None:
+            layer.bias = nn.Parameter(layer.bias[index].clone())
+        if isinstance(layer, nn.Conv2d):
+            layer.out_channels = len(index)
+        else:
+            layer.out_features = len(index)
 
-    # This transpose makes it so that during the next reshape (when we combine our p permutations
-    # into a single dimension), the order goes one full permutation after another (instead of
-    # interleaving the permutations)
-    x = torch.transpose(x, dim0=1, dim1=2)
+        if norm is not None:
+            if norm.affine:
+                norm.weight = nn.Parameter(norm.weight[index].clone())
+                norm.bias = nn.Parameter(norm.bias[index].clone())
+            if norm.track_running_stats:
+                norm.running_mean = norm.running_mean[index].clone()
+                norm.running_var = norm.running_var[index].clone()
+            norm.num_features = len(index)
 
-    # Combine p permutations into a single dimension, then cluster into groups of size k
-    batch_size = x.shape[0]
-    if layer_type == 'conv':
-        num_channels = x.shape[2]
-        height = x.shape[3]
-        width = x.shape[4]
-        x = x.reshape(batch_size, int(num_channels * p / k), k, height, width)
-    elif layer_type == 'linear':
-        num_channels = M
-        x = x.reshape(batch_size, int(num_channels * p / k), k)
 
-    bin_partition_actfuns = ['bin_part_full', 'bin_part_max_min_sgm', 'bin_part_max_sgm',
-                             'ail_part_full', 'ail_part_or_and_xnor', 'ail_part_or_xnor',
-                             'nail_part_full', 'nail_part_or_and_xnor', 'nail_part_or_xnor']
-    bin_all_actfuns = ['bin_all_full', 'bin_all_max_min', 'bin_all_max_sgm', 'bin_all_max_min_sgm',
-                       'ail_all_full', 'ail_all_or_and', 'ail_all_or_xnor', 'ail_all_or_and_xnor',
-                       'nail_all_full', 'nail_all_or_and', 'nail_all_or_xnor', 'nail_all_or_and_xnor']
+def _is_channels_last(x):
+    return x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last)
+
+
+def activate(x, actfun, p=1, k=2, M=None,
+             layer_type='conv',
+             permute_type='shuffle',
+             shuffle_maps=None,
+             alpha_primes=None,
+             alpha_dist=None,
+             reduce_actfuns=False,
+             permute_index=None,
+             combinact_actfuns=None,
+             binary_ops_plan=None,
+             deterministic=False,
+             **kwargs
+             ):
+    if permute_type == 'invert' and p > 1:
+        assert p % k == 0, 'k must divide p if you use the invert shuffle type ya big dummy.'
+
+    num_channels = x.shape[1]
+    if p == 1:
+        permute_index = None
+    elif permute_index is None:
+        permute_index = get_permutation_index(num_channels, p, k, permute_type, shuffle_maps).to(x.device)
+
+    if layer_type == 'conv' and _is_channels_last(x):
+        # NHWC inputs are activated as a (B * H * W, C) batch of linear features, a view of the same memory, and
+        # the result is viewed back as a channels-last (B, C', H, W) tensor without any layout conversion
+        batch_size, _, height, width = x.shape
+        x = activate(x.permute(0, 2, 3, 1).reshape(-1, num_channels), actfun, p=p, k=k, M=M,
+                     layer_type='linear',
+                     permute_type=permute_type,
+                     shuffle_maps=shuffle_maps,
+                     alpha_primes=alpha_primes,
+                     alpha_dist=alpha_dist,
+                     reduce_actfuns=reduce_actfuns,
+                     permute_index=permute_index,
+                     combinact_actfuns=combinact_actfuns,
+                     binary_ops_plan=binary_ops_plan,
+                     deterministic=deterministic)
+        return x.reshape(batch_size, height, width, -1).permute(0, 3, 1, 2)
+
+    # When training, grouped reductions gather and reduce in one autograd node so that the p-times larger
+    # clustered tensor is not kept alive for backward. Selections only need to remember which element won.
+    if actfun in _SELECTION_ACTFUNS and torch.is_grad_enabled() and x.requires_grad:
+        return GroupedSelection.apply(x, permute_index if p > 1 else None, k, actfun, False)
+    if actfun == 'groupsort' and torch.is_grad_enabled() and x.requires_grad:
+        return GroupSort.apply(x, permute_index if p > 1 else None, k)
+    if p > 1 and actfun in _GROUPED_REDUCTIONS and torch.is_grad_enabled() and x.requires_grad:
+        return GroupedReduction.apply(x, permute_index, k, actfun)
+
+    # Populate the channel dimension with all p permutations of our inputs (one full permutation after
+    # another) using a single gather, then cluster into groups of size k
+    x = cluster(x, permute_index, k)
 
     if actfun == 'combinact':
         x = combinact(x,
@@ -153,11 +434,14 @@ def activate(x, actfun, p=1, k=2, M=None,
                       layer_type=layer_type,
                       alpha_primes=alpha_primes,
                       alpha_dist=alpha_dist,
-                      reduce_actfuns=reduce_actfuns)
+                      reduce_actfuns=reduce_actfuns,
+                      combinact_actfuns=combinact_actfuns)
     elif actfun == 'cf_relu' or actfun == 'cf_abs':
-        x = coin_flip(x, actfun, M=num_channels * p, k=k)
-    elif actfun in bin_partition_actfuns or actfun in bin_all_actfuns:
-        x = binary_ops(x, actfun, layer_type, bin_partition_actfuns, bin_all_actfuns)
+        x = coin_flip(x, actfun, deterministic=deterministic)
+    elif actfun in _BINARY_OPS:
+        if binary_ops_plan is None:
+            binary_ops_plan = get_binary_ops_plan(actfun, x.shape[1], k)
+        x = binary_ops_plan(x)
     elif actfun == 'groupsort':
         x = groupsort(x, layer_type)
     else:
@@ -166,8 +450,82 @@ def activate(x, actfun, p=1, k=2, M=None,
     return x
 
 
+def _logavgexp_scriptable(z: Tensor) -> Tensor:
+    return torch.logsumexp(z, dim=2) - math.log(z.shape[2])
+
+
+def activate_scriptable(x: Tensor, actfun: str, k: int, permute_index: Optional[Tensor] = None) -> Tensor:
+    """
+    TorchScript compatible activate() for inference, with the same outputs. Supports the selection and reduction
+    actfuns and groupsort, for conv or linear inputs; the others raise. Computes in the input's dtype.
+    :param x: (B, C, H, W) or (B, C) input
+    :param actfun: actfun name
+    :param k: cluster size
+    :param permute_index: channel gather index of the p permutations (see get_permutation_index), None for p == 1
+    :return:
+    """
+    if permute_index is not None:
+        x = x.index_select(1, permute_index)
+    shape = list(x.shape)
+    z = x.reshape([shape[0], shape[1] // k, k] + shape[2:])
+    if actfun == 'groupsort':
+        return z.sort(dim=2, descending=True)[0].reshape([shape[0], shape[1]] + shape[2:])
+    if actfun == 'max':
+        return torch.amax(z, dim=2)
+    if actfun == 'min':
+        return torch.amin(z, dim=2)
+    if actfun == 'median':
+        return torch.median(z, dim=2)[0]
+    if actfun == 'prod':
+        return torch.prod(z, dim=2)
+    if actfun == 'l1':
+        return torch.sum(z.abs(), dim=2)
+    if actfun == 'l2':
+        return torch.sum(z.pow(2), dim=2).sqrt_()
+    if actfun == 'l3-signed':
+        x3y3 = z[:, :, 0].pow(3) + z[:, :, 1].pow(3)
+        return x3y3.tanh() * x3y3.abs().pow(1 / 3)
+    if actfun == 'linf':
+        return torch.max(z.abs(), dim=2)[0]
+    if actfun == 'lse':
+        return torch.logsumexp(z, dim=2)
+    if actfun == 'lae':
+        return _logavgexp_scriptable(z)
+    if actfun == 'nlsen':
+        return -1 * torch.logsumexp(-1 * z, dim=2)
+    if actfun == 'nlaen':
+        return -1 * _logavgexp_scriptable(-1 * z)
+    if actfun == 'swishk':
+        return z[:, :, 0] * torch.exp(torch.sum(F.logsigmoid(z), dim=2))
+    if actfun == 'swishy':
+        return z[:, :, 0] * torch.exp(torch.sum(F.logsigmoid(z[:, :, 1:]), dim=2))
+    if actfun == 'signed_geomean':
+        log_abs = z.abs().to(torch.promote_types(z.dtype, torch.float32)).log_().sum(dim=2)
+        negative = (z < 0).sum(dim=2).remainder_(2).bool()
+        output = log_abs.mul_(0.5).exp_()
+        return torch.where(negative, -output, output).to(z.dtype)
+    if actfun.endswith('-approx'):
+        # two-element approximations of lse / lae / nlsen / nlaen
+        gap = -0.305 * (z[:, :, 0] - z[:, :, 1]).abs()
+        if actfun.startswith('lse') or actfun.startswith('nlsen'):
+            gap = (gap + math.log(2.)).clamp_min(0.)
+        else:
+            gap = gap.clamp_min(-math.log(2.))
+        if actfun.startswith('n'):
+            return -torch.max(-z[:, :, 0], -z[:, :, 1]) - gap
+        return torch.max(z[:, :, 0], z[:, :, 1]) + gap
+    raise RuntimeError('actfun {} is not supported in TorchScript'.format(actfun))
+
+
 # -------------------- Activation Functions
 
+# Reductions that GroupedReduction computes straight from the un-expanded input
+_GROUPED_REDUCTIONS = ['max', 'min', 'l2', 'linf', 'lse', 'lae', 'swishk', 'prod', 'signed_geomean']
+# Reductions whose gradient only flows to the selected element of each group, see GroupedSelection
+_SELECTION_ACTFUNS = ['max', 'min', 'linf']
+# Actfuns that select elements (by value or magnitude) and so can run directly on quantized tensors
+_QUANTIZED_ACTFUNS = ['max', 'min', 'linf', 'median', 'groupsort']
+
 _COMBINACT_ACTFUNS = ['max', 'swishk', 'l1', 'l2', 'linf', 'lse', 'lae', 'min', 'nlsen', 'nlaen', 'signed_geomean']
 _COMBINACT_ACTFUNS_REDUCED = ['max', 'swishk', 'l2', 'lae', 'signed_geomean']
 
@@ -196,7 +554,10 @@ def logistic_or_approx(z):
 
 
 def logistic_xnor_approx(z):
-    return torch.sign(torch.prod(z, dim=2)) * torch.min(z.abs(), dim=2).values
+    # The sign comes from the parity of negative elements rather than the product, which underflows in fp16
+    negative = (z < 0).sum(dim=2).remainder_(2).bool()
+    out_val = torch.min(z.abs(), dim=2).values
+    return torch.where(negative, -out_val, out_val)
 
 
 def logistic_and_approx_normalized(z):
@@ -214,69 +575,92 @@ def logistic_xnor_approx_normalized(z):
     return logistic_xnor_approx(z).mul_(1.658896739970306)
 
 
-def combinact(x, p, layer_type='linear', alpha_primes=None, alpha_dist=None, reduce_actfuns=False):
-    if reduce_actfuns:
-        all_actfuns = _COMBINACT_ACTFUNS_REDUCED
-    else:
-        all_actfuns = _COMBINACT_ACTFUNS
+def combinact(x, p, layer_type='linear', alpha_primes=None, alpha_dist=None, reduce_actfuns=False,
+              combinact_actfuns=None):
+    # combinact_actfuns overrides the default set, e.g. for layers whose low-weight actfuns have been pruned
+    all_actfuns = combinact_actfuns if combinact_actfuns is not None else get_combinact_actfuns(reduce_actfuns)
 
     # Recording current input shape
     batch_size = x.shape[0]
     num_clusters = x.shape[1]
-    img_size = x.shape[-1]
+    spatial = x.shape[3:]
 
     layer_alphas = F.softmax(alpha_primes, dim=1)  # Convert alpha prime to alpha
 
-    # Computing all activation functions
-    outputs = None
-    for i, actfun in enumerate(all_actfuns):
-        if i == 0:
-            outputs = _ACTFUNS[actfun](x).to(x.device)
-            outputs = outputs.unsqueeze(dim=2)
-        else:
-            outputs = torch.cat((outputs, _ACTFUNS[actfun](x).unsqueeze(dim=2)), dim=2)
+    # Computing all activation functions into one (num_actfuns, B, num_clusters, ...) stack, sharing
+    # intermediates (max, min, abs, logsumexp) between the actfuns that use them
+    shared = _SharedTerms(x)
+    outputs = torch.stack([_COMBINACT_TERMS[actfun](x, shared) for actfun in all_actfuns])
+    layer_alphas = layer_alphas.to(outputs.dtype).t()
 
-    # Handling per-permutation alpha vector
+    # Handling per-permutation alpha vector. The weighted sums across all actfuns contract the actfun axis with
+    # einsum, without materializing the weighted (num_actfuns, B, num_clusters, ...) outputs
     if alpha_dist == "per_perm":
-        if layer_type == 'conv':
-            layer_alphas = layer_alphas.reshape([1, 1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1],
-                                                 1, 1])
-            outputs = outputs.reshape([batch_size, int(num_clusters / p), p,
-                                       len(all_actfuns), img_size, img_size])
-
-        elif layer_type == 'linear':
-            layer_alphas = layer_alphas.reshape([1, 1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1]])
-            outputs = outputs.reshape([batch_size, int(num_clusters / p), p,
-                                       len(all_actfuns)])
-        outputs = outputs * layer_alphas  # Multiply elements in last 2 dims of outputs by layer_alphas
-        outputs = torch.sum(outputs, dim=3)  # Sum across all actfuns
-
-        if layer_type == 'conv':
-            outputs = outputs.reshape([batch_size, num_clusters, img_size, img_size])
-        elif layer_type == 'linear':
-            outputs = outputs.reshape([batch_size, num_clusters])
+        outputs = outputs.reshape((len(all_actfuns), batch_size, num_clusters // p, p) + spatial)
+        outputs = torch.einsum('abcp...,ap->bcp...', outputs, layer_alphas)
+        outputs = outputs.reshape((batch_size, num_clusters) + spatial)
 
     # Handling per-cluster alpha vector
     elif alpha_dist == "per_cluster":
-        if layer_type == 'conv':
-            layer_alphas = layer_alphas.reshape([1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1],
-                                                 1, 1])
-        elif layer_type == 'linear':
-            layer_alphas = layer_alphas.reshape([1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1]])
-
-        outputs = outputs * layer_alphas  # Multiply elements in last 2 dims of outputs by layer_alphas
-        outputs = torch.sum(outputs, dim=2)  # Sum across all actfuns
+        outputs = torch.einsum('abc...,ac->bc...', outputs, layer_alphas)
 
     return outputs
 
 
-def coin_flip(z, actfun, M, k):
-    shuffle_map = torch.empty(int(M / k), dtype=torch.long).random_(k)
-    z = z[:, torch.arange(z.size(1)), shuffle_map, ...]
+class _SharedTerms(dict):
+    """Lazily computed intermediates that several combinact actfuns have in common"""
+    def __init__(self, z):
+        super(_SharedTerms, self).__init__()
+        self.z = z
+
+    def __missing__(self, key):
+        value = self[key] = _SHARED_TERMS[key](self.z, self)
+        return value
+
+
+def _shifted_logsumexp(z, shift):
+    return shift + torch.log(torch.sum(torch.exp(z - shift.unsqueeze(2)), dim=2))
+
+
+_SHARED_TERMS = {
+    'max': lambda z, s: torch.max(z, dim=2).values,
+    'min': lambda z, s: torch.min(z, dim=2).values,
+    'abs': lambda z, s: z.abs(),
+    'lse': lambda z, s: _shifted_logsumexp(z, s['max'].detach()),
+    'nlsen': lambda z, s: -_shifted_logsumexp(-z, -s['min'].detach()),
+}
+
+
+# Generator the coin flips draw from, None for the default generator of the input's device
+_coin_flip_generator = None
+
+
+def set_coin_flip_generator(generator):
+    """
+    Makes coin flip activations draw from generator, for reproducible runs. It is re-created from its seed on the
+    device of the inputs if they live elsewhere.
+    :param generator: torch.Generator, or None to go back to the default generator
+    """
+    global _coin_flip_generator
+    _coin_flip_generator = generator
+
+
+def coin_flip(z, actfun, deterministic=False):
+    """
+    Picks one random element of each cluster (the same one for every sample and position) and activates it.
+    :param z: clustered input, (B, N, k) or (B, N, k, H, W)
+    :param actfun: 'cf_relu' or 'cf_abs'
+    :param deterministic: instead of drawing, return the expected output over all k choices
+    """
+    global _coin_flip_generator
+    if deterministic:
+        return F.relu(z).mean(dim=2) if actfun == 'cf_relu' else z.abs().mean(dim=2)
+    generator = _coin_flip_generator
+    if generator is not None and generator.device != z.device:
+        generator = _coin_flip_generator = torch.Generator(z.device).manual_seed(generator.initial_seed())
+    # drawn on the input's device, so accelerators don't wait on a host-to-device copy
+    index = torch.randint(z.size(2), (1, z.size(1), 1) + (1,) * (z.dim() - 3), device=z.device, generator=generator)
+    z = z.gather(2, index.expand(z.shape[:2] + (1,) + z.shape[3:])).squeeze(2)
     if actfun == 'cf_relu':
         return F.relu_(z)
     elif actfun == 'cf_abs':
@@ -288,8 +672,76 @@ def multi_relu(z):
     return F.relu(z)
 
 
+# Optimal compare-exchange networks for small clusters. Each (i, j) pair moves the larger of the two elements to
+# position i, so running a network over the k slices of a cluster sorts it in descending order with elementwise
+# max / min only. Larger clusters fall back to torch.sort / torch.amax.
+_SORTING_NETWORKS = {
+    2: [(0, 1)],
+    3: [(0, 1), (1, 2), (0, 1)],
+    4: [(0, 1), (2, 3), (0, 2), (1, 3), (1, 2)],
+    5: [(0, 1), (3, 4), (2, 4), (2, 3), (0, 3), (0, 2), (1, 4), (1, 3), (1, 2)],
+    6: [(1, 2), (4, 5), (0, 2), (3, 5), (0, 1), (3, 4), (1, 4), (0, 3), (2, 5), (1, 3), (2, 4), (2, 3)],
+}
+
+
+def _network_sort(z):
+    elements = list(z.unbind(2))
+    for i, j in _SORTING_NETWORKS[z.shape[2]]:
+        elements[i], elements[j] = torch.maximum(elements[i], elements[j]), torch.minimum(elements[i], elements[j])
+    return elements
+
+
+def _network_sort_indices(z):
+    # _network_sort that also tracks the position each sorted element came from, for the autograd functions
+    elements = list(z.unbind(2))
+    indices = [torch.full_like(elements[0], i, dtype=torch.uint8) for i in range(len(elements))]
+    for i, j in _SORTING_NETWORKS[z.shape[2]]:
+        swap = elements[j] > elements[i]
+        elements[i], elements[j] = (torch.where(swap, elements[j], elements[i]),
+                                    torch.where(swap, elements[i], elements[j]))
+        indices[i], indices[j] = torch.where(swap, indices[j], indices[i]), torch.where(swap, indices[i], indices[j])
+    return torch.stack(elements, dim=2), torch.stack(indices, dim=2)
+
+
+def _network_select(z, largest):
+    # Largest (or smallest) element of each cluster and its position, with k - 1 elementwise comparisons
+    elements = z.unbind(2)
+    output, indices = elements[0], torch.zeros_like(elements[0], dtype=torch.uint8)
+    for i, element in enumerate(elements[1:], 1):
+        better = element > output if largest else element < output
+        output = torch.where(better, element, output)
+        indices = indices.masked_fill(better, i)
+    return output, indices
+
+
+def sort_clusters(z):
+    """Sorts each cluster of z (dim 2) in descending order."""
+    if z.shape[2] in _SORTING_NETWORKS:
+        return torch.stack(_network_sort(z), dim=2)
+    return z.sort(dim=2, descending=True).values
+
+
+def cluster_max(z):
+    if z.shape[2] in _SORTING_NETWORKS:
+        return functools.reduce(torch.maximum, z.unbind(2))
+    return torch.amax(z, dim=2)
+
+
+def cluster_min(z):
+    if z.shape[2] in _SORTING_NETWORKS:
+        return functools.reduce(torch.minimum, z.unbind(2))
+    return torch.amin(z, dim=2)
+
+
+def cluster_median(z):
+    """Lower median of each cluster, matching torch.median for even k."""
+    if z.shape[2] in _SORTING_NETWORKS:
+        return _network_sort(z)[z.shape[2] // 2]
+    return torch.median(z, dim=2).values
+
+
 def groupsort(z, layer_type):
-    z = z.sort(dim=2, descending=True).values
+    z = sort_clusters(z)
     if layer_type == 'conv':
         z = z.reshape(z.shape[0], z.shape[1] * z.shape[2],
                       z.shape[3], z.shape[4])
@@ -298,28 +750,149 @@ def groupsort(z, layer_type):
     return z
 
 
+def _accumulate_dtype(x):
+    return torch.promote_types(x.dtype, torch.float32)
+
+
 class SignedGeomean(torch.autograd.Function):
+    """sign(prod(x)) * sqrt(|prod(x)|) over the clusters of the input.
+
+    The magnitude is summed in the log domain in float32, so the product of the k elements cannot overflow or
+    underflow under fp16 / bf16 autocast. The gradient has the closed form 0.5 * output / x (zero where x is zero),
+    so only the input and the k-times smaller output are saved.
+    """
     @staticmethod
     def forward(ctx, input):
-        ctx.save_for_backward(input)
-        prod = torch.prod(input, dim=2)
-        signs = prod.sign()
-        return signs * prod.abs().sqrt()
+        log_abs = input.abs().to(_accumulate_dtype(input)).log_().sum(dim=2)
+        negative = (input < 0).sum(dim=2).remainder_(2).bool()
+        output = log_abs.mul_(0.5).exp_()
+        output = torch.where(negative, -output, output).to(input.dtype)
+        ctx.save_for_backward(input, output)
+        return output
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        input, output = ctx.saved_tensors
+        dtype = _accumulate_dtype(input)
+        grad_input = (output.to(dtype) * grad_output.to(dtype)).mul_(0.5).unsqueeze(2).div(input.to(dtype))
+        grad_input.masked_fill_(input == 0, 0)
+        return grad_input.to(input.dtype)
+
+
+class GroupedReduction(torch.autograd.Function):
+    """Clusters the permuted input and reduces each group of k elements in a single autograd node.
+
+    Only the un-expanded input is saved. The clustered tensor is rebuilt from the permutation index in
+    backward, and the gradient is scattered back to the input channels through the same index.
+    """
+    @staticmethod
+    def forward(ctx, input, permute_index, k, actfun):
+        ctx.save_for_backward(input, permute_index)
+        ctx.k = k
+        ctx.actfun = actfun
+        return _ACTFUNS[actfun](cluster(input, permute_index, k))
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        input, permute_index = ctx.saved_tensors
+        with torch.enable_grad():
+            input = input.detach().requires_grad_()
+            output = _ACTFUNS[ctx.actfun](cluster(input, permute_index, ctx.k))
+        grad_input, = torch.autograd.grad(output, input, grad_output)
+        return grad_input, None, None, None
+
+
+def _compact_index(indices, k):
+    return indices.to(torch.uint8) if k <= 256 else indices
+
+
+def _uncluster_grad(grad_z, input_shape, permute_index):
+    # Flattens a gradient w.r.t. the clustered tensor and scatters it back to the un-expanded input channels
+    grad_z = grad_z.reshape(grad_z.shape[0], -1, *grad_z.shape[3:])
+    if permute_index is None:
+        return grad_z.reshape(input_shape)
+    return grad_z.new_zeros(input_shape).index_add_(1, permute_index, grad_z)
 
+
+class GroupedSelection(torch.autograd.Function):
+    """'max', 'min' or 'linf' over clusters of k, saving only the position of the selected element.
+
+    The position is stored as uint8 (plus the sign of the selected element for 'linf') instead of the float
+    input, and the gradient is scattered to that element in backward. With clustered=True the input is already
+    (B, N, k, ...) and is used as is. 'max' and 'min' select with elementwise comparisons for the cluster sizes
+    of _SORTING_NETWORKS, as in inference.
+    """
+    @staticmethod
+    def forward(ctx, input, permute_index, k, actfun, clustered):
+        z = input if clustered else cluster(input, permute_index, k)
+        sign = None
+        if k in _SORTING_NETWORKS and actfun in ('max', 'min'):
+            # Elementwise comparisons give both the value and the position of the selected element
+            output, indices = _network_select(z, actfun == 'max')
+        elif actfun == 'max':
+            output, indices = torch.max(z, dim=2)
+        elif actfun == 'min':
+            output, indices = torch.min(z, dim=2)
+        elif actfun == 'linf':
+            output, indices = torch.max(z.abs(), dim=2)
+            sign = torch.gather(z, 2, indices.unsqueeze(2)).squeeze(2) < 0
+        ctx.save_for_backward(_compact_index(indices, k), permute_index, sign)
+        ctx.input_shape = input.shape
+        ctx.k = k
+        return output
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        indices, permute_index, sign = ctx.saved_tensors
+        if sign is not None:
+            grad_output = torch.where(sign, -grad_output, grad_output)
+        grad_z = grad_output.new_zeros(grad_output.shape[:2] + (ctx.k,) + grad_output.shape[2:])
+        grad_z.scatter_(2, indices.long().unsqueeze(2), grad_output.unsqueeze(2))
+        return _uncluster_grad(grad_z, ctx.input_shape, permute_index), None, None, None, None
+
+
+class GroupSort(torch.autograd.Function):
+    """Sorts each cluster of k in descending order, saving only the uint8 sort positions for backward.
+
+    Clusters of the sizes in _SORTING_NETWORKS are sorted by their compare-exchange network, as in inference.
+    """
     @staticmethod
+    def forward(ctx, input, permute_index, k):
+        z = cluster(input, permute_index, k)
+        if k in _SORTING_NETWORKS:
+            z, indices = _network_sort_indices(z)
+        else:
+            z, indices = z.sort(dim=2, descending=True)
+        ctx.save_for_backward(_compact_index(indices, k), permute_index)
+        ctx.input_shape = input.shape
+        return z.reshape(z.shape[0], -1, *z.shape[3:])
+
+    @staticmethod
+    @once_differentiable
     def backward(ctx, grad_output):
-        input, = ctx.saved_tensors
+        indices, permute_index = ctx.saved_tensors
+        grad_output = grad_output.reshape(indices.shape)
+        grad_z = torch.zeros_like(grad_output).scatter_(2, indices.long(), grad_output)
+        return _uncluster_grad(grad_z, ctx.input_shape, permute_index), None, None
 
-        prod = input.prod(dim=2).unsqueeze(2)
-        signs = prod.sign()
 
-        A = (prod.expand(input.shape) / input).abs().sqrt() * input
-        B = 2 * input.abs().pow(3 / 2)
+def select(z, actfun):
+    """Selection reduction over the clusters of z, using GroupedSelection whenever a backward pass will follow."""
+    if torch.is_grad_enabled() and z.requires_grad:
+        return GroupedSelection.apply(z, None, z.shape[2], actfun, True)
+    return _ACTFUNS[actfun](z)
 
-        grad_input = signs * A / B * grad_output.unsqueeze(2).expand(input.shape)
-        grad_input[input.abs() == 0] = 0
 
-        return grad_input
+def l2_norm(z):
+    if z.dtype == torch.float16:
+        # Rescale by the largest magnitude in each cluster so that the squares cannot overflow or underflow. The
+        # result does not depend on the scale, so it is kept out of the graph.
+        scale = z.detach().abs().amax(dim=2, keepdim=True).clamp_min_(torch.finfo(z.dtype).tiny)
+        return torch.sum((z / scale).pow(2), dim=2).sqrt_().mul_(scale.squeeze(2))
+    return torch.sum(z.pow(2), dim=2).sqrt_()
 
 
 def signed_l3(z):
@@ -348,154 +921,116 @@ def logavgexp(input, dim, keepdim=False, temperature=None, dtype=torch.float32):
     return lae.to(input_dtype)
 
 
-def binary_ops(z, actfun, layer_type, bin_partition_actfuns, bin_all_actfuns):
-
-    bin_pass = None
-
-    if actfun in bin_partition_actfuns:
-        if actfun == 'bin_part_full':
-            partition = math.floor(z.shape[1] / 4)
-            zs = [
-                torch.max(z[:, :partition, ...], dim=2).values,
-                torch.min(z[:, partition:2 * partition, ...], dim=2).values,
-                sgm(z[:, 2 * partition: 3 * partition, ...]),
-            ]
-            bin_pass = z[:, 3 * partition:, ...]
-        elif actfun == 'bin_part_max_min_sgm':
-            partition = math.floor(z.shape[1] / 3)
-            zs = [
-                torch.max(z[:, :partition, ...], dim=2).values,
-                torch.min(z[:, partition:2 * partition, ...], dim=2).values,
-                sgm(z[:, 2 * partition:, ...]),
-            ]
-        elif actfun == 'bin_part_max_sgm':
-            partition = math.floor(z.shape[1] / 2)
-            zs = [
-                torch.max(z[:, :partition, ...], dim=2).values,
-                sgm(z[:, partition:, ...]),
-            ]
-        elif actfun == 'ail_part_full':
-            partition = math.floor(z.shape[1] / 4)
-            zs = [
-                logistic_or_approx(z[:, :partition, ...]),
-                logistic_and_approx(z[:, partition:2 * partition, ...]),
-                logistic_xnor_approx(z[:, 2 * partition: 3 * partition, ...]),
-            ]
-            bin_pass = z[:, 3 * partition:, ...]
-        elif actfun == 'nail_part_full':
-            partition = math.floor(z.shape[1] / 4)
-            zs = [
-                logistic_or_approx_normalized(z[:, :partition, ...]),
-                logistic_and_approx_normalized(z[:, partition:2 * partition, ...]),
-                logistic_xnor_approx_normalized(z[:, 2 * partition: 3 * partition, ...]),
-            ]
-            bin_pass = z[:, 3 * partition:, ...]
-        elif actfun == 'ail_part_or_and_xnor':
-            partition = math.floor(z.shape[1] / 3)
-            zs = [
-                logistic_or_approx(z[:, :partition, ...]),
-                logistic_and_approx(z[:, partition:2 * partition, ...]),
-                logistic_xnor_approx(z[:, 2 * partition:, ...]),
-            ]
-        elif actfun == 'nail_part_or_and_xnor':
-            partition = math.floor(z.shape[1] / 3)
-            zs = [
-                logistic_or_approx_normalized(z[:, :partition, ...]),
-                logistic_and_approx_normalized(z[:, partition:2 * partition, ...]),
-                logistic_xnor_approx_normalized(z[:, 2 * partition:, ...]),
-            ]
-        elif actfun == 'ail_part_or_xnor':
-            partition = math.floor(z.shape[1] / 2)
-            zs = [
-                logistic_or_approx(z[:, :partition, ...]),
-                logistic_xnor_approx(z[:, partition:, ...]),
-            ]
-        elif actfun == 'nail_part_or_xnor':
-            partition = math.floor(z.shape[1] / 2)
-            zs = [
-                logistic_or_approx_normalized(z[:, :partition, ...]),
-                logistic_xnor_approx_normalized(z[:, partition:, ...]),
-            ]
-    elif actfun in bin_all_actfuns:
-        if actfun == 'bin_all_max_sgm':
-            zs = [
-                torch.max(z, dim=2).values,
-                sgm(z),
-            ]
-        elif actfun == 'bin_all_max_min':
-            zs = [
-                torch.max(z, dim=2).values,
-                torch.min(z, dim=2).values,
-            ]
-        elif actfun == 'bin_all_max_min_sgm':
-            zs = [
-                torch.max(z, dim=2).values,
-                torch.min(z, dim=2).values,
-                sgm(z),
-            ]
-        elif actfun == 'bin_all_full':
-            zs = [
-                torch.max(z, dim=2).values,
-                torch.min(z, dim=2).values,
-                sgm(z),
-            ]
-            bin_pass = z
-        elif actfun == 'ail_all_or_xnor':
-            zs = [
-                logistic_or_approx(z),
-                logistic_xnor_approx(z),
-            ]
-        elif actfun == 'nail_all_or_xnor':
-            zs = [
-                logistic_or_approx_normalized(z),
-                logistic_xnor_approx_normalized(z),
-            ]
-        elif actfun == 'ail_all_or_and':
-            zs = [
-                logistic_or_approx(z),
-                logistic_and_approx(z),
-            ]
-        elif actfun == 'nail_all_or_and':
-            zs = [
-                logistic_or_approx_normalized(z),
-                logistic_and_approx_normalized(z),
-            ]
-        elif actfun == 'ail_all_or_and_xnor':
-            zs = [
-                logistic_or_approx(z),
-                logistic_and_approx(z),
-                logistic_xnor_approx(z),
-            ]
-        elif actfun == 'nail_all_or_and_xnor':
-            zs = [
-                logistic_or_approx_normalized(z),
-                logistic_and_approx_normalized(z),
-                logistic_xnor_approx_normalized(z),
-            ]
-        elif actfun == 'ail_all_full':
-            zs = [
-                logistic_or_approx(z),
-                logistic_and_approx(z),
-                logistic_xnor_approx(z),
-            ]
-            bin_pass = z
-        elif actfun == 'nail_all_full':
-            zs = [
-                logistic_or_approx_normalized(z),
-                logistic_and_approx_normalized(z),
-                logistic_xnor_approx_normalized(z),
-            ]
-            bin_pass = z
-
-    if bin_pass is not None:
-        if layer_type == 'conv':
-            bin_pass = bin_pass.reshape(bin_pass.shape[0], bin_pass.shape[1] * bin_pass.shape[2],
-                                        bin_pass.shape[3], bin_pass.shape[4])
-        elif layer_type == 'linear':
-            bin_pass = bin_pass.reshape(bin_pass.shape[0], bin_pass.shape[1] * bin_pass.shape[2])
-        zs.append(bin_pass)
-
-    return torch.cat(zs, dim=1)
+def select_max(z):
+    return select(z, 'max')
+
+
+def select_min(z):
+    return select(z, 'min')
+
+
+def _amax_out(z, out):
+    if z.shape[2] == 2:
+        torch.maximum(z[:, :, 0], z[:, :, 1], out=out)
+    else:
+        torch.amax(z, dim=2, out=out)
+
+
+def _amin_out(z, out):
+    if z.shape[2] == 2:
+        torch.minimum(z[:, :, 0], z[:, :, 1], out=out)
+    else:
+        torch.amin(z, dim=2, out=out)
+
+
+_BINARY_OPS = {
+    # actfun: (reductions, whether clusters are split into one partition per reduction, whether to pass
+    # clustered inputs through unchanged as an extra partition)
+    'bin_part_full': (['max', 'min', 'signed_geomean'], True, True),
+    'bin_part_max_min_sgm': (['max', 'min', 'signed_geomean'], True, False),
+    'bin_part_max_sgm': (['max', 'signed_geomean'], True, False),
+    'ail_part_full': (['ail_or', 'ail_and', 'ail_xnor'], True, True),
+    'ail_part_or_and_xnor': (['ail_or', 'ail_and', 'ail_xnor'], True, False),
+    'ail_part_or_xnor': (['ail_or', 'ail_xnor'], True, False),
+    'nail_part_full': (['nail_or', 'nail_and', 'nail_xnor'], True, True),
+    'nail_part_or_and_xnor': (['nail_or', 'nail_and', 'nail_xnor'], True, False),
+    'nail_part_or_xnor': (['nail_or', 'nail_xnor'], True, False),
+    'bin_all_full': (['max', 'min', 'signed_geomean'], False, True),
+    'bin_all_max_min': (['max', 'min'], False, False),
+    'bin_all_max_sgm': (['max', 'signed_geomean'], False, False),
+    'bin_all_max_min_sgm': (['max', 'min', 'signed_geomean'], False, False),
+    'ail_all_full': (['ail_or', 'ail_and', 'ail_xnor'], False, True),
+    'ail_all_or_and': (['ail_or', 'ail_and'], False, False),
+    'ail_all_or_xnor': (['ail_or', 'ail_xnor'], False, False),
+    'ail_all_or_and_xnor': (['ail_or', 'ail_and', 'ail_xnor'], False, False),
+    'nail_all_full': (['nail_or', 'nail_and', 'nail_xnor'], False, True),
+    'nail_all_or_and': (['nail_or', 'nail_and'], False, False),
+    'nail_all_or_xnor': (['nail_or', 'nail_xnor'], False, False),
+    'nail_all_or_and_xnor': (['nail_or', 'nail_and', 'nail_xnor'], False, False),
+}
+
+
+class BinaryOpsPlan(object):
+    """Dispatch plan for one binary_ops actfun, resolved once for a given number of clusters.
+
+    Holds each reduction's callable together with the clusters it reads and the channels of the output it
+    fills. Without autograd, every result is written straight into one preallocated output. With autograd,
+    the results are concatenated once instead, because in-place writes into a shared output would make each
+    partition's backward copy the whole output gradient.
+    """
+    def __init__(self, actfun, num_clusters, k):
+        self.actfun = actfun
+        self.num_clusters = num_clusters
+        self.k = k
+
+        reductions, partitioned, has_pass = _BINARY_OPS[actfun]
+        num_partitions = len(reductions) + int(has_pass)
+        partition = num_clusters // num_partitions if partitioned else 0
+
+        self.steps = []
+        out_start = 0
+        for i, reduction in enumerate(reductions):
+            if not partitioned:
+                start, end = 0, num_clusters
+            else:
+                start = i * partition
+                end = start + partition if has_pass or i < len(reductions) - 1 else num_clusters
+            fn, out_fn = _BINARY_OP_FNS[reduction]
+            self.steps.append((fn, out_fn, start, end, out_start, out_start + end - start))
+            out_start += end - start
+
+        self.pass_range = None
+        if has_pass:
+            pass_start = len(reductions) * partition
+            self.pass_range = (pass_start, num_clusters, out_start)
+            out_start += (num_clusters - pass_start) * k
+        self.num_outputs = out_start
+
+    def __call__(self, z):
+        if torch.is_grad_enabled() and z.requires_grad:
+            zs = [fn(z[:, start:end]) for fn, _, start, end, _, _ in self.steps]
+            if self.pass_range is not None:
+                zs.append(z[:, self.pass_range[0]:self.pass_range[1]].flatten(1, 2))
+            return torch.cat(zs, dim=1)
+
+        output = z.new_empty((z.shape[0], self.num_outputs) + z.shape[3:])
+        for fn, out_fn, start, end, out_start, out_end in self.steps:
+            if out_fn is not None:
+                out_fn(z[:, start:end], output[:, out_start:out_end])
+            else:
+                output[:, out_start:out_end] = fn(z[:, start:end])
+        if self.pass_range is not None:
+            pass_start, pass_end, out_start = self.pass_range
+            output[:, out_start:] = z[:, pass_start:pass_end].flatten(1, 2)
+        return output
+
+    def __reduce__(self):
+        return BinaryOpsPlan, (self.actfun, self.num_clusters, self.k)
+
+
+@functools.lru_cache(maxsize=None)
+def get_binary_ops_plan(actfun, num_clusters, k):
+    return BinaryOpsPlan(actfun, num_clusters, k)
 
 
 sgm = SignedGeomean.apply
@@ -530,9 +1065,11 @@ _ACTFUNS = {
     'prod':
         lambda z: torch.prod(z, dim=2),
     'max':
-        lambda z: torch.max(z, dim=2).values,
+        cluster_max,
     'min':
-        lambda z: torch.min(z, dim=2).values,
+        cluster_min,
+    'median':
+        cluster_median,
     'signed_geomean':
         sgm,
     'swishk':
@@ -542,7 +1079,7 @@ _ACTFUNS = {
     'l1':
         lambda z: (torch.sum(z.abs(), dim=2)),
     'l2':
-        lambda z: (torch.sum(z.pow(2), dim=2)).sqrt_(),
+        l2_norm,
     'l3-signed':
         signed_l3,
     'linf':
@@ -550,11 +1087,11 @@ _ACTFUNS = {
     'lse':
         lambda z: torch.logsumexp(z, dim=2),
     'lae':
-        lambda z: logavgexp(z, dim=2),
+        lambda z: logavgexp(z, dim=2, dtype=None),
     'nlsen':
         lambda z: -1 * torch.logsumexp(-1 * z, dim=2),
     'nlaen':
-        lambda z: -1 * logavgexp(-1 * z, dim=2),
+        lambda z: -1 * logavgexp(-1 * z, dim=2, dtype=None),
     'lse-approx':
         lambda z: torch.max(z[:, :, 0], z[:, :, 1]) + torch.max(torch.tensor(0., device=z.device),
                                                                 _ln2 - 0.305 * (z[:, :, 0] - z[:, :, 1]).abs_()),
@@ -570,3 +1107,105 @@ _ACTFUNS = {
     'multi_relu':
         multi_relu,
 }
+
+
+_BINARY_OP_FNS = {
+    # reduction: (callable, optional writer into a preallocated output used when no backward will follow)
+    'max': (select_max, _amax_out),
+    'min': (select_min, _amin_out),
+    'signed_geomean': (sgm, None),
+    'ail_or': (logistic_or_approx, None),
+    'ail_and': (logistic_and_approx, None),
+    'ail_xnor': (logistic_xnor_approx, None),
+    'nail_or': (logistic_or_approx_normalized, None),
+    'nail_and': (logistic_and_approx_normalized, None),
+    'nail_xnor': (logistic_xnor_approx_normalized, None),
+}
+
+# Lowest precision each actfun can be evaluated in under mixed precision. 'fp16' actfuns are safe in float16 and
+# bfloat16, 'bf16' actfuns need bfloat16's exponent range (float16 inputs are upcast to float32), and 'fp32'
+# actfuns always run in float32. Binary ops take the strictest precision of their reductions.
+_PRECISION_LEVELS = ['fp16', 'bf16', 'fp32']
+_PRECISION = {
+    'ail_and': 'fp16',
+    'ail_or': 'fp16',
+    'ail_xnor': 'fp16',
+    'nail_and': 'fp16',
+    'nail_or': 'fp16',
+    'nail_xnor': 'fp16',
+    'combinact': 'fp16',
+    'relu': 'fp16',
+    'tanh': 'fp16',
+    'leaky_relu': 'fp16',
+    'abs': 'fp16',
+    'swish': 'fp16',
+    'prod': 'bf16',
+    'max': 'fp16',
+    'min': 'fp16',
+    'median': 'fp16',
+    'signed_geomean': 'fp16',
+    'swishk': 'fp16',
+    'swishy': 'fp16',
+    'l1': 'fp16',
+    'l2': 'fp16',
+    'l3-signed': 'bf16',
+    'linf': 'fp16',
+    'lse': 'fp16',
+    'lae': 'fp16',
+    'nlsen': 'fp16',
+    'nlaen': 'fp16',
+    'lse-approx': 'fp16',
+    'lae-approx': 'fp16',
+    'nlsen-approx': 'fp16',
+    'nlaen-approx': 'fp16',
+    'multi_relu': 'fp16',
+    'groupsort': 'fp16',
+    'cf_relu': 'fp16',
+    'cf_abs': 'fp16',
+}
+
+
+def get_actfun_precision(actfun):
+    """Returns 'fp16', 'bf16' or 'fp32', the lowest precision actfun is safe to evaluate in. Unknown actfuns are
+    treated as 'fp32'."""
+    if actfun in _BINARY_OPS:
+        return max((_PRECISION.get(reduction, 'fp32') for reduction in _BINARY_OPS[actfun][0]),
+                   key=_PRECISION_LEVELS.index)
+    return _PRECISION.get(actfun, 'fp32')
+
+
+def get_compute_dtype(actfun, dtype):
+    """Returns the dtype actfun should be evaluated in for inputs of the given dtype. Full precision inputs are
+    left as they are, reduced precision inputs are upcast to float32 when actfun is not safe in them."""
+    if dtype not in (torch.float16, torch.bfloat16):
+        return dtype
+    precision = get_actfun_precision(actfun)
+    if precision == 'fp16' or (precision == 'bf16' and dtype == torch.bfloat16):
+        return dtype
+    return torch.float32
+
+
+_COMBINACT_TERMS = {
+    'max':
+        lambda z, s: s['max'],
+    'min':
+        lambda z, s: s['min'],
+    'l1':
+        lambda z, s: torch.sum(s['abs'], dim=2),
+    'linf':
+        lambda z, s: torch.max(s['abs'], dim=2).values,
+    'l2':
+        lambda z, s: _ACTFUNS['l2'](z),
+    'lse':
+        lambda z, s: s['lse'],
+    'lae':
+        lambda z, s: s['lse'] - math.log(z.shape[2]),
+    'nlsen':
+        lambda z, s: s['nlsen'],
+    'nlaen':
+        lambda z, s: s['nlsen'] + math.log(z.shape[2]),
+    'swishk':
+        lambda z, s: _ACTFUNS['swishk'](z),
+    'signed_geomean':
+        lambda z, s: sgm(z),
+}
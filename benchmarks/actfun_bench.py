@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+""" Higher-Order Activation Micro-Benchmark
+
+Sweeps actfuns over p, k, permute type and realistic EfficientNet / MLP activation shapes, timing the training
+forward, backward and inference forward passes and recording how much memory each configuration allocates, holds
+at its peak and saves for backward. Results are written to a CSV so runs can be compared across commits:
+
+    python benchmarks/actfun_bench.py --output before.csv
+    python benchmarks/actfun_bench.py --output after.csv --baseline before.csv --threshold 0.1
+
+With --baseline, any timing or memory figure that grows by more than --threshold (relative) is reported and the
+script exits with status 1.
+"""
+import argparse
+import csv
+import os
+import statistics
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import activation_functions as actfuns  # noqa: E402
+
+# Activation shapes (without batch) of EfficientNet-B0 blocks and of MLP hidden layers
+_SHAPES = {
+    'b0_stem': (32, 112, 112),
+    'b0_s2': (96, 56, 56),
+    'b0_s3': (144, 28, 28),
+    'b0_s4': (240, 14, 14),
+    'b0_s6': (672, 7, 7),
+    'b0_head': (1280, 7, 7),
+    'mlp_l1': (1024,),
+    'mlp_l2': (512,),
+}
+
+_ALL_ACTFUNS = sorted(set(actfuns._ACTFUNS) | set(actfuns._BINARY_OPS) | {'groupsort', 'cf_relu', 'cf_abs'})
+
+_FIELDS = ['actfun', 'layer_type', 'permute_type', 'p', 'k', 'shape', 'batch_size',
+           'fwd_ms', 'bwd_ms', 'infer_ms', 'peak_mb', 'alloc_mb', 'saved_mb', 'status']
+_KEY_FIELDS = ['actfun', 'layer_type', 'permute_type', 'p', 'k', 'shape', 'batch_size']
+_COMPARED_FIELDS = ['fwd_ms', 'bwd_ms', 'infer_ms', 'peak_mb', 'alloc_mb', 'saved_mb']
+
+parser = argparse.ArgumentParser(description='Higher-order activation micro-benchmark')
+parser.add_argument('--actfuns', nargs='+', default=_ALL_ACTFUNS, metavar='NAME',
+                    help='actfuns to benchmark (default: all)')
+parser.add_argument('--p', nargs='+', type=int, default=[1, 2], help='numbers of permutations')
+parser.add_argument('--k', nargs='+', type=int, default=[2], help='cluster sizes')
+parser.add_argument('--permute-types', nargs='+', default=['shuffle'], choices=['shuffle', 'invert'],
+                    help='permutation types (invert is only run where k divides p)')
+parser.add_argument('--shapes', nargs='+', default=['b0_s2', 'b0_s4', 'b0_s6', 'mlp_l1'], choices=sorted(_SHAPES),
+                    help='activation shapes, conv shapes are CxHxW and linear shapes are C')
+parser.add_argument('-b', '--batch-size', type=int, default=8, metavar='N', help='batch size')
+parser.add_argument('--reps', type=int, default=10, metavar='N', help='timed repetitions, the median is reported')
+parser.add_argument('--warmup', type=int, default=2, metavar='N', help='untimed warmup repetitions')
+parser.add_argument('--device', default='cpu', type=str, help='device to benchmark on')
+parser.add_argument('--threads', type=int, default=0, metavar='N', help='torch threads (default: torch default)')
+parser.add_argument('--output', default='./actfun_bench.csv', type=str, metavar='PATH', help='output CSV')
+parser.add_argument('--baseline', default='', type=str, metavar='PATH',
+                    help='CSV of an earlier run to check for regressions against')
+parser.add_argument('--threshold', type=float, default=0.1,
+                    help='relative increase over the baseline that counts as a regression')
+parser.add_argument('--min-ms', type=float, default=0.05,
+                    help='timings below this in both runs are never reported as regressions')
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _median_ms(fn, device, reps, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(reps):
+        _sync(device)
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+class _Activation(object):
+    """Binds an actfun configuration the way HigherOrderActivation / MLP call activate()."""
+
+    def __init__(self, actfun, p, k, permute_type, num_channels, layer_type, device):
+        self.actfun, self.p, self.k = actfun, p, k
+        self.permute_type, self.layer_type = permute_type, layer_type
+        self.shuffle_maps = torch.stack([torch.randperm(num_channels) for _ in range(p)]).to(device)
+        self.permute_index = actfuns.get_permutation_index(
+            num_channels, p, k, permute_type, self.shuffle_maps).to(device)
+        num_clusters = num_channels * p // k
+        self.binary_ops_plan = None
+        if actfun in actfuns._BINARY_OPS:
+            self.binary_ops_plan = actfuns.get_binary_ops_plan(actfun, num_clusters, k)
+        self.alpha_primes = None
+        if actfun == 'combinact':
+            self.alpha_primes = torch.zeros(num_clusters, len(actfuns.get_combinact_actfuns()),
+                                            device=device, requires_grad=True)
+
+    def __call__(self, x):
+        return actfuns.activate(x, self.actfun, p=self.p, k=self.k, M=x.shape[1],
+                                layer_type=self.layer_type,
+                                permute_type=self.permute_type,
+                                shuffle_maps=self.shuffle_maps,
+                                permute_index=self.permute_index,
+                                binary_ops_plan=self.binary_ops_plan,
+                                alpha_primes=self.alpha_primes,
+                                alpha_dist='per_cluster')
+
+
+def _saved_bytes(act, x):
+    if not hasattr(torch.autograd, 'graph'):
+        # saved tensor hooks need torch >= 1.10
+        return float('nan')
+    saved = {}
+
+    def pack(t):
+        saved[(t.data_ptr(), t.dtype, tuple(t.shape))] = t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        act(x)
+    return sum(saved.values())
+
+
+def _cpu_memory(act, x, grad_output):
+    """Bytes allocated and the peak of live allocations over a forward and backward pass, from the profiler."""
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        act(x).backward(grad_output)
+    events = sorted(prof.function_events, key=lambda e: e.time_range.start)
+    live = peak = allocated = 0
+    for event in events:
+        usage = event.self_cpu_memory_usage
+        allocated += max(usage, 0)
+        live += usage
+        peak = max(peak, live)
+    return peak, allocated
+
+
+def _cuda_memory(act, x, grad_output, device):
+    torch.cuda.synchronize(device)
+    base = torch.cuda.memory_allocated(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    stats = torch.cuda.memory_stats(device)
+    allocated = stats.get('allocated_bytes.all.allocated', 0)
+    act(x).backward(grad_output)
+    torch.cuda.synchronize(device)
+    allocated = torch.cuda.memory_stats(device).get('allocated_bytes.all.allocated', 0) - allocated
+    return torch.cuda.max_memory_allocated(device) - base, allocated
+
+
+def bench_config(actfun, p, k, permute_type, shape_name, args, device):
+    shape = _SHAPES[shape_name]
+    layer_type = 'conv' if len(shape) == 3 else 'linear'
+    row = dict(actfun=actfun, layer_type=layer_type, permute_type=permute_type, p=p, k=k, shape=shape_name,
+               batch_size=args.batch_size, status='ok')
+    try:
+        act = _Activation(actfun, p, k, permute_type, shape[0], layer_type, device)
+        x = torch.randn((args.batch_size,) + shape, device=device)
+        x_grad = x.clone().requires_grad_()
+        grad_output = torch.randn_like(act(x_grad))
+
+        def train_forward():
+            return act(x_grad)
+
+        def train_step():
+            act(x_grad).backward(grad_output)
+
+        def infer():
+            with torch.no_grad():
+                act(x)
+
+        fwd_ms = _median_ms(train_forward, device, args.reps, args.warmup)
+        step_ms = _median_ms(train_step, device, args.reps, args.warmup)
+        row['fwd_ms'] = fwd_ms
+        row['bwd_ms'] = max(step_ms - fwd_ms, 0.)
+        row['infer_ms'] = _median_ms(infer, device, args.reps, args.warmup)
+        if device.type == 'cuda':
+            peak, allocated = _cuda_memory(act, x_grad, grad_output, device)
+        else:
+            peak, allocated = _cpu_memory(act, x_grad, grad_output)
+        row['peak_mb'] = peak / 2 ** 20
+        row['alloc_mb'] = allocated / 2 ** 20
+        row['saved_mb'] = _saved_bytes(act, x_grad) / 2 ** 20
+    except Exception as e:
+        row['status'] = '{}: {}'.format(type(e).__name__, str(e).splitlines()[0][:120] if str(e) else '')
+    return row
+
+
+def _row_key(row):
+    return tuple(str(row[f]) for f in _KEY_FIELDS)
+
+
+def find_regressions(rows, baseline_rows, threshold, min_ms):
+    baseline = {_row_key(row): row for row in baseline_rows if row['status'] == 'ok'}
+    regressions = []
+    for row in rows:
+        base = baseline.get(_row_key(row))
+        if base is None or row['status'] != 'ok':
+            continue
+        for field in _COMPARED_FIELDS:
+            old, new = float(base[field]), float(row[field])
+            if field.endswith('_ms') and max(old, new) < min_ms:
+                continue
+            if new > old * (1 + threshold) and new - old > 1e-6:
+                regressions.append((row, field, old, new))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    unknown = [a for a in args.actfuns if a not in _ALL_ACTFUNS and a != 'combinact']
+    if unknown:
+        print('Error: unknown actfuns {}'.format(unknown))
+        exit(1)
+
+    rows = []
+    for shape_name in args.shapes:
+        for actfun in args.actfuns:
+            for permute_type in args.permute_types:
+                for p in args.p:
+                    for k in args.k:
+                        if permute_type == 'invert' and p % k != 0:
+                            continue
+                        torch.manual_seed(0)
+                        row = bench_config(actfun, p, k, permute_type, shape_name, args, device)
+                        rows.append(row)
+                        if row['status'] == 'ok':
+                            print('{actfun:>22} {layer_type:>6} {permute_type:>7} p={p} k={k} {shape:>8} '
+                                  'fwd {fwd_ms:8.3f}ms  bwd {bwd_ms:8.3f}ms  infer {infer_ms:8.3f}ms  '
+                                  'peak {peak_mb:8.2f}MB  saved {saved_mb:8.2f}MB'.format(**row))
+                        else:
+                            print('{actfun:>22} {layer_type:>6} {permute_type:>7} p={p} k={k} {shape:>8} '
+                                  'skipped ({status})'.format(**row))
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({field: ('{:.4f}'.format(v) if isinstance(v, float) else v)
+                             for field, v in row.items()})
+    print('=> Results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline, newline='') as f:
+            baseline_rows = list(csv.DictReader(f))
+        regressions = find_regressions(rows, baseline_rows, args.threshold, args.min_ms)
+        for row, field, old, new in regressions:
+            print('REGRESSION {} {} {} p={} k={} {}: {} {:.4f} -> {:.4f} (+{:.1%})'.format(
+                row['actfun'], row['layer_type'], row['permute_type'], row['p'], row['k'], row['shape'],
+                field, old, new, new / old - 1 if old else float('inf')))
+        if regressions:
+            exit(1)
+        print('=> No regressions over {:.0%} against {}'.format(args.threshold, args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+""" Activation Checkpointing Benchmark
+
+Trains a few steps of an EfficientNet with higher-order activations under each grad checkpointing mode ('' = off,
+'act' = every higher-order activation, 'block' = every IR/DS/ER block) and reports the median training step time
+and the peak memory of a step, so the memory saved can be weighed against the recompute cost:
+
+    python benchmarks/checkpoint_bench.py --actfun max --p 4 --k 2 -b 32 --device cuda
+    python benchmarks/checkpoint_bench.py --actfun l2 --p 1 2 4 --output checkpoint_bench.csv
+
+Peak memory is measured with the CUDA allocator stats on GPU and with the autograd profiler on CPU.
+"""
+import argparse
+import csv
+import os
+import statistics
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from timm import create_model  # noqa: E402
+
+_FIELDS = ['model', 'actfun', 'p', 'k', 'batch_size', 'img_size', 'mode', 'step_ms', 'peak_mb', 'status']
+
+parser = argparse.ArgumentParser(description='Activation checkpointing benchmark')
+parser.add_argument('--model', default='efficientnet_b0', type=str, metavar='MODEL', help='model to benchmark')
+parser.add_argument('--actfun', default='max', type=str, help='higher-order actfun')
+parser.add_argument('--p', nargs='+', type=int, default=[1, 2, 4], help='numbers of permutations')
+parser.add_argument('--k', type=int, default=2, help='cluster size')
+parser.add_argument('--modes', nargs='+', default=['', 'act', 'block'], choices=['', 'act', 'block'],
+                    help='grad checkpointing modes')
+parser.add_argument('-b', '--batch-size', type=int, default=16, metavar='N', help='batch size')
+parser.add_argument('--img-size', type=int, default=224, metavar='N', help='input image size')
+parser.add_argument('--reps', type=int, default=5, metavar='N', help='timed steps, the median is reported')
+parser.add_argument('--warmup', type=int, default=1, metavar='N', help='untimed warmup steps')
+parser.add_argument('--device', default='cpu', type=str, help='device to benchmark on')
+parser.add_argument('--output', default='./checkpoint_bench.csv', type=str, metavar='PATH', help='output CSV')
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _peak_bytes(step, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        step()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        step()
+    live = peak = 0
+    for event in sorted(prof.function_events, key=lambda e: e.time_range.start):
+        live += event.self_cpu_memory_usage
+        peak = max(peak, live)
+    return peak
+
+
+def bench_config(p, mode, args, device):
+    row = dict(model=args.model, actfun=args.actfun, p=p, k=args.k, batch_size=args.batch_size,
+               img_size=args.img_size, mode=mode or 'none', status='ok')
+    try:
+        torch.manual_seed(0)
+        model = create_model(args.model, actfun=args.actfun, p=p, k=args.k, g=1, grad_checkpointing=mode)
+        model.to(device).train()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+        x = torch.randn(args.batch_size, 3, args.img_size, args.img_size, device=device)
+        target = torch.randint(model.num_classes, (args.batch_size,), device=device)
+
+        def step():
+            optimizer.zero_grad()
+            F.cross_entropy(model(x), target).backward()
+            optimizer.step()
+
+        for _ in range(args.warmup):
+            step()
+        times = []
+        for _ in range(args.reps):
+            _sync(device)
+            start = time.perf_counter()
+            step()
+            _sync(device)
+            times.append((time.perf_counter() - start) * 1000)
+        row['step_ms'] = statistics.median(times)
+        row['peak_mb'] = _peak_bytes(step, device) / 2 ** 20
+    except Exception as e:
+        row['status'] = '{}: {}'.format(type(e).__name__, str(e).splitlines()[0][:120] if str(e) else '')
+    return row
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    rows = []
+    for p in args.p:
+        baseline = None
+        for mode in args.modes:
+            row = bench_config(p, mode, args, device)
+            rows.append(row)
+            if row['status'] != 'ok':
+                print('{actfun} p={p} k={k} {mode:>5}: skipped ({status})'.format(**row))
+                continue
+            baseline = baseline or row
+            print('{actfun} p={p} k={k} {mode:>5}: step {step_ms:9.1f}ms ({time:+6.1%})  '
+                  'peak {peak_mb:9.1f}MB ({mem:+6.1%})'.format(
+                    time=row['step_ms'] / baseline['step_ms'] - 1,
+                    mem=row['peak_mb'] / baseline['peak_mb'] - 1 if baseline['peak_mb'] else 0., **row))
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({field: ('{:.4f}'.format(v) if isinstance(v, float) else v)
+                             for field, v in row.items()})
+    print('=> Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
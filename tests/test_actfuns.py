@@ -0,0 +1,306 @@
+import itertools
+
+import pytest
+import torch
+
+import activation_functions as actfuns
+
+
+def _clusters(k, shape=(4, 6), dtype=torch.float32):
+    torch.manual_seed(0)
+    return torch.randn(shape[0], shape[1], k, 5, 5, dtype=dtype)
+
+
+@pytest.mark.parametrize('k', sorted(actfuns._SORTING_NETWORKS))
+def test_sorting_networks_sort_all_binary_inputs(k):
+    # 0-1 principle: a comparator network sorts every input iff it sorts every 0/1 input
+    z = torch.tensor(list(itertools.product([0., 1.], repeat=k))).reshape(-1, 1, k)
+    expected = z.sort(dim=2, descending=True).values
+    assert torch.equal(actfuns.sort_clusters(z), expected)
+
+
+@pytest.mark.parametrize('k', [2, 3, 4, 5, 6, 8])
+def test_sort_clusters_matches_sort(k):
+    z = _clusters(k)
+    assert torch.equal(actfuns.sort_clusters(z), z.sort(dim=2, descending=True).values)
+
+
+@pytest.mark.parametrize('k', [2, 3, 4, 5, 6, 8])
+def test_cluster_reductions_match_torch(k):
+    z = _clusters(k)
+    assert torch.equal(actfuns.cluster_max(z), torch.max(z, dim=2).values)
+    assert torch.equal(actfuns.cluster_min(z), torch.min(z, dim=2).values)
+    assert torch.equal(actfuns.cluster_median(z), torch.median(z, dim=2).values)
+
+
+@pytest.mark.parametrize('k', [2, 3, 4, 5, 6, 8])
+@pytest.mark.parametrize('p', [1, 2])
+@pytest.mark.parametrize('actfun', ['groupsort', 'max', 'min'])
+def test_activate_grad_matches_sort(actfun, p, k):
+    torch.manual_seed(0)
+    x = torch.randn(4, 120, 5, 5)
+    shuffle_maps = torch.stack([torch.randperm(120) for _ in range(p)])
+    grad_output = None
+
+    def _reference(x):
+        z = actfuns.cluster(x, actfuns.get_permutation_index(120, p, k, shuffle_maps=shuffle_maps), k)
+        if actfun == 'groupsort':
+            return z.sort(dim=2, descending=True).values.reshape(z.shape[0], -1, *z.shape[3:])
+        return getattr(torch, actfun)(z, dim=2).values
+
+    outputs, grads = [], []
+    for fn in [_reference, lambda x: actfuns.activate(x, actfun, p=p, k=k, shuffle_maps=shuffle_maps)]:
+        x_ = x.clone().requires_grad_()
+        out = fn(x_)
+        if grad_output is None:
+            grad_output = torch.randn(out.shape, generator=torch.Generator().manual_seed(1))
+        out.backward(grad_output)
+        outputs.append(out.detach())
+        grads.append(x_.grad)
+    assert torch.equal(outputs[0], outputs[1])
+    assert torch.allclose(grads[0], grads[1])
+
+
+@pytest.mark.parametrize('k', [2, 3, 4])
+def test_signed_geomean_grad(k):
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, k, 4, dtype=torch.float64)
+    x[0, 0, 0, 0] = 0
+    x.requires_grad_()
+    prod = x.prod(dim=2)
+    assert torch.allclose(actfuns.SignedGeomean.apply(x), prod.sign() * prod.abs().sqrt())
+    assert torch.autograd.gradcheck(actfuns.SignedGeomean.apply, (x[1:].detach().requires_grad_(),))
+
+
+def test_signed_geomean_half_range():
+    # |prod| overflows / underflows fp16 while the geomean itself is representable
+    x = torch.tensor([[300., 400.], [1e-4, 2e-4], [-300., 400.]], dtype=torch.float16).reshape(3, 1, 2)
+    expected = torch.tensor([[346.4], [1.414e-4], [-346.4]])
+    assert torch.allclose(actfuns.SignedGeomean.apply(x).float(), expected, rtol=1e-3)
+
+
+_PRECISION_ACTFUNS = [a for a in actfuns._PRECISION if a != 'combinact'] + list(actfuns._BINARY_OPS)
+
+
+@pytest.mark.parametrize('alpha_dist', ['per_cluster', 'per_perm'])
+def test_combinact_weighted_sum(alpha_dist):
+    z = _clusters(2)
+    names = actfuns.get_combinact_actfuns(False)
+    torch.manual_seed(1)
+    alpha_primes = torch.randn(2 if alpha_dist == 'per_perm' else z.shape[1], len(names))
+    out = actfuns.combinact(z, 2, layer_type='conv', alpha_primes=alpha_primes, alpha_dist=alpha_dist)
+
+    expected = 0
+    alphas = torch.softmax(alpha_primes, dim=1).repeat(z.shape[1] // len(alpha_primes), 1)
+    for i, name in enumerate(names):
+        output = actfuns.combinact(z, 2, layer_type='conv', alpha_primes=torch.zeros(z.shape[1], 1),
+                                   alpha_dist='per_cluster', combinact_actfuns=[name])
+        expected += output * alphas[:, i].reshape(1, -1, 1, 1)
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('scale', [1, 300])
+@pytest.mark.parametrize('dtype', [torch.float16, torch.bfloat16])
+@pytest.mark.parametrize('actfun', _PRECISION_ACTFUNS)
+def test_reduced_precision_matches_fp32(actfun, dtype, scale):
+    k = 2 if actfun in ('l3-signed', 'swishy') or actfun.endswith('-approx') else 4
+    hoa = actfuns.HigherOrderActivation()
+    hoa.actfun, hoa.p, hoa.k, hoa.g = actfun, 2, k, 1
+    torch.manual_seed(0)
+    hoa.init_shuffle_maps(24)
+    x = (torch.randn(4, 24, 5, 5) * scale).to(dtype)
+
+    torch.manual_seed(1)
+    expected = hoa(x.float())
+    torch.manual_seed(1)
+    out = hoa(x)
+    assert out.dtype == dtype
+    # compare wherever the fp32 result is representable in the reduced precision dtype
+    valid = expected.abs() < torch.finfo(dtype).max / 2
+    err = (out.float() - expected).abs() / (expected.abs() + scale)
+    assert torch.isfinite(out[valid]).all()
+    assert err[valid].max() <= 4 * torch.finfo(dtype).eps
+
+
+def test_compute_dtype():
+    assert actfuns.get_compute_dtype('max', torch.float16) == torch.float16
+    assert actfuns.get_compute_dtype('prod', torch.float16) == torch.float32
+    assert actfuns.get_compute_dtype('prod', torch.bfloat16) == torch.bfloat16
+    assert actfuns.get_compute_dtype('prod', torch.float32) == torch.float32
+    assert actfuns.get_actfun_precision('bin_all_max_sgm') == 'fp16'
+    assert actfuns.get_actfun_precision('unknown') == 'fp32'
+
+
+@pytest.mark.parametrize('p', [1, 2])
+@pytest.mark.parametrize('actfun', ['max', 'l2', 'groupsort', 'bin_all_max_min', 'bin_part_full'])
+def test_channels_last_matches_contiguous(actfun, p):
+    torch.manual_seed(0)
+    x = torch.randn(2, 12, 5, 5)
+    shuffle_maps = torch.stack([torch.randperm(12) for _ in range(p)])
+    outputs, grads = [], []
+    for memory_format in [torch.contiguous_format, torch.channels_last]:
+        x_ = x.contiguous(memory_format=memory_format).detach().requires_grad_()
+        out = actfuns.activate(x_, actfun, p=p, k=2, shuffle_maps=shuffle_maps)
+        out.backward(torch.arange(out.numel(), dtype=out.dtype).reshape(out.shape))
+        outputs.append(out)
+        grads.append(x_.grad)
+    assert outputs[1].is_contiguous(memory_format=torch.channels_last)
+    assert torch.equal(outputs[0], outputs[1])
+    assert torch.allclose(grads[0], grads[1])
+
+
+@pytest.mark.parametrize('actfun', ['cf_relu', 'cf_abs'])
+def test_coin_flip(actfun):
+    z = _clusters(3)
+    elementwise = torch.relu if actfun == 'cf_relu' else torch.abs
+    try:
+        actfuns.set_coin_flip_generator(torch.Generator().manual_seed(0))
+        out = actfuns.coin_flip(z.clone(), actfun)
+        actfuns.set_coin_flip_generator(torch.Generator().manual_seed(0))
+        assert torch.equal(actfuns.coin_flip(z.clone(), actfun), out)
+    finally:
+        actfuns.set_coin_flip_generator(None)
+    # every cluster picks one of its elements, the same one for all samples and positions
+    match = elementwise(z) == out.unsqueeze(2)
+    assert match.all(dim=0).all(dim=-1).all(dim=-1).any(dim=-1).all()
+    assert torch.equal(actfuns.coin_flip(z, actfun, deterministic=True), elementwise(z).mean(dim=2))
+
+
+@pytest.mark.parametrize('actfun', ['max', 'min', 'linf', 'median', 'groupsort'])
+@pytest.mark.parametrize('p', [1, 2])
+def test_quantized_selection_matches_float(actfun, p):
+    hoa = actfuns.HigherOrderActivation(actfun=actfun, p=p, k=3 if actfun == 'median' else 2, g=1)
+    torch.manual_seed(0)
+    hoa.init_shuffle_maps(12)
+    x = torch.quantize_per_tensor(torch.randn(2, 12, 5, 5), scale=0.05, zero_point=100, dtype=torch.quint8)
+    out = hoa(x)
+    assert out.is_quantized
+    assert torch.equal(out.dequantize(), hoa(x.dequantize()))
+
+
+_SCRIPTABLE_ACTFUNS = [
+    'max', 'min', 'median', 'prod', 'l1', 'l2', 'l3-signed', 'linf', 'lse', 'lae', 'nlsen', 'nlaen', 'swishk',
+    'swishy', 'signed_geomean', 'lse-approx', 'lae-approx', 'nlsen-approx', 'nlaen-approx', 'groupsort']
+
+
+@pytest.mark.parametrize('shape', [(2, 12, 5, 5), (4, 12)])
+@pytest.mark.parametrize('p', [1, 2])
+@pytest.mark.parametrize('actfun', _SCRIPTABLE_ACTFUNS)
+def test_scripted_matches_eager(actfun, p, shape):
+    hoa = actfuns.HigherOrderActivation(actfun=actfun, p=p, k=2, g=1)
+    torch.manual_seed(0)
+    hoa.init_shuffle_maps(12)
+    scripted = torch.jit.script(hoa)
+    x = torch.randn(shape)
+    with torch.no_grad():
+        expected = hoa(x)
+        assert torch.equal(scripted(x), expected)
+
+
+def _randomize_norms(model):
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, (torch.nn.BatchNorm1d, torch.nn.BatchNorm2d)):
+                module.running_mean.normal_(0, 0.1)
+                module.running_var.uniform_(0.5, 2)
+                module.weight.normal_(1, 0.1)
+                module.bias.normal_(0, 0.1)
+
+
+@pytest.mark.parametrize('actfun,p,g,permute_type', [
+    ('max', 2, 1, 'shuffle'), ('l2', 3, 1, 'shuffle'), ('bin_all_max_min', 2, 1, 'shuffle'),
+    ('groupsort', 4, 1, 'invert'), ('combinact', 2, 1, 'shuffle'), ('max', 2, 2, 'shuffle')])
+def test_mlp_fold_permutations(actfun, p, g, permute_type):
+    import MLP
+    torch.manual_seed(0)
+    model = MLP.MLP(actfun, p=p, k=2, g=g, permute_type=permute_type, num_params=50000)
+    _randomize_norms(model)
+    with torch.no_grad():
+        for alpha_primes in model.all_alpha_primes:
+            alpha_primes.normal_()
+    model.eval()
+    x = torch.randn(16, 784)
+    with torch.no_grad():
+        expected = model(x)
+        folded = model.fold_permutations()
+        out = model(x)
+    assert folded == ([0] if g > 1 else [0, 1])
+    assert torch.allclose(out, expected, atol=1e-5)
+
+    # folded state dicts load into (and fold) a freshly built model
+    restored = MLP.MLP(actfun, p=p, k=2, g=g, permute_type=permute_type, num_params=50000)
+    restored.load_state_dict(model.state_dict())
+    assert restored.layer_ps == model.layer_ps
+    restored.eval()
+    with torch.no_grad():
+        assert torch.allclose(restored(x), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('alpha_dist', ['per_cluster', 'per_perm'])
+def test_mlp_collapse_combinact_reloads(alpha_dist):
+    import MLP
+    torch.manual_seed(0)
+    model = MLP.MLP('combinact', p=2, k=2, alpha_dist=alpha_dist, num_params=50000)
+    _randomize_norms(model)
+    with torch.no_grad():
+        model.all_alpha_primes[0][:, :2] = 10
+        model.all_alpha_primes[1][:, 0] = 20
+    report = model.collapse_combinact(threshold=0.05)
+    assert model.combinact_actfuns[0] == actfuns.get_combinact_actfuns()[:2]
+    assert model.layer_actfuns[1] == report[1]['actfun'] != 'combinact'
+
+    restored = MLP.MLP('combinact', p=2, k=2, alpha_dist=alpha_dist, num_params=50000)
+    restored.load_state_dict(model.state_dict())
+    assert restored.combinact_actfuns == model.combinact_actfuns
+    assert restored.layer_actfuns == model.layer_actfuns
+    model.eval()
+    restored.eval()
+    x = torch.randn(16, 784)
+    with torch.no_grad():
+        assert torch.equal(restored(x), model(x))
+
+
+def test_mlp_cost_after_fold_permutations():
+    import MLP
+    import util
+    torch.manual_seed(0)
+    model = MLP.MLP('max', p=2, k=2, g=1, num_params=50000)
+    before = util.get_model_cost(model, (16, 784))
+    model.fold_permutations()
+    after = util.get_model_cost(model, (16, 784))
+    for layer, layer_before, layer_after in zip(range(2), before['layers'][1::2], after['layers'][1::2]):
+        assert layer_before['name'] == layer_after['name'] == 'activate.{}'.format(layer)
+        expected = actfuns.get_actfun_cost('max', 1, 2, 1, layer_after['input_shape'])
+        assert layer_after['forward'] == expected['forward']
+        assert layer_after['forward']['flops'] < layer_before['forward']['flops']
+
+
+def _pre_series_state_dict(model):
+    # MLP checkpoints from before the permutations were buffers and the second layer a GroupedLinear
+    state_dict = {name: value.clone() for name, value in model.state_dict().items()
+                  if not name.startswith(('shuffle_maps_', 'permute_index_', 'folded', 'combinact_mask'))}
+    weight, bias = state_dict.pop('linear_layers.l2.weight'), state_dict.pop('linear_layers.l2.bias')
+    for group, group_bias in enumerate(bias.chunk(len(weight))):
+        state_dict['linear_layers.l2.{}.weight'.format(group)] = weight[group].t().contiguous()
+        state_dict['linear_layers.l2.{}.bias'.format(group)] = group_bias
+    return state_dict
+
+
+@pytest.mark.parametrize('g', [1, 2])
+def test_mlp_loads_pre_series_state_dict(g):
+    import MLP
+    torch.manual_seed(0)
+    model = MLP.MLP('max', p=2, k=2, g=g, num_params=50000)
+    state_dict = _pre_series_state_dict(model)
+
+    restored = MLP.MLP('max', p=2, k=2, g=g, num_params=50000)
+    shuffle_maps = restored.shuffle_maps_0.clone()
+    restored.load_state_dict(state_dict)
+    assert torch.equal(restored.linear_layers['l2'].weight, model.linear_layers['l2'].weight)
+    assert torch.equal(restored.shuffle_maps_0, shuffle_maps)
+
+    hoa = actfuns.HigherOrderActivation(actfun='max', p=2, k=2)
+    hoa.init_shuffle_maps(8)
+    shuffle_maps = hoa.shuffle_maps.clone()
+    hoa.load_state_dict({})
+    assert torch.equal(hoa.shuffle_maps, shuffle_maps)
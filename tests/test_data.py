@@ -0,0 +1,64 @@
+import torch
+import torch.nn as nn
+import torch.utils.data
+
+from timm.data import Dataset, create_feature_cache_loader, create_split_manifest
+
+
+def test_feature_cache(tmp_path):
+    torch.manual_seed(0)
+    backbone = nn.Linear(8, 4)
+    dataset = torch.utils.data.TensorDataset(torch.randn(10, 8), torch.arange(10))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=3)
+
+    cached = create_feature_cache_loader(backbone, loader, str(tmp_path), batch_size=4)
+    assert cached.cache.is_complete()
+    assert len(cached) == 3
+    input, target = zip(*cached)
+    input, target = torch.cat(input), torch.cat(target)
+    assert torch.equal(target, torch.arange(10))
+    with torch.no_grad():
+        assert torch.allclose(input, backbone(dataset.tensors[0]))
+
+    # same backbone and loader load the existing store, new weights get a new one
+    assert create_feature_cache_loader(backbone, loader, str(tmp_path), batch_size=4).cache.path == cached.cache.path
+    with torch.no_grad():
+        backbone.weight.add_(1)
+    assert create_feature_cache_loader(backbone, loader, str(tmp_path), batch_size=4).cache.path != cached.cache.path
+
+    # training loaders shuffle and cycle through the cached passes per epoch
+    cached = create_feature_cache_loader(backbone, loader, str(tmp_path), batch_size=4, is_training=True, num_passes=2)
+    assert cached.cache.num_passes == 2
+    assert len(cached) == 2
+    for epoch in range(3):
+        cached.set_epoch(epoch)
+        batches = list(cached)
+        assert sum(len(target) for _, target in batches) == 8
+        # iterating again within the epoch reads the same pass in the same order
+        assert all(torch.equal(a[0], b[0]) and torch.equal(a[1], b[1]) for a, b in zip(batches, cached))
+
+
+def test_split_manifest(tmp_path):
+    root = tmp_path / 'images'
+    for label, num_images in [('cat', 10), ('dog', 20), ('BACKGROUND_Google', 5)]:
+        (root / label).mkdir(parents=True)
+        for i in range(num_images):
+            (root / label / '{}.jpg'.format(i)).touch()
+
+    manifest = str(tmp_path / 'split.csv')
+    create_split_manifest(str(root), manifest, seed=0, exclude=['BACKGROUND_Google'])
+    splits = {split: Dataset(str(root), manifest=manifest, split=split) for split in ['train', 'val', 'test']}
+    assert [len(splits[split]) for split in ['train', 'val', 'test']] == [24, 3, 3]
+    assert all(dataset.class_to_idx == {'cat': 0, 'dog': 1} for dataset in splits.values())
+    filenames = [set(dataset.filenames()) for dataset in splits.values()]
+    assert len(set.union(*filenames)) == 30
+
+    # splits only depend on the files and the seed
+    with open(manifest) as f:
+        expected = f.read()
+    create_split_manifest(str(root), manifest, seed=0, exclude=['BACKGROUND_Google'])
+    with open(manifest) as f:
+        assert f.read() == expected
+    create_split_manifest(str(root), manifest, seed=1, exclude=['BACKGROUND_Google'])
+    with open(manifest) as f:
+        assert f.read() != expected
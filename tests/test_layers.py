@@ -4,7 +4,7 @@ import torch.nn as nn
 import platform
 import os
 
-from timm.models.layers import create_act_layer, get_act_layer, set_layer_config
+from timm.models.layers import create_act_layer, get_act_layer, set_layer_config, GroupedLinear
 
 
 class MLP(nn.Module):
@@ -69,3 +69,23 @@ def test_hard_swish_grad():
 def test_hard_mish_grad():
     for _ in range(100):
         _run_act_layer_grad('hard_mish')
+
+
+@pytest.mark.parametrize('groups', [1, 2, 4])
+def test_grouped_linear(groups):
+    torch.manual_seed(0)
+    # per-group nn.Linear layers, the layout GroupedLinear replaces
+    group_fcs = nn.ModuleList([nn.Linear(96 // groups, 40 // groups) for _ in range(groups)])
+    m = GroupedLinear(96, 40, groups=groups)
+    m.load_state_dict(group_fcs.state_dict())
+
+    x = torch.randn(8, 96, requires_grad=True)
+    expected = torch.cat([fc(x_g) for fc, x_g in zip(group_fcs, x.chunk(groups, dim=1))], dim=1)
+    out = m(x)
+    assert out.shape == (8, 40)
+    assert torch.allclose(out, expected, atol=1e-6)
+    out.sum().backward()
+    assert m.weight.grad.shape == (groups, 96 // groups, 40 // groups)
+
+    scripted = torch.jit.script(m)
+    assert torch.allclose(scripted(x), out)
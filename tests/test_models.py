@@ -173,3 +173,161 @@ def test_model_forward_features(model_name, batch_size):
         assert e == o.shape[1]
         assert o.shape[0] == batch_size
         assert not torch.isnan(o).any()
+
+
+@pytest.mark.timeout(120)
+@pytest.mark.parametrize('actfun', ['max', 'l2'])
+def test_efficientnet_fold_permutations(actfun):
+    """Folding HOA permutations into the preceding convs must not change the output"""
+    import activation_functions as actfuns
+    torch.manual_seed(0)
+    model = create_model('efficientnet_b0', actfun=actfun, p=2, k=2, g=1, weight_init_name='orthogonal')
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.normal_(0, 0.1)
+                module.running_var.uniform_(0.5, 2)
+    model.eval()
+    x = torch.randn(2, 3, 96, 96)
+    with torch.no_grad():
+        expected = model(x)
+        out = model.fold_permutations()(x)
+    hoas = [m for m in model.modules() if isinstance(m, actfuns.HigherOrderActivation)]
+    assert any(hoa.p == 1 for hoa in hoas)
+    assert torch.allclose(out, expected, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.timeout(120)
+@pytest.mark.parametrize('model_name,features_only', [
+    ('efficientnet_b0', False), ('mobilenetv3_large_100', False), ('efficientnet_es', False), ('resnet26d', False),
+    ('mobilenetv3_large_100', True), ('efficientnet_es', True), ('resnet26d', True)])
+def test_fuse_model(model_name, features_only):
+    """Folding BatchNorm into the preceding convs must not change the output or drop feature hooks"""
+    from timm.utils import fuse_model
+    torch.manual_seed(0)
+    model = create_model(model_name, pretrained=False, features_only=features_only)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.normal_(0, 0.1)
+                module.running_var.uniform_(0.5, 2)
+    fuse_model(model, input_size=(3, 96, 96))  # raises if the outputs differ
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules())
+    if features_only:
+        outputs = model(torch.randn(1, 3, 96, 96))
+        assert [o.shape[1] for o in outputs] == model.feature_info.channels()
+
+
+@pytest.mark.timeout(120)
+@pytest.mark.parametrize('model_name', ['densenet121', 'dpn68'])
+def test_fuse_model_keeps_norm_act(model_name):
+    """BatchNormAct2d layers also apply an activation, so they must not be folded away"""
+    from timm.models.layers import BatchNormAct2d
+    from timm.utils import fuse_model
+    torch.manual_seed(0)
+    model = create_model(model_name, pretrained=False)
+    num_norm_acts = sum(isinstance(m, BatchNormAct2d) for m in model.modules())
+    assert num_norm_acts
+    fuse_model(model, input_size=(3, 64, 64))  # raises if the outputs differ
+    assert sum(isinstance(m, BatchNormAct2d) for m in model.modules()) == num_norm_acts
+
+
+@pytest.mark.timeout(120)
+def test_efficientnet_stage_actfuns():
+    """Per stage higher-order activation specs configure each block's activations independently"""
+    import activation_functions as actfuns
+    torch.manual_seed(0)
+    model = create_model(
+        'efficientnet_b0', actfun='swish', p=1, k=2, g=1,
+        stage_actfuns=['', '', '', 'max', 'max.p2', 'l2.p2.k4', 'swish'])
+    for stage_idx, stage in enumerate(model.blocks):
+        hoas = [m for m in stage.modules() if isinstance(m, actfuns.HigherOrderActivation)]
+        if stage_idx in (3, 4, 5):
+            assert hoas
+        else:
+            assert not hoas
+    assert all((m.actfun, m.p) == ('max', 1)
+               for m in model.blocks[3].modules() if isinstance(m, actfuns.HigherOrderActivation))
+    assert all(m.p == 2 for m in model.blocks[4].modules() if isinstance(m, actfuns.HigherOrderActivation))
+    assert all((m.actfun, m.p, m.k) == ('l2', 2, 4)
+               for m in model.blocks[5].modules() if isinstance(m, actfuns.HigherOrderActivation))
+    assert not isinstance(model.act1, actfuns.HigherOrderActivation)
+    # act2 of the p != k stage sees the p / k expanded output of act1
+    for block in model.blocks[5]:
+        assert block.act2.shuffle_maps.shape[1] == block.conv_dw.out_channels
+    model.eval()
+    x = torch.randn(1, 3, 96, 96)
+    assert model(x).shape == (1, 1000)
+    features = model.blocks[:5](model.act1(model.bn1(model.conv_stem(x))))
+    assert model.blocks[5](features).shape[1] == model.blocks[5][-1].conv_pwl.out_channels
+
+
+def test_decode_block_str_ho_spec():
+    from timm.models.efficientnet_builder import _decode_block_str
+    block_args, _ = _decode_block_str('ir_r1_k3_s1_e6_c320_se0.25_hobin+all+max+min.p2')
+    assert block_args['ho_args'] == dict(actfun='bin_all_max_min', p=2)
+    block_args, _ = _decode_block_str('ir_r1_k3_s1_e6_c320_se0.25_ho.k4')
+    assert block_args['ho_args'] == dict(k=4)
+
+
+@pytest.mark.timeout(120)
+@pytest.mark.parametrize('mode', ['act', 'block'])
+def test_efficientnet_grad_checkpointing(mode):
+    """Checkpointed activations / blocks must produce the same outputs and gradients"""
+    torch.manual_seed(0)
+    model = create_model('efficientnet_b0', actfun='max', p=2, k=2, g=1)
+    x = torch.randn(2, 3, 64, 64)
+    grads = []
+    for checkpointing in ['', mode]:
+        model.set_grad_checkpointing(checkpointing)
+        model.zero_grad()
+        model.train()
+        out = model(x)
+        out.mean().backward()
+        grads.append([p.grad.clone() for p in model.parameters()])
+        model.eval()
+        if not checkpointing:
+            expected = out.detach()
+    assert torch.allclose(out, expected, atol=1e-5)
+    for grad, expected_grad in zip(grads[1], grads[0]):
+        assert torch.allclose(grad, expected_grad, atol=1e-5)
+
+
+@pytest.mark.timeout(120)
+@pytest.mark.skipif('fbgemm' not in torch.backends.quantized.supported_engines, reason='needs the fbgemm engine')
+@pytest.mark.parametrize('actfun', ['max', 'l2'])
+def test_efficientnet_quantize_int8(actfun):
+    """HOA EfficientNets quantize to int8, with selection actfuns kept int8 and the others run in float"""
+    import activation_functions as actfuns
+    from timm.utils import quantize_int8
+    from timm.utils.quantize import FloatModule, QuantizableResidual
+    torch.manual_seed(0)
+    model = create_model('efficientnet_b0', actfun=actfun, p=2, k=2, g=1)
+    assert not any(isinstance(m, torch.nn.quantized.FloatFunctional) for m in model.modules())
+    calib_batches = [(torch.randn(2, 3, 64, 64), None) for _ in range(2)]
+    model = quantize_int8(model, calib_batches, num_batches=2)
+    assert any(isinstance(m, torch.nn.quantized.Conv2d) for m in model.modules())
+    assert any(isinstance(m, QuantizableResidual) for m in model.modules())
+    in_float = [m.module for m in model.modules() if isinstance(m, FloatModule)]
+    assert any(isinstance(m, actfuns.HigherOrderActivation) for m in in_float) == (actfun == 'l2')
+    outputs = model(torch.randn(2, 3, 64, 64))
+    assert outputs.shape == (2, 1000)
+    assert torch.isfinite(outputs).all()
+
+
+@pytest.mark.timeout(120)
+@pytest.mark.parametrize('actfun', ['max', 'l2', 'groupsort'])
+def test_efficientnet_hoa_torchscript(actfun):
+    """Scripted, frozen and traced HOA EfficientNets must match the eager model"""
+    torch.manual_seed(0)
+    model = create_model('efficientnet_b0', actfun=actfun, p=2, k=2, g=1)
+    model.eval()
+    x = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        expected = model(x)
+        scripted = torch.jit.script(model)
+        assert torch.allclose(scripted(x), expected, atol=1e-5)
+        if hasattr(torch.jit, 'freeze'):
+            assert torch.allclose(torch.jit.freeze(scripted)(x), expected, atol=1e-5)
+        traced = torch.jit.trace(model, x)
+        assert torch.allclose(traced(x), expected, atol=1e-5)
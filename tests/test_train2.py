@@ -0,0 +1,60 @@
+import copy
+
+import torch
+from torch.optim.lr_scheduler import OneCycleLR
+
+import MLP
+import train2
+
+
+def _pre_series_mlp(model):
+    # module with the parameter layout (and order) of MLP before the second layer was a GroupedLinear
+    l2 = model.linear_layers['l2']
+    old = torch.nn.Module()
+    old.linear_layers = torch.nn.ModuleDict({
+        'l1': copy.deepcopy(model.linear_layers['l1']),
+        'l2': torch.nn.ModuleList([torch.nn.Linear(l2.in_group_features, l2.out_features // l2.groups)
+                                   for _ in range(l2.groups)]),
+        'l3': copy.deepcopy(model.linear_layers['l3'])})
+    old.batch_norms = copy.deepcopy(model.batch_norms)
+    old.all_alpha_primes = copy.deepcopy(model.all_alpha_primes)
+    with torch.no_grad():
+        for group, (layer, bias) in enumerate(zip(old.linear_layers['l2'], l2.bias.chunk(l2.groups))):
+            layer.weight.copy_(l2.weight[group].t())
+            layer.bias.copy_(bias)
+    return old
+
+
+def test_resumes_pre_series_checkpoint(tmp_path):
+    def create_head(seed):
+        torch.manual_seed(seed)
+        model = MLP.MLP('max', p=2, k=2, g=2, num_params=50000)
+        optimizer = torch.optim.Adam(model.parameters(), weight_decay=1e-5)
+        scheduler = OneCycleLR(optimizer, max_lr=0.01, total_steps=10, cycle_momentum=False)
+        return {'model': model, 'optimizer': optimizer, 'scheduler': scheduler}
+
+    old = _pre_series_mlp(create_head(0)['model'])
+    optimizer = torch.optim.Adam(old.parameters(), weight_decay=1e-5)
+    scheduler = OneCycleLR(optimizer, max_lr=0.01, total_steps=10, cycle_momentum=False)
+    sum((param ** 2).sum() for param in old.parameters()).backward()
+    optimizer.step()
+    scheduler.step()
+    pre_model = torch.nn.Linear(4, 4)
+    torch.save({'pre_model_state_dict': pre_model.state_dict(), 'model_state_dict': old.state_dict(),
+                'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'epoch': 3,
+                'curr_seed': 0, 'actfun': 'max', 'p': 2, 'k': 2, 'g': 2, 'perm_method': 'shuffle'},
+               str(tmp_path / 'checkpoint.pth'))
+
+    head = create_head(1)
+    checkpoint = torch.load(str(tmp_path / 'checkpoint.pth'))
+    assert train2._load_checkpoint(checkpoint, torch.nn.Linear(4, 4), [head], 'cpu') == 3
+    weight = head['model'].linear_layers['l2'].weight
+    old_l2 = old.linear_layers['l2']
+    assert torch.equal(weight, torch.stack([layer.weight.t() for layer in old_l2]))
+    assert torch.equal(head['optimizer'].state[weight]['exp_avg'],
+                       torch.stack([optimizer.state[layer.weight]['exp_avg'].t() for layer in old_l2]))
+    assert head['scheduler'].last_epoch == scheduler.last_epoch
+
+    # the restored optimizer state matches the parameters it steps
+    head['model'](torch.randn(4, 784)).sum().backward()
+    head['optimizer'].step()
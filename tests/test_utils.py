@@ -0,0 +1,33 @@
+import torch
+import torch.nn.functional as F
+
+from timm.utils import MetricAccumulator, accuracy
+
+
+def test_metric_accumulator():
+    torch.manual_seed(0)
+    metrics = MetricAccumulator(topk=(1, 5), num_classes=10)
+    outputs, targets = torch.randn(3, 8, 10, requires_grad=True), torch.randint(10, (3, 8))
+    for output, target in zip(outputs, targets):
+        loss = F.cross_entropy(output, target)
+        metrics.update(loss=loss, output=output, target=target)
+        assert not metrics.loss_sum.requires_grad
+
+    last = metrics.compute(last=True)
+    assert abs(last['top1'] - accuracy(outputs[-1], targets[-1])[0].item()) < 1e-4
+    output, target = outputs.reshape(-1, 10), targets.reshape(-1)
+    result = metrics.compute()
+    acc1, acc5 = accuracy(output, target, topk=(1, 5))
+    assert result['count'] == 24
+    assert abs(result['loss'] - F.cross_entropy(output, target).item()) < 1e-5
+    assert abs(result['top1'] - acc1.item()) < 1e-4
+    assert abs(result['top5'] - acc5.item()) < 1e-4
+
+    confusion = metrics.confusion_matrix()
+    assert confusion.sum() == 24
+    assert confusion.diagonal().sum() == int(round(acc1.item() * 24 / 100))
+
+    # soft targets only count towards the loss
+    metrics.reset()
+    metrics.update(loss=torch.tensor(2.), output=output, target=F.one_hot(target, 10).float())
+    assert metrics.compute() == {'loss': 2., 'count': 24}
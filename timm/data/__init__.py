@@ -1,8 +1,9 @@
 from .constants import *
 from .config import resolve_data_config
-from .dataset import Dataset, DatasetTar, AugMixDataset
+from .dataset import Dataset, DatasetTar, AugMixDataset, create_split_manifest, load_split_manifest
 from .transforms import *
 from .loader import create_loader
+from .feature_cache import FeatureCache, FeatureCacheLoader, create_feature_cache_loader, feature_cache_key
 from .transforms_factory import create_transform
 from .mixup import Mixup, FastCollateMixup
 from .auto_augment import RandAugment, AutoAugment, rand_augment_ops, auto_augment_policy,\
@@ -8,7 +8,9 @@ from __future__ import print_function
 
 import torch.utils.data as data
 
+import csv
 import os
+import random
 import re
 import torch
 import tarfile
@@ -59,6 +61,54 @@ def load_class_map(filename, root=''):
     return class_to_idx
 
 
+def create_split_manifest(root, filename, splits=(('train', 0.8), ('val', 0.1), ('test', 0.1)), seed=None,
+                          exclude=(), types=IMG_EXTENSIONS):
+    """ Split the images of every class folder under root and write the splits to a (path, label, split) CSV
+
+    Each class is split on its own, by the fractions of splits, in natural sort order or shuffled with seed. The
+    result only depends on the files, splits and seed, and the file is written atomically, so parallel processes
+    (e.g. distributed ranks) can all create the same manifest safely. Paths are relative to root.
+    """
+    images, class_to_idx = find_images_and_targets(root, types=types)
+    idx_to_class = {idx: c for c, idx in class_to_idx.items()}
+    class_images = {}
+    for path, target in images:
+        if idx_to_class[target] not in exclude:
+            class_images.setdefault(idx_to_class[target], []).append(os.path.relpath(path, root))
+
+    rows = []
+    for label, paths in class_images.items():
+        if seed is not None:
+            random.Random('{}-{}'.format(seed, label)).shuffle(paths)
+        start, cumulative = 0, 0.
+        for split_idx, (split, fraction) in enumerate(splits):
+            cumulative += fraction
+            end = len(paths) if split_idx == len(splits) - 1 else int(cumulative * len(paths))
+            rows.extend((path, label, split) for path in paths[start:end])
+            start = end
+
+    tmp_filename = '{}.tmp-{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'label', 'split'])
+        writer.writerows(rows)
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+def load_split_manifest(filename, root='', split=None, class_to_idx=None):
+    """ Images and targets of split (or of every split) of a manifest written by create_split_manifest """
+    with open(filename, newline='') as f:
+        rows = list(csv.DictReader(f))
+    if class_to_idx is None:
+        # built from every split, so all splits share it
+        sorted_labels = list(sorted(set(row['label'] for row in rows), key=natural_key))
+        class_to_idx = {c: idx for idx, c in enumerate(sorted_labels)}
+    images_and_targets = [(os.path.join(root, row['path']), class_to_idx[row['label']]) for row in rows
+                          if (split is None or row['split'] == split) and row['label'] in class_to_idx]
+    return images_and_targets, class_to_idx
+
+
 class Dataset(data.Dataset):
 
     def __init__(
@@ -66,12 +116,18 @@ class Dataset(data.Dataset):
             root,
             load_bytes=False,
             transform=None,
-            class_map=''):
+            class_map='',
+            manifest='',
+            split=None):
 
         class_to_idx = None
         if class_map:
             class_to_idx = load_class_map(class_map, root)
-        images, class_to_idx = find_images_and_targets(root, class_to_idx=class_to_idx)
+        if manifest:
+            # images of one split of root, see create_split_manifest
+            images, class_to_idx = load_split_manifest(manifest, root, split, class_to_idx=class_to_idx)
+        else:
+            images, class_to_idx = find_images_and_targets(root, class_to_idx=class_to_idx)
         if len(images) == 0:
             raise RuntimeError(f'Found 0 images in subfolders of {root}. '
                                f'Supported image extensions are {", ".join(IMG_EXTENSIONS)}')
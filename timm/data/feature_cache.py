@@ -0,0 +1,278 @@
+""" Backbone feature cache for frozen backbone (transfer learning) training
+
+Runs a frozen backbone over a loader once and stores its features and targets in memory-mapped .npy files on disk.
+The store is keyed by a hash of the backbone weights, the dataset samples, the transforms and any extra config, so
+later epochs, and later runs with the same key, stream batches from the store instead of re-running the backbone.
+
+Random augmentations are frozen into the cached features. Caching several passes of a training loader (each with its
+own seed) and cycling through them per epoch keeps some of the augmentation.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+from contextlib import suppress
+
+import numpy as np
+import torch
+
+_logger = logging.getLogger(__name__)
+
+_META_FILE = 'meta.json'
+
+
+def _base_loader(loader):
+    # PrefetchLoader wraps the torch DataLoader
+    return getattr(loader, 'loader', loader)
+
+
+def _loader_config(loader):
+    base = _base_loader(loader)
+    dataset = base.dataset
+    if hasattr(dataset, 'filenames'):
+        samples = dataset.filenames()
+        targets = [target for _, target in dataset.samples]
+    else:
+        samples, targets = len(dataset), None
+    config = dict(
+        dataset=type(dataset).__name__,
+        samples=hashlib.sha1(repr((samples, targets)).encode()).hexdigest(),
+        transform=repr(getattr(dataset, 'transform', None)),
+        batch_size=base.batch_size,
+        drop_last=base.drop_last,
+        collate_fn=getattr(base.collate_fn, '__name__', type(base.collate_fn).__name__),
+    )
+    if loader is not base:
+        config.update(mean=loader.mean.flatten().tolist(), std=loader.std.flatten().tolist(), fp16=loader.fp16)
+        if loader.random_erasing is not None:
+            config['random_erasing'] = repr(sorted(vars(loader.random_erasing).items()))
+    return config
+
+
+def feature_cache_key(backbone, loader, extra=None):
+    """ Hash of everything the cached features depend on
+
+    Args:
+        backbone: frozen backbone module, its state dict (weights and buffers) is hashed
+        loader: loader (torch DataLoader or PrefetchLoader) the features are computed over, its dataset samples,
+            transform, batching and normalization are hashed
+        extra: dict of any other config the features depend on (model name, split, mixup, amp...)
+
+    Returns:
+        hex digest
+    """
+    h = hashlib.sha1()
+    for name, tensor in backbone.state_dict().items():
+        tensor = tensor.detach().cpu()
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.float()
+        h.update(name.encode())
+        h.update(str(tuple(tensor.shape)).encode())
+        h.update(tensor.contiguous().numpy().tobytes())
+    config = dict(loader=_loader_config(loader), extra=extra or {})
+    h.update(json.dumps(config, sort_keys=True, default=repr).encode())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """ On-disk store of the backbone features and targets of one or more passes over a loader
+
+    Each pass is saved as features_<pass>.npy (num_samples, *feature_shape) and targets_<pass>.npy, and opened
+    memory-mapped. The store is written to a temporary directory that is only renamed to its final path once every
+    pass is complete, so an interrupted build is never picked up.
+    """
+
+    def __init__(self, root, key):
+        self.root = root
+        self.key = key
+        self.path = os.path.join(root, key)
+        self.meta = None
+        if self.is_complete():
+            with open(os.path.join(self.path, _META_FILE)) as f:
+                self.meta = json.load(f)
+
+    def is_complete(self):
+        return os.path.isfile(os.path.join(self.path, _META_FILE))
+
+    @property
+    def num_passes(self):
+        return self.meta['num_passes']
+
+    def num_samples(self, pass_idx=0):
+        return self.meta['num_samples'][pass_idx]
+
+    def features(self, pass_idx=0):
+        return np.load(os.path.join(self.path, 'features_{}.npy'.format(pass_idx)), mmap_mode='r')
+
+    def targets(self, pass_idx=0):
+        return np.load(os.path.join(self.path, 'targets_{}.npy'.format(pass_idx)), mmap_mode='r')
+
+    def build(self, backbone, loader, num_passes=1, seed=0, amp_autocast=suppress, batch_fn=None):
+        """ Run backbone over num_passes passes of loader and write the store
+
+        Args:
+            backbone: frozen backbone, run in eval mode under torch.no_grad
+            loader: loader of (input, target) batches
+            num_passes: passes over loader to cache, pass i is run with torch / numpy / random seeded to seed + i
+            seed: base seed of the passes
+            amp_autocast: autocast context to run the backbone in, half precision features are stored as float16
+            batch_fn: optional fn(input, target) -> (input, target) applied to each batch before the backbone,
+                e.g. a Mixup
+        """
+        device = next(backbone.parameters()).device
+        tmp_path = '{}.tmp-{}'.format(self.path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        max_samples = len(_base_loader(loader).dataset)
+        num_samples = []
+        was_training = backbone.training
+        backbone.eval()
+        try:
+            for pass_idx in range(num_passes):
+                random_state, np_state = random.getstate(), np.random.get_state()
+                with torch.random.fork_rng(devices=[]):
+                    torch.manual_seed(seed + pass_idx)
+                    random.seed(seed + pass_idx)
+                    np.random.seed(seed + pass_idx)
+                    num_samples.append(self._build_pass(
+                        backbone, loader, tmp_path, pass_idx, max_samples, device, amp_autocast, batch_fn))
+                random.setstate(random_state)
+                np.random.set_state(np_state)
+                _logger.info('Cached {} backbone features of pass {}/{} in {}'.format(
+                    num_samples[-1], pass_idx + 1, num_passes, tmp_path))
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        finally:
+            backbone.train(was_training)
+
+        self.meta = dict(num_passes=num_passes, num_samples=num_samples)
+        with open(os.path.join(tmp_path, _META_FILE), 'w') as f:
+            json.dump(self.meta, f)
+        if self.is_complete():
+            # built concurrently by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            os.rename(tmp_path, self.path)
+        return self
+
+    @staticmethod
+    def _build_pass(backbone, loader, path, pass_idx, max_samples, device, amp_autocast, batch_fn):
+        features = targets = None
+        count = 0
+        with torch.no_grad():
+            for input, target in loader:
+                input, target = input.to(device), target.to(device)
+                if batch_fn is not None:
+                    input, target = batch_fn(input, target)
+                with amp_autocast():
+                    output = backbone(input)
+                output = output.cpu().numpy()
+                target = target.cpu().numpy()
+                if features is None:
+                    # every sample is seen at most once per pass, the unused tail is cut off on load
+                    features = np.lib.format.open_memmap(
+                        os.path.join(path, 'features_{}.npy'.format(pass_idx)), mode='w+',
+                        dtype=np.float16 if output.dtype == np.float16 else np.float32,
+                        shape=(max_samples,) + output.shape[1:])
+                    targets = np.lib.format.open_memmap(
+                        os.path.join(path, 'targets_{}.npy'.format(pass_idx)), mode='w+',
+                        dtype=target.dtype, shape=(max_samples,) + target.shape[1:])
+                features[count:count + len(output)] = output
+                targets[count:count + len(target)] = target
+                count += len(output)
+        if features is not None:
+            features.flush()
+            targets.flush()
+        return count
+
+
+class FeatureCacheLoader:
+    """ Loader of (features, target) batches from a FeatureCache
+
+    Iterating streams the cached pass of the epoch set by set_epoch (epoch % num_passes, shuffled per epoch), so
+    epochs cycle through the augmentation passes and repeated iterations within an epoch see the same pass. Batches
+    are returned as float32 features and targets on device.
+    """
+
+    def __init__(self, cache, batch_size, shuffle=False, drop_last=False, device=None, seed=0):
+        self.cache = cache
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def num_samples(self):
+        return min(self.cache.num_samples(p) for p in range(self.cache.num_passes))
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        pass_idx = self.epoch % self.cache.num_passes
+        num_samples = self.cache.num_samples(pass_idx)
+        features, targets = self.cache.features(pass_idx), self.cache.targets(pass_idx)
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(num_samples)
+        else:
+            order = np.arange(num_samples)
+        for batch_idx in range(len(self)):
+            # sorted indices read the memory map in order
+            idx = np.sort(order[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size])
+            input = torch.from_numpy(np.ascontiguousarray(features[idx])).float()
+            target = torch.from_numpy(np.ascontiguousarray(targets[idx]))
+            if self.device is not None:
+                input = input.to(self.device, non_blocking=True)
+                target = target.to(self.device, non_blocking=True)
+            yield input, target
+
+
+def create_feature_cache_loader(
+        backbone,
+        loader,
+        cache_dir,
+        batch_size,
+        is_training=False,
+        num_passes=1,
+        seed=0,
+        extra=None,
+        amp_autocast=suppress,
+        batch_fn=None,
+):
+    """ Cache the backbone features of loader in cache_dir (unless already cached) and return a loader over them
+
+    Args:
+        backbone: frozen backbone
+        loader: loader the features are computed over
+        cache_dir: root directory of the feature caches, one subdirectory per cache key
+        batch_size: batch size of the returned loader
+        is_training: shuffle and drop the last incomplete batch, and cache num_passes passes
+        num_passes: passes of a training loader to cache (see FeatureCache.build)
+        seed: seed of the passes and of the shuffling
+        extra: dict of any other config the features depend on, part of the cache key
+        amp_autocast: autocast context to run the backbone in
+        batch_fn: optional fn(input, target) -> (input, target) applied to each batch before the backbone
+
+    Returns:
+        FeatureCacheLoader
+    """
+    num_passes = num_passes if is_training else 1
+    extra = dict(extra or {}, num_passes=num_passes, seed=seed, amp=amp_autocast is not suppress)
+    cache = FeatureCache(cache_dir, feature_cache_key(backbone, loader, extra))
+    if cache.is_complete():
+        _logger.info('Loading cached backbone features from {}'.format(cache.path))
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache.build(backbone, loader, num_passes=num_passes, seed=seed, amp_autocast=amp_autocast,
+                    batch_fn=batch_fn)
+    return FeatureCacheLoader(cache, batch_size, shuffle=is_training, drop_last=is_training,
+                              device=next(backbone.parameters()).device, seed=seed)
@@ -27,11 +27,13 @@ Hacked together by / Copyright 2020 Ross Wightman
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as cp
 
 from typing import List
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD, IMAGENET_INCEPTION_MEAN, IMAGENET_INCEPTION_STD
-from .efficientnet_blocks import round_channels, resolve_bn_args, resolve_act_layer, BN_EPS_TF_DEFAULT
+from .efficientnet_blocks import round_channels, resolve_bn_args, resolve_act_layer, resolve_ho_act_layer, \
+    BN_EPS_TF_DEFAULT
 from .efficientnet_builder import EfficientNetBuilder, decode_arch_def, efficientnet_init_weights
 from .features import FeatureInfo, FeatureHooks
 from .helpers import build_model_with_cfg, default_cfg_for_features
@@ -334,7 +336,7 @@ class EfficientNet(nn.Module):
                  output_stride=32, pad_type='', fix_stem=False, act_layer=nn.ReLU, act_layer2=None, drop_rate=0.,
                  drop_path_rate=0., se_kwargs=None, norm_layer=nn.BatchNorm2d, norm_kwargs=None, global_pool='avg',
                  actfun='swish', p=1, k=2, g=1, extra_channel_mult=1, weight_init_name=None,
-                 partial_ho_actfun=''):
+                 partial_ho_actfun='', stage_actfuns=None, grad_checkpointing=''):
         super(EfficientNet, self).__init__()
         norm_kwargs = norm_kwargs or {}
 
@@ -361,7 +363,7 @@ class EfficientNet(nn.Module):
         builder = EfficientNetBuilder(
             channel_multiplier, channel_divisor, channel_min, output_stride, pad_type, act_layer, se_kwargs,
             norm_layer, norm_kwargs, drop_path_rate, actfun=actfun, p=p, k=k, g=g,
-            partial_ho_actfun=partial_ho_actfun, act_layer2=act_layer2, verbose=_DEBUG)
+            partial_ho_actfun=partial_ho_actfun, act_layer2=act_layer2, stage_actfuns=stage_actfuns, verbose=_DEBUG)
         self.blocks = nn.Sequential(*builder(activations, block_args))
         self.feature_info = builder.features
         head_chs = builder.in_chs
@@ -377,6 +379,22 @@ class EfficientNet(nn.Module):
         self.global_pool, self.classifier = create_classifier(self.activations, self.num_classes, pool_type=global_pool)
 
         efficientnet_init_weights(self, weight_init_name)
+        self.set_grad_checkpointing(grad_checkpointing)
+
+    def set_grad_checkpointing(self, mode='block'):
+        """ Trade compute for memory in training by recomputing activations in backward (torch.utils.checkpoint)
+
+        Args:
+            mode: '' to disable, 'act' to checkpoint every higher-order activation, so that only their
+                (p-expanded) outputs are recomputed, or 'block' to checkpoint every IR/DS/ER block, which only keeps
+                block inputs alive. Note that BN running stats are updated again when a block is recomputed.
+        """
+        assert mode in ('', 'act', 'block')
+        self.grad_checkpointing = mode
+        for module in self.modules():
+            if isinstance(module, activation_functions.HigherOrderActivation):
+                module.grad_checkpointing = mode == 'act'
+        return self
 
     def as_sequential(self):
         layers = [self.conv_stem, self.bn1, self.act1]
@@ -393,11 +411,36 @@ class EfficientNet(nn.Module):
         self.global_pool, self.classifier = create_classifier(
             self.num_features, self.num_classes, pool_type=global_pool)
 
+    def fold_permutations(self):
+        """ Fold the channel permutations of higher-order activations into the conv (and BN) layers before them
+
+        For inference / export only. Each dense conv then directly outputs the permuted copies of its channels
+        in cluster order, so the activations no longer gather them at runtime. Outputs are unchanged.
+        """
+        if isinstance(self.act1, activation_functions.HigherOrderActivation):
+            self.act1.fold_into(self.conv_stem, self.bn1)
+        if isinstance(self.act2, activation_functions.HigherOrderActivation):
+            self.act2.fold_into(self.conv_head, self.bn2)
+        for module in self.blocks.modules():
+            if hasattr(module, 'fold_permutations'):
+                module.fold_permutations()
+        return self
+
+    @torch.jit.unused
+    def checkpoint_blocks(self, x):
+        for stage in self.blocks:
+            for block in stage:
+                x = cp.checkpoint(block, x)
+        return x
+
     def forward_features(self, x):
         x = self.conv_stem(x)
         x = self.bn1(x)
         x = self.act1(x)
-        x = self.blocks(x)
+        if self.grad_checkpointing == 'block' and torch.is_grad_enabled() and not torch.jit.is_scripting():
+            x = self.checkpoint_blocks(x)
+        else:
+            x = self.blocks(x)
         x = self.conv_head(x)
         x = self.bn2(x)
         x = self.act2(x)
@@ -714,36 +757,26 @@ def _gen_efficientnet(variant, channel_multiplier=1.0, depth_multiplier=1.0, pre
         ['ir_r4_k5_s2_e6_c192_se0.25'],
         ['ir_r1_k3_s1_e6_c320_se0.25'],
     ]
-    actfun = kwargs.pop('actfun')
-    p = kwargs['p']
-    k = kwargs['k']
-    g = kwargs['g']
+    actfun = kwargs.pop('actfun', 'swish')
+    p, k, g = kwargs.get('p', 1), kwargs.get('k', 2), kwargs.get('g', 1)
+    act_layer2 = None
     if actfun == 'swish' or actfun == 'nswish':
         act_layer = resolve_act_layer(kwargs, actfun)
-        act_layer2 = None
     else:
-        act_layer = activation_functions.HigherOrderActivation
-        act_layer.actfun = actfun
-        act_layer.p = p
-        act_layer.k = k
-        act_layer.g = g
-        act_layer2 = None
-
-    if kwargs['partial_ho_actfun'] != '':
+        act_layer = resolve_ho_act_layer(actfun, p, k, g)
+
+    if kwargs.get('partial_ho_actfun', ''):
         act_layer = resolve_act_layer(kwargs, 'nswish')
-        act_layer2 = activation_functions.HigherOrderActivation
-        act_layer2.actfun = actfun
-        act_layer2.p = p
-        act_layer2.k = k
-        act_layer2.g = g
+        act_layer2 = resolve_ho_act_layer(actfun, p, k, g)
 
     model_kwargs = dict(
         block_args=decode_arch_def(arch_def, depth_multiplier),
         num_features=round_channels(1280, channel_multiplier, 8, None),
         stem_size=32,
-        channel_multiplier=channel_multiplier * kwargs['extra_channel_mult'],
+        channel_multiplier=channel_multiplier * kwargs.get('extra_channel_mult', 1),
         act_layer=act_layer,
         act_layer2=act_layer2,
+        actfun=actfun,
         norm_kwargs=resolve_bn_args(kwargs),
         **kwargs,
     )
@@ -3,6 +3,8 @@
 Hacked together by / Copyright 2020 Ross Wightman
 """
 
+from functools import partial
+
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -65,6 +67,11 @@ def resolve_act_layer(kwargs, default='relu'):
     return act_layer
 
 
+def resolve_ho_act_layer(actfun, p=1, k=2, g=1):
+    """ Layer factory for higher-order activations, every layer it creates uses this actfun and p, k, g """
+    return partial(activation_functions.HigherOrderActivation, actfun=actfun, p=p, k=k, g=g)
+
+
 def make_divisible(v, divisor=8, min_value=None):
     min_value = min_value or divisor
     new_v = max(min_value, int(v + divisor / 2) // divisor * divisor)
@@ -127,6 +134,11 @@ class SqueezeExcite(nn.Module):
         x_se = self.conv_expand(x_se)
         return x * self.gate_fn(x_se)
 
+    def fold_permutations(self):
+        """ Fold the channel permutations of a higher-order act1 into conv_reduce (inference only) """
+        if isinstance(self.act1, activation_functions.HigherOrderActivation):
+            self.act1.fold_into(self.conv_reduce)
+
 
 class ConvBnAct(nn.Module):
     def __init__(self, in_chs, out_chs, kernel_size,
@@ -151,6 +163,11 @@ class ConvBnAct(nn.Module):
         x = self.act1(x)
         return x
 
+    def fold_permutations(self):
+        """ Fold the channel permutations of a higher-order act1 into conv and bn1 (inference only) """
+        if isinstance(self.act1, activation_functions.HigherOrderActivation):
+            self.act1.fold_into(self.conv, self.bn1)
+
 
 class DepthwiseSeparableConv(nn.Module):
     """ DepthwiseSeparable block
@@ -223,6 +240,17 @@ class DepthwiseSeparableConv(nn.Module):
             x += residual
         return x
 
+    def fold_permutations(self):
+        """ Fold the channel permutations of a higher-order act2 into conv_pw and bn2 (inference only)
+
+        The permuted copies of a depthwise conv's channels would need a grouped conv with a channel gather in
+        between, so act1 keeps gathering at runtime.
+        """
+        if isinstance(self.act2, activation_functions.HigherOrderActivation):
+            self.act2.fold_into(self.conv_pw, self.bn2)
+        if self.se is not None:
+            self.se.fold_permutations()
+
 
 class InvertedResidual(nn.Module):
     """ Inverted residual block w/ optional SE and CondConv routing"""
@@ -259,7 +287,7 @@ class InvertedResidual(nn.Module):
         curr_act = act_layer2() if partial_ho_actfun == 'dw' else act_layer(inplace=True)
         self.act2 = curr_act
         if isinstance(self.act2, activation_functions.HigherOrderActivation):
-            self.act2.init_shuffle_maps(mid_chs)
+            self.act2.init_shuffle_maps(activations)
             activations = int(self.act2.get_actfun_multiplier() * activations)
 
         # Squeeze-and-excitation
@@ -309,6 +337,17 @@ class InvertedResidual(nn.Module):
 
         return x
 
+    def fold_permutations(self):
+        """ Fold the channel permutations of a higher-order act1 into conv_pw and bn1 (inference only)
+
+        As in DepthwiseSeparableConv, act2 follows a depthwise conv and keeps gathering at runtime. CondConv
+        expansions are left as they are.
+        """
+        if isinstance(self.act1, activation_functions.HigherOrderActivation):
+            self.act1.fold_into(self.conv_pw, self.bn1)
+        if self.se is not None:
+            self.se.fold_permutations()
+
 
 class CondConvResidual(InvertedResidual):
     """ Inverted residual block w/ CondConv routing"""
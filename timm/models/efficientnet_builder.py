@@ -33,6 +33,21 @@ def _parse_ksize(ss):
         return [int(k) for k in ss.split('.')]
 
 
+def _decode_ho_spec(spec):
+    """ Decode a higher-order activation spec, e.g. 'max.p4.k2' or 'p2'
+
+    '.' separated fields, p / k / g followed by an int set those args and any other field is the actfun name.
+    Args left unspecified fall back to the model defaults.
+    """
+    ho_args = {}
+    for field in spec.split('.'):
+        if re.fullmatch(r'[pkg]\d+', field):
+            ho_args[field[0]] = int(field[1:])
+        elif field:
+            ho_args['actfun'] = field
+    return ho_args
+
+
 def _decode_block_str(block_str):
     """ Decode block definition string
 
@@ -51,6 +66,8 @@ def _decode_block_str(block_str):
     c - output channels,
     se - squeeze/excitation ratio
     n - activation fn ('re', 'r6', 'hs', or 'sw')
+    ho - higher-order activation spec (see _decode_ho_spec), with '+' in place of '_' in actfun names,
+      e.g. ho.max.p4 or hobin+all+max+min.p2
     Args:
         block_str: a string representation of block arguments.
     Returns:
@@ -83,6 +100,9 @@ def _decode_block_str(block_str):
             else:
                 continue
             options[key] = value
+        elif op.startswith('ho'):
+            # higher-order activation fn
+            options['ho'] = _decode_ho_spec(op[2:].replace('+', '_'))
         else:
             # all numeric options
             splits = re.split(r'(\d.*)', op)
@@ -92,6 +112,7 @@ def _decode_block_str(block_str):
 
     # if act_layer is None, the model default (passed to model init) will be used
     act_layer = options['n'] if 'n' in options else None
+    ho_args = options['ho'] if 'ho' in options else None
     exp_kernel_size = _parse_ksize(options['a']) if 'a' in options else 1
     pw_kernel_size = _parse_ksize(options['p']) if 'p' in options else 1
     fake_in_chs = int(options['fc']) if 'fc' in options else 0  # FIXME hack to deal with in_chs issue in TPU def
@@ -109,6 +130,7 @@ def _decode_block_str(block_str):
             se_ratio=float(options['se']) if 'se' in options else None,
             stride=int(options['s']),
             act_layer=act_layer,
+            ho_args=ho_args,
             noskip=noskip,
         )
         if 'cc' in options:
@@ -122,6 +144,7 @@ def _decode_block_str(block_str):
             se_ratio=float(options['se']) if 'se' in options else None,
             stride=int(options['s']),
             act_layer=act_layer,
+            ho_args=ho_args,
             pw_act=block_type == 'dsa',
             noskip=block_type == 'dsa' or noskip,
         )
@@ -136,6 +159,7 @@ def _decode_block_str(block_str):
             se_ratio=float(options['se']) if 'se' in options else None,
             stride=int(options['s']),
             act_layer=act_layer,
+            ho_args=ho_args,
             noskip=noskip,
         )
     elif block_type == 'cn':
@@ -145,6 +169,7 @@ def _decode_block_str(block_str):
             out_chs=int(options['c']),
             stride=int(options['s']),
             act_layer=act_layer,
+            ho_args=ho_args,
         )
     else:
         assert False, 'Unknown block type (%s)' % block_type
@@ -223,7 +248,7 @@ class EfficientNetBuilder:
                  output_stride=32, pad_type='', act_layer=None, se_kwargs=None,
                  norm_layer=nn.BatchNorm2d, norm_kwargs=None, drop_path_rate=0., feature_location='',
                  verbose=False, actfun='swish', p=1, k=2, g=1, partial_ho_actfun='',
-                 act_layer2=None):
+                 act_layer2=None, stage_actfuns=None):
         self.channel_multiplier = channel_multiplier
         self.channel_divisor = channel_divisor
         self.channel_min = channel_min
@@ -240,6 +265,8 @@ class EfficientNetBuilder:
         self.p = p
         self.k = k
         self.g = g
+        # per stage higher-order activation specs (see _decode_ho_spec), None or '' keeps the model default
+        self.stage_actfuns = stage_actfuns
         if feature_location == 'depthwise':
             # old 'depthwise' mode renamed 'expansion' to match TF impl, old expansion mode didn't make sense
             _logger.warning("feature_location=='depthwise' is deprecated, using 'expansion'")
@@ -255,6 +282,13 @@ class EfficientNetBuilder:
     def _round_channels(self, chs):
         return round_channels(chs, self.channel_multiplier, self.channel_divisor, self.channel_min)
 
+    def _ho_act_layer(self, ho_args):
+        actfun = ho_args.get('actfun', self.actfun)
+        if actfun == 'swish' or actfun == 'nswish':
+            return get_act_layer(actfun)
+        return resolve_ho_act_layer(
+            actfun, ho_args.get('p', self.p), ho_args.get('k', self.k), ho_args.get('g', self.g))
+
     def _make_block(self, ba, block_idx, block_count):
         drop_path_rate = self.drop_path_rate * block_idx / block_count
 
@@ -271,6 +305,13 @@ class EfficientNetBuilder:
         ba['act_layer'] = ba['act_layer'] if ba['act_layer'] is not None else self.act_layer
         ba['act_layer2'] = self.act_layer2
         ba['partial_ho_actfun'] = self.partial_ho_actfun
+        # block / stage higher-order activation spec overrides the model's (partial) higher-order act fn
+        ho_args = ba.pop('ho_args', None)
+        if ho_args is not None:
+            if self.partial_ho_actfun:
+                ba['act_layer2'] = self._ho_act_layer(ho_args)
+            else:
+                ba['act_layer'] = self._ho_act_layer(ho_args)
         assert ba['act_layer'] is not None
         if bt == 'ir':
             ba['drop_path_rate'] = drop_path_rate
@@ -328,6 +369,7 @@ class EfficientNetBuilder:
             _log_info_if('Stack: {}'.format(stack_idx), self.verbose)
             assert isinstance(stack_args, list)
 
+            stage_spec = self.stage_actfuns[stack_idx] if self.stage_actfuns else None
             blocks = []
             # each stack (stage of blocks) contains a list of block arguments
             for block_idx, block_args in enumerate(stack_args):
@@ -358,6 +400,9 @@ class EfficientNetBuilder:
                 if next_dilation != current_dilation:
                     current_dilation = next_dilation
 
+                if stage_spec and block_args.get('ho_args') is None:
+                    block_args['ho_args'] = _decode_ho_spec(stage_spec)
+
                 # create the block
                 block = self._make_block(block_args, total_block_idx, total_block_count)
                 blocks.append(block)
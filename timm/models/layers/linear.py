@@ -1,5 +1,7 @@
-""" Linear layer (alternate definition)
+""" Linear layers (alternate definition, grouped)
 """
+import math
+
 import torch
 import torch.nn.functional as F
 from torch import nn as nn
@@ -17,3 +19,66 @@ class Linear(nn.Linear):
             return F.linear(input, self.weight.to(dtype=input.dtype), bias=bias)
         else:
             return F.linear(input, self.weight, self.bias)
+
+
+class GroupedLinear(nn.Module):
+    r"""Block-diagonal linear layer, splits the input features into groups and applies a separate linear
+    transformation to each: :math:`y_i = x_i A_i + b_i`
+
+    All groups run in a single batched matmul. The weight is stored as (groups, in_features / groups,
+    out_features / groups) and the bias as (out_features,). Per-group nn.Linear weights, as saved by a ModuleList
+    of nn.Linear under the same name ('0.weight', '0.bias', '1.weight', ...), are converted when loaded.
+    Trailing input features that don't fill a group are ignored, like slicing the input per group would.
+    """
+    __constants__ = ['in_features', 'out_features', 'groups', 'in_group_features']
+
+    def __init__(self, in_features, out_features, groups=1, bias=True):
+        super(GroupedLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.groups = groups
+        self.in_group_features = in_features // groups
+        self.weight = nn.Parameter(torch.empty(groups, self.in_group_features, out_features // groups))
+        if bias:
+            self.bias = nn.Parameter(torch.empty(self.weight.shape[0] * self.weight.shape[2]))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same as the nn.Linear default init of each group
+        bound = 1 / math.sqrt(self.in_group_features) if self.in_group_features > 0 else 0
+        nn.init.uniform_(self.weight, -bound, bound)
+        if self.bias is not None:
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        if input.shape[1] != self.groups * self.in_group_features:
+            input = input[:, :self.groups * self.in_group_features]
+        if self.groups == 1:
+            out = torch.mm(input, self.weight[0])
+        else:
+            x = input.reshape(input.shape[0], self.groups, self.in_group_features).transpose(0, 1)
+            out = torch.bmm(x, self.weight).transpose(0, 1).reshape(input.shape[0], -1)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        if prefix + 'weight' not in state_dict and prefix + '0.weight' in state_dict:
+            weights, biases = [], []
+            for group in range(self.groups):
+                weights.append(state_dict.pop('{}{}.weight'.format(prefix, group)).t())
+                bias = state_dict.pop('{}{}.bias'.format(prefix, group), None)
+                if bias is not None:
+                    biases.append(bias)
+            state_dict[prefix + 'weight'] = torch.stack(weights)
+            if biases:
+                state_dict[prefix + 'bias'] = torch.cat(biases)
+        super(GroupedLinear, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, groups={}, bias={}'.format(
+            self.in_features, self.out_features, self.groups, self.bias is not None)
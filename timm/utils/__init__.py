@@ -1,10 +1,12 @@
 from .checkpoint_saver import CheckpointSaver
 from .cuda import ApexScaler, NativeScaler
 from .distributed import distribute_bn, reduce_tensor
+from .fuse import fuse_bn, fuse_model
 from .jit import set_jit_legacy
 from .log import setup_default_logging, FormatterNoInfo
-from .metrics import AverageMeter, accuracy
+from .metrics import AverageMeter, MetricAccumulator, accuracy
 from .misc import natural_key, add_bool_arg
 from .model import unwrap_model, get_state_dict
 from .model_ema import ModelEma, ModelEmaV2
+from .quantize import prepare_int8, calibrate_int8, convert_int8, quantize_int8
 from .summary import update_summary, get_outdir
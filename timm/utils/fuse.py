@@ -0,0 +1,135 @@
+""" Conv / Linear + BatchNorm fusion for inference
+"""
+import torch
+import torch.nn as nn
+
+from timm.models.layers import GroupedLinear
+
+# (conv / linear, batch norm) submodule pairs to fuse, per module class name. Paths are relative to the module and
+# pairs whose modules are missing or whose channels don't line up are skipped.
+_FUSE_PAIRS = {
+    'EfficientNet': [('conv_stem', 'bn1'), ('conv_head', 'bn2')],
+    'EfficientNetFeatures': [('conv_stem', 'bn1')],
+    'ConvBnAct': [('conv', 'bn1')],
+    'DepthwiseSeparableConv': [('conv_dw', 'bn1'), ('conv_pw', 'bn2')],
+    'InvertedResidual': [('conv_pw', 'bn1'), ('conv_dw', 'bn2'), ('conv_pwl', 'bn3')],
+    'EdgeResidual': [('conv_exp', 'bn1'), ('conv_pwl', 'bn2')],
+    'ResNet': [('conv1', 'bn1')],
+    'BasicBlock': [('conv1', 'bn1'), ('conv2', 'bn2')],
+    'Bottleneck': [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+    'MLP': [('linear_layers.l1', 'batch_norms.l1'), ('linear_layers.l2', 'batch_norms.l2')],
+}
+
+
+def _get_submodule(module, path):
+    for name in path.split('.'):
+        module = getattr(module, name, None)
+        if module is None:
+            return None
+    return module
+
+
+def _set_submodule(module, path, new_module):
+    parent_path, _, name = path.rpartition('.')
+    parent = _get_submodule(module, parent_path) if parent_path else module
+    # carry over forward hooks (e.g. registered by FeatureHooks) so feature extraction keeps working
+    old_module = parent._modules[name]
+    new_module._forward_hooks.update(old_module._forward_hooks)
+    new_module._forward_pre_hooks.update(old_module._forward_pre_hooks)
+    parent._modules[name] = new_module
+
+
+def _can_fuse(layer, norm):
+    # exact types, subclasses such as BatchNormAct2d also apply an activation that would be dropped with the norm
+    if type(norm) not in (nn.BatchNorm1d, nn.BatchNorm2d) or not norm.track_running_stats:
+        return False
+    if isinstance(layer, nn.Conv2d):
+        return layer.out_channels == norm.num_features
+    if isinstance(layer, (nn.Linear, GroupedLinear)):
+        return layer.out_features == norm.num_features
+    return False
+
+
+def fuse_bn(layer, norm):
+    """ Fold the (eval mode) batch norm norm into the weight and bias of the conv / linear layer before it """
+    with torch.no_grad():
+        scale = norm.running_var.add(norm.eps).rsqrt()
+        if norm.affine:
+            scale = scale * norm.weight
+        shift = -norm.running_mean * scale
+        if norm.affine:
+            shift = shift + norm.bias
+        bias = layer.bias if layer.bias is not None else torch.zeros_like(norm.running_mean)
+        if isinstance(layer, GroupedLinear):
+            # output features are the last weight dim, split across the groups
+            weight_scale = scale.reshape(layer.groups, 1, -1)
+        else:
+            weight_scale = scale.reshape(-1, *([1] * (layer.weight.dim() - 1)))
+        layer.weight = nn.Parameter(layer.weight * weight_scale)
+        layer.bias = nn.Parameter(bias * scale + shift)
+    return layer
+
+
+def _fuse_sequential(seq):
+    names = list(seq._modules.keys())
+    for layer_name, norm_name in zip(names[:-1], names[1:]):
+        if _can_fuse(seq._modules[layer_name], seq._modules[norm_name]):
+            fuse_bn(seq._modules[layer_name], seq._modules[norm_name])
+            _set_submodule(seq, norm_name, nn.Identity())
+
+
+def _model_outputs(model, inputs):
+    with torch.no_grad():
+        outputs = model(inputs)
+    return list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+
+
+def fuse_model(model, validate=True, input_size=None, batch_size=2, rtol=1e-3, atol=1e-4):
+    """ Fold every batch norm that directly follows a conv / linear layer into it, for inference
+
+    Fuses the conv-BN pairs of EfficientNet / MobileNet blocks (ConvBnAct, DepthwiseSeparableConv,
+    InvertedResidual, EdgeResidual), ResNet BasicBlock / Bottleneck, the stems and heads of these models, the
+    linear-BatchNorm1d pairs of MLP and adjacent conv, BN pairs in nn.Sequential containers (ResNet downsample,
+    deep stems). Fused BNs are replaced by nn.Identity, so module names, and any hooks registered on them
+    (FeatureHookNet, features_only models), stay in place. The model is put in eval mode and modified in place.
+
+    Args:
+        model: model to fuse
+        validate: compare the outputs on random inputs before and after fusion, raising a ValueError on mismatch
+        input_size: input size (without batch dim) for validation, defaults to model.default_cfg['input_size']
+            or (model.input_dim,) for MLPs
+        batch_size: validation batch size
+        rtol, atol: validation tolerances
+
+    Returns:
+        the fused model
+    """
+    model.eval()
+    if validate:
+        if input_size is None:
+            if hasattr(model, 'default_cfg') and 'input_size' in model.default_cfg:
+                input_size = model.default_cfg['input_size']
+            elif hasattr(model, 'input_dim'):
+                input_size = (model.input_dim,)
+            else:
+                raise ValueError('input_size must be given to validate models without a default_cfg')
+        param = next(model.parameters())
+        inputs = torch.randn((batch_size,) + tuple(input_size), device=param.device, dtype=param.dtype)
+        expected = _model_outputs(model, inputs)
+
+    for module in list(model.modules()):
+        for layer_path, norm_path in _FUSE_PAIRS.get(type(module).__name__, []):
+            layer, norm = _get_submodule(module, layer_path), _get_submodule(module, norm_path)
+            if _can_fuse(layer, norm):
+                fuse_bn(layer, norm)
+                _set_submodule(module, norm_path, nn.Identity())
+        if isinstance(module, nn.Sequential):
+            _fuse_sequential(module)
+
+    if validate:
+        outputs = _model_outputs(model, inputs)
+        for out, exp in zip(outputs, expected):
+            if out.shape != exp.shape or not torch.allclose(out, exp, rtol=rtol, atol=atol):
+                raise ValueError('Fused model outputs differ from the original (max abs diff {:.3e})'.format(
+                    (out - exp).abs().max().item() if out.shape == exp.shape else float('inf')))
+    return model
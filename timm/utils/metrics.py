@@ -2,6 +2,10 @@
 
 Hacked together by / Copyright 2020 Ross Wightman
 """
+from collections import OrderedDict
+
+import torch
+import torch.distributed as dist
 
 
 class AverageMeter:
@@ -30,3 +34,95 @@ def accuracy(output, target, topk=(1,)):
     pred = pred.t()
     correct = pred.eq(target.reshape(1, -1).expand_as(pred))
     return [correct[:k].reshape(-1).float().sum(0) * 100. / batch_size for k in topk]
+
+
+class MetricAccumulator:
+    """Accumulates the loss, top-k correct predictions and (optionally) confusion matrix of a loop on device
+
+    Updates detach their inputs and never copy to the host, so the loop isn't synced and no autograd graph is kept
+    alive. Results are copied to the host by compute(), once per call, e.g. at log steps and at the end of an epoch.
+    Targets that aren't class indices (e.g. mixup / cutmix soft targets) only count towards the loss.
+    """
+    def __init__(self, topk=(1,), num_classes=None):
+        self.topk = tuple(topk)
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = None
+        self.correct = None
+        self.confusion = None
+        self.loss_count = 0
+        self.scored = 0
+        self._last = (None, None, 0, 0)
+
+    def update(self, loss=None, output=None, target=None, n=None):
+        """ Add a batch, loss is the batch mean loss, n the batch size (default: size of target / output) """
+        if n is None:
+            n = target.size(0) if target is not None else output.size(0)
+        loss_sum = correct = None
+        with torch.no_grad():
+            if loss is not None:
+                loss_sum = loss.detach().float() * n
+                self.loss_sum = loss_sum if self.loss_sum is None else self.loss_sum + loss_sum
+                self.loss_count += n
+            if output is not None and target is not None and target.dim() == 1:
+                output = output.detach()
+                maxk = min(max(self.topk), output.size(1))
+                _, pred = output.topk(maxk, 1, True, True)
+                # predictions are unique per row, so the cumulative sum counts hits within the top k
+                hits = pred.eq(target.reshape(-1, 1)).float().cumsum(1).sum(0)
+                correct = hits[[min(k, maxk) - 1 for k in self.topk]]
+                self.correct = correct if self.correct is None else self.correct + correct
+                self.scored += target.size(0)
+                if self.num_classes is not None:
+                    confusion = torch.bincount(
+                        target * self.num_classes + pred[:, 0], minlength=self.num_classes ** 2
+                    ).reshape(self.num_classes, self.num_classes)
+                    self.confusion = confusion if self.confusion is None else self.confusion + confusion
+        self._last = (loss_sum, correct, n if loss_sum is not None else 0, target.size(0) if correct is not None else 0)
+
+    def compute(self, last=False):
+        """ Loss average, top-k accuracies (in percent) and sample count, of everything or of the last batch only """
+        loss_sum, correct, loss_count, scored = self._last if last else (
+            self.loss_sum, self.correct, self.loss_count, self.scored)
+        values = []
+        if loss_sum is not None:
+            values.append(loss_sum.reshape(1) / loss_count)
+        if correct is not None:
+            values.append(correct * (100. / scored))
+        values = torch.cat(values).tolist() if values else []  # the only host sync
+
+        metrics = OrderedDict()
+        if loss_sum is not None:
+            metrics['loss'] = values.pop(0)
+        if correct is not None:
+            for k in self.topk:
+                metrics['top{}'.format(k)] = values.pop(0)
+        metrics['count'] = max(loss_count, scored)
+        return metrics
+
+    def confusion_matrix(self):
+        """ (num_classes, num_classes) counts, rows are targets and columns top-1 predictions """
+        return self.confusion.cpu() if self.confusion is not None else None
+
+    def all_reduce(self):
+        """ Sum the accumulated values over all distributed processes """
+        device = next(t for t in (self.loss_sum, self.correct) if t is not None).device
+        flat = [torch.tensor([float(self.loss_count), float(self.scored)], device=device)]
+        if self.loss_sum is not None:
+            flat.append(self.loss_sum.reshape(1))
+        if self.correct is not None:
+            flat.append(self.correct)
+        flat = torch.cat(flat)
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        self.loss_count, self.scored = int(flat[0].item()), int(flat[1].item())
+        offset = 2
+        if self.loss_sum is not None:
+            self.loss_sum = flat[offset]
+            offset += 1
+        if self.correct is not None:
+            self.correct = flat[offset:]
+        if self.confusion is not None:
+            dist.all_reduce(self.confusion, op=dist.ReduceOp.SUM)
+        return self
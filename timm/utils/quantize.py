@@ -0,0 +1,123 @@
+""" Int8 post-training quantization for CPU inference
+
+Eager mode (torch.quantization) static quantization of EfficientNet / MobileNet style models, including models with
+higher-order activations. Convs and linears are quantized, selection actfuns (max, min, linf, median, groupsort) run
+on the int8 tensors directly, and the ops that have no quantized implementation run in float between a local
+dequantize and a calibrated requantize.
+"""
+import torch
+import torch.nn as nn
+import torch.quantization as tq
+
+from activation_functions import HigherOrderActivation
+from timm.models.efficientnet_blocks import SqueezeExcite, DepthwiseSeparableConv, InvertedResidual, EdgeResidual
+from .fuse import fuse_model
+
+# Leaf modules that have a quantized implementation, or run on quantized tensors as is. Any other leaf module, and
+# squeeze-excite (its forward uses a mean and a gating multiply), is run in float.
+_QUANTIZED_LEAF_TYPES = (
+    nn.Conv2d, nn.Linear, nn.ReLU, nn.ReLU6, nn.Identity, nn.Dropout, nn.Flatten, nn.BatchNorm2d,
+    nn.AdaptiveAvgPool2d, nn.AvgPool2d, nn.MaxPool2d, nn.quantized.FloatFunctional, tq.QuantStub, tq.DeQuantStub)
+if hasattr(nn, 'Hardswish'):
+    _QUANTIZED_LEAF_TYPES += (nn.Hardswish,)
+
+
+class FloatModule(nn.Module):
+    """ Runs module in float inside a quantized model, with a calibrated requantize of its output """
+
+    def __init__(self, module):
+        super(FloatModule, self).__init__()
+        self.dequant = tq.DeQuantStub()
+        self.module = module
+        self.module.qconfig = None  # keep everything inside in float
+        self.quant = tq.QuantStub()
+
+    def forward(self, x):
+        return self.quant(self.module(self.dequant(x)))
+
+
+class QuantizableResidual(nn.Module):
+    """ Runs a residual block with its skip connection added through a FloatFunctional, so the add can be quantized
+
+    The block's own in-place residual add is turned off, float models are left as they are.
+    """
+
+    def __init__(self, block):
+        super(QuantizableResidual, self).__init__()
+        block.has_residual = False
+        self.block = block
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        return self.skip_add.add(self.block(x), x)
+
+
+def _wrap_residual_blocks(module):
+    for name, child in module.named_children():
+        if isinstance(child, (DepthwiseSeparableConv, InvertedResidual, EdgeResidual)) and child.has_residual:
+            setattr(module, name, QuantizableResidual(child))
+        else:
+            _wrap_residual_blocks(child)
+
+
+def _runs_in_float(module):
+    if isinstance(module, HigherOrderActivation):
+        return not module.supports_quantized()
+    if isinstance(module, SqueezeExcite):
+        return True
+    return len(module._modules) == 0 and not isinstance(module, _QUANTIZED_LEAF_TYPES)
+
+
+def _wrap_float_modules(module):
+    for name, child in module.named_children():
+        if _runs_in_float(child):
+            setattr(module, name, FloatModule(child))
+        elif not isinstance(child, HigherOrderActivation):
+            _wrap_float_modules(child)
+
+
+def prepare_int8(model, backend='fbgemm'):
+    """ Prepare a (float, eval mode) model for int8 post-training static quantization on CPU
+
+    Folds BatchNorm into the convs (see fuse_model), moves the residual adds of the blocks into a
+    QuantizableResidual, wraps every module that can't run on quantized tensors in a FloatModule and inserts
+    observers. Feed a few batches of calibration data through the returned model
+    (see calibrate_int8), then call convert_int8.
+
+    Args:
+        model: float model, it's modified in place
+        backend: quantized engine, 'fbgemm' (x86) or 'qnnpack' (ARM)
+
+    Returns:
+        the model wrapped with input quantize / output dequantize stubs, with observers
+    """
+    torch.backends.quantized.engine = backend
+    model = fuse_model(model.cpu().eval(), validate=False)
+    _wrap_residual_blocks(model)
+    _wrap_float_modules(model)
+    model = tq.QuantWrapper(model)
+    model.qconfig = tq.get_default_qconfig(backend)
+    return tq.prepare(model, inplace=True)
+
+
+def calibrate_int8(model, loader, num_batches=10):
+    """ Record activation ranges of a prepared model over num_batches batches of (input, target) from loader """
+    model.eval()
+    with torch.no_grad():
+        for batch_idx, (input, _) in enumerate(loader):
+            if batch_idx >= num_batches:
+                break
+            model(input.cpu())
+    return model
+
+
+def convert_int8(model):
+    """ Swap the observed modules of a prepared and calibrated model for their int8 versions """
+    return tq.convert(model.eval(), inplace=True)
+
+
+def quantize_int8(model, loader, num_batches=10, backend='fbgemm'):
+    """ Prepare, calibrate on num_batches batches from loader and convert model to int8, see prepare_int8 """
+    model = prepare_int8(model, backend=backend)
+    calibrate_int8(model, loader, num_batches)
+    return convert_int8(model)
@@ -24,7 +24,6 @@ from contextlib import suppress
 from datetime import datetime
 import csv
 import os
-from shutil import copyfile
 import sys
 
 import torch
@@ -32,7 +31,8 @@ import torch.nn as nn
 import torchvision.utils
 from torch.nn.parallel import DistributedDataParallel as NativeDDP
 
-from timm.data import Dataset, create_loader, resolve_data_config, Mixup, FastCollateMixup, AugMixDataset
+from timm.data import Dataset, create_loader, resolve_data_config, Mixup, FastCollateMixup, AugMixDataset, \
+    create_feature_cache_loader, create_split_manifest
 from timm.models import create_model, resume_checkpoint, load_checkpoint, convert_splitbn_model
 from timm.utils import *
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy, JsdCrossEntropy
@@ -282,6 +282,20 @@ parser.add_argument('--load-path', default='', type=str, metavar='PATH',
                     help='Path for loading initial checkpoints')
 parser.add_argument('--partial_ho_actfun', default='', type=str,
                     help='Tells network when to apply higher order activations only to specific blocks')
+parser.add_argument('--stage-actfuns', default=None, type=str, nargs='+', metavar='SPEC',
+                    help='Per stage higher order activation specs, e.g. swish swish swish max max.p2 max.p4 l2.p4 '
+                         '(use "" to keep the model default for a stage)')
+parser.add_argument('--grad-checkpointing', default='', type=str, choices=['', 'act', 'block'],
+                    help='Recompute higher order activations (act) or whole blocks (block) in backward to save memory')
+parser.add_argument('--feature-cache', default='', type=str, metavar='PATH',
+                    help='With --tl, cache the frozen backbone features of each split under PATH and train from them')
+parser.add_argument('--feature-cache-passes', type=int, default=1, metavar='N',
+                    help='Augmented passes of the train split to cache, epochs cycle through them (default: 1)')
+parser.add_argument('--split-manifest', default='', type=str, metavar='PATH',
+                    help='Load the train / val splits of the class folders in --data from this (path, label, split) '
+                         'CSV, it is created if missing (default: folders in --data/train and --data/val)')
+parser.add_argument('--split-seed', type=int, default=None, metavar='SEED',
+                    help='Seed to shuffle each class with when creating a split manifest (default: natural order)')
 
 
 def _parse_args():
@@ -383,53 +397,11 @@ def main():
         g=args.g,
         extra_channel_mult=args.extra_channel_mult,
         weight_init_name=args.weight_init,
-        partial_ho_actfun=args.partial_ho_actfun
+        partial_ho_actfun=args.partial_ho_actfun,
+        stage_actfuns=args.stage_actfuns,
+        grad_checkpointing=args.grad_checkpointing
     )
 
-    if args.tl:
-        if args.data == 'caltech101' and not os.path.exists('caltech101'):
-            dir_root = r'101_ObjectCategories'
-            dir_new = r'caltech101'
-            dir_new_train = os.path.join(dir_new, 'train')
-            dir_new_val = os.path.join(dir_new, 'val')
-            dir_new_test = os.path.join(dir_new, 'test')
-            if not os.path.exists(dir_new):
-                os.mkdir(dir_new)
-                os.mkdir(dir_new_train)
-                os.mkdir(dir_new_val)
-                os.mkdir(dir_new_test)
-
-            for dir2 in os.listdir(dir_root):
-                if dir2 != 'BACKGROUND_Google':
-                    curr_path = os.path.join(dir_root, dir2)
-                    new_path_train = os.path.join(dir_new_train, dir2)
-                    new_path_val = os.path.join(dir_new_val, dir2)
-                    new_path_test = os.path.join(dir_new_test, dir2)
-                    if not os.path.exists(new_path_train):
-                        os.mkdir(new_path_train)
-                    if not os.path.exists(new_path_val):
-                        os.mkdir(new_path_val)
-                    if not os.path.exists(new_path_test):
-                        os.mkdir(new_path_test)
-
-                    train_upper = int(0.8 * len(os.listdir(curr_path)))
-                    val_upper = int(0.9 * len(os.listdir(curr_path)))
-                    curr_files_all = os.listdir(curr_path)
-                    curr_files_train = curr_files_all[:train_upper]
-                    curr_files_val = curr_files_all[train_upper:val_upper]
-                    curr_files_test = curr_files_all[val_upper:]
-
-                    for file in curr_files_train:
-                        copyfile(os.path.join(curr_path, file),
-                                 os.path.join(new_path_train, file))
-                    for file in curr_files_val:
-                        copyfile(os.path.join(curr_path, file),
-                                 os.path.join(new_path_val, file))
-                    for file in curr_files_test:
-                        copyfile(os.path.join(curr_path, file),
-                                 os.path.join(new_path_test, file))
-        time.sleep(5)
-
     if args.tl:
         pre_model = create_model(
             args.model,
@@ -607,19 +579,32 @@ def main():
             mixup_fn = Mixup(**mixup_args)
 
     # create the train and eval datasets
-    train_dir = os.path.join(args.data, 'train')
-    if not os.path.exists(train_dir):
-        _logger.error('Training folder does not exist at: {}'.format(train_dir))
-        exit(1)
-    dataset_train = Dataset(train_dir)
-
-    eval_dir = os.path.join(args.data, 'val')
-    if not os.path.isdir(eval_dir):
-        eval_dir = os.path.join(args.data, 'validation')
-        if not os.path.isdir(eval_dir):
-            _logger.error('Validation folder does not exist at: {}'.format(eval_dir))
+    data_root = args.data
+    if args.data == 'caltech101' and not os.path.isdir(args.data):
+        # caltech101 ships without splits, split its class folders in place through a manifest
+        data_root = '101_ObjectCategories'
+        args.split_manifest = args.split_manifest or 'caltech101_split{}.csv'.format(
+            '' if args.split_seed is None else '_{}'.format(args.split_seed))
+    if args.split_manifest:
+        if not os.path.exists(args.split_manifest):
+            create_split_manifest(data_root, args.split_manifest, seed=args.split_seed,
+                                  exclude=['BACKGROUND_Google'] if args.data == 'caltech101' else ())
+        dataset_train = Dataset(data_root, manifest=args.split_manifest, split='train')
+        dataset_eval = Dataset(data_root, manifest=args.split_manifest, split='val')
+    else:
+        train_dir = os.path.join(args.data, 'train')
+        if not os.path.exists(train_dir):
+            _logger.error('Training folder does not exist at: {}'.format(train_dir))
             exit(1)
-    dataset_eval = Dataset(eval_dir)
+        dataset_train = Dataset(train_dir)
+
+        eval_dir = os.path.join(args.data, 'val')
+        if not os.path.isdir(eval_dir):
+            eval_dir = os.path.join(args.data, 'validation')
+            if not os.path.isdir(eval_dir):
+                _logger.error('Validation folder does not exist at: {}'.format(eval_dir))
+                exit(1)
+        dataset_eval = Dataset(eval_dir)
 
     # wrap dataset in AugMix helper
     if num_aug_splits > 1:
@@ -672,6 +657,20 @@ def main():
         pin_memory=args.pin_mem,
     )
 
+    if args.tl and args.feature_cache:
+        # run the frozen backbone once per split (and augmentation pass), then train the head from the stored features
+        assert not args.distributed, 'Feature cache is not supported in distributed mode'
+        cache_extra = dict(model=args.model, mixup=mixup_args if mixup_active else None)
+        loader_train = create_feature_cache_loader(
+            pre_model, loader_train, args.feature_cache, args.batch_size, is_training=True,
+            num_passes=args.feature_cache_passes, seed=args.seed, extra=dict(cache_extra, split='train'),
+            amp_autocast=amp_autocast, batch_fn=mixup_fn)
+        loader_eval = create_feature_cache_loader(
+            pre_model, loader_eval, args.feature_cache, args.validation_batch_size_multiplier * args.batch_size,
+            seed=args.seed, extra=dict(cache_extra, split='eval'), amp_autocast=amp_autocast)
+        pre_model = None
+        mixup_fn = None
+
     # setup learning rate schedule and starting epoch
     lr_scheduler, num_epochs = create_scheduler(args, optimizer, dataset_train)
     start_epoch = 0
@@ -757,6 +756,8 @@ def main():
 
             if args.distributed:
                 loader_train.sampler.set_epoch(epoch)
+            elif hasattr(loader_train, 'set_epoch'):
+                loader_train.set_epoch(epoch)
 
             train_metrics = train_epoch(
                 epoch, model, loader_train, optimizer, train_loss_fn, args,
@@ -834,7 +835,7 @@ def train_epoch(
         loss_scaler=None, model_ema=None, mixup_fn=None, pre_model=None):
 
     if args.mixup_off_epoch and epoch >= args.mixup_off_epoch:
-        if args.prefetcher and loader.mixup_enabled:
+        if args.prefetcher and getattr(loader, 'mixup_enabled', False):
             loader.mixup_enabled = False
         elif mixup_fn is not None:
             mixup_fn.mixup_enabled = False
@@ -842,11 +843,13 @@ def train_epoch(
     second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
     batch_time_m = AverageMeter()
     data_time_m = AverageMeter()
-    losses_m = AverageMeter()
+    metrics_m = MetricAccumulator()
+    loss_avg = None
 
     model.train()
 
     end = time.time()
+    log_end, log_idx = end, -1
     last_idx = len(loader) - 1
     num_updates = epoch * len(loader)
     for batch_idx, (input, target) in enumerate(loader):
@@ -856,7 +859,7 @@ def train_epoch(
             input, target = input.cuda(), target.cuda()
             if mixup_fn is not None:
                 input, target = mixup_fn(input, target)
-        if args.channels_last:
+        if args.channels_last and input.dim() == 4:
             input = input.contiguous(memory_format=torch.channels_last)
 
         with amp_autocast():
@@ -866,8 +869,7 @@ def train_epoch(
             output = model(input)
             loss = loss_fn(output, target)
 
-        if not args.distributed:
-            losses_m.update(loss.item(), input.size(0))
+        metrics_m.update(loss=loss, n=input.size(0))
 
         optimizer.zero_grad()
         if loss_scaler is not None:
@@ -882,22 +884,26 @@ def train_epoch(
         if model_ema is not None:
             model_ema.update(model)
 
-        torch.cuda.synchronize()
         num_updates += 1
-        batch_time_m.update(time.time() - end)
         lr = 0
         if last_batch or batch_idx % args.log_interval == 0:
+            # only sync with the device at log steps, batch time is averaged over the steps since the last one
+            torch.cuda.synchronize()
+            batch_time_m.update((time.time() - log_end) / (batch_idx - log_idx), batch_idx - log_idx)
+            log_end, log_idx = time.time(), batch_idx
             lrl = [param_group['lr'] for param_group in optimizer.param_groups]
             lr = sum(lrl) / len(lrl)
 
+            loss_val = loss.detach()
             if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
-                losses_m.update(reduced_loss.item(), input.size(0))
+                loss_val = reduce_tensor(loss_val, args.world_size)
+            loss_val = loss_val.item()
+            loss_avg = metrics_m.compute()['loss']
 
             if args.local_rank == 0:
                 _logger.info(
                     'Train: {} [{:>4d}/{} ({:>3.0f}%)]  '
-                    'Loss: {loss.val:>9.6f} ({loss.avg:>6.4f})  '
+                    'Loss: {loss_val:>9.6f} ({loss_avg:>6.4f})  '
                     'Time: {batch_time.val:.3f}s, {rate:>7.2f}/s  '
                     '({batch_time.avg:.3f}s, {rate_avg:>7.2f}/s)  '
                     'LR: {lr:.3e}  '
@@ -905,7 +911,8 @@ def train_epoch(
                         epoch,
                         batch_idx, len(loader),
                         100. * batch_idx / last_idx,
-                        loss=losses_m,
+                        loss_val=loss_val,
+                        loss_avg=loss_avg,
                         batch_time=batch_time_m,
                         rate=input.size(0) * args.world_size / batch_time_m.val,
                         rate_avg=input.size(0) * args.world_size / batch_time_m.avg,
@@ -926,7 +933,9 @@ def train_epoch(
         if args.sched == 'onecycle':
             lr_scheduler.step()
         elif lr_scheduler is not None:
-            lr_scheduler.step_update(num_updates=num_updates, metric=losses_m.avg)
+            # no scheduler uses the metric of per update steps (plateau steps on the eval metric per epoch), and
+            # the running loss would need a device sync every step, see MetricAccumulator
+            lr_scheduler.step_update(num_updates=num_updates, metric=None)
 
         end = time.time()
         # end for
@@ -934,18 +943,19 @@ def train_epoch(
     if hasattr(optimizer, 'sync_lookahead'):
         optimizer.sync_lookahead()
 
-    return OrderedDict([('loss', losses_m.avg), ('lr', lr)])
+    if args.distributed:
+        metrics_m.all_reduce()
+    return OrderedDict([('loss', metrics_m.compute()['loss']), ('lr', lr)])
 
 
 def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='', pre_model=None):
     batch_time_m = AverageMeter()
-    losses_m = AverageMeter()
-    top1_m = AverageMeter()
-    top5_m = AverageMeter()
+    metrics_m = MetricAccumulator(topk=(1, 5))
 
     model.eval()
 
     end = time.time()
+    log_idx = -1
     last_idx = len(loader) - 1
     with torch.no_grad():
         for batch_idx, (input, target) in enumerate(loader):
@@ -953,7 +963,7 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='',
             if not args.prefetcher:
                 input = input.cuda()
                 target = target.cuda()
-            if args.channels_last:
+            if args.channels_last and input.dim() == 4:
                 input = input.contiguous(memory_format=torch.channels_last)
 
             with amp_autocast():
@@ -971,35 +981,27 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='',
                 target = target[0:target.size(0):reduce_factor]
 
             loss = loss_fn(output, target)
-            acc1, acc5 = accuracy(output, target, topk=(1, 5))
-
-            if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
-                acc1 = reduce_tensor(acc1, args.world_size)
-                acc5 = reduce_tensor(acc5, args.world_size)
-            else:
-                reduced_loss = loss.data
+            metrics_m.update(loss=loss, output=output, target=target)
 
-            torch.cuda.synchronize()
-
-            losses_m.update(reduced_loss.item(), input.size(0))
-            top1_m.update(acc1.item(), output.size(0))
-            top5_m.update(acc5.item(), output.size(0))
-
-            batch_time_m.update(time.time() - end)
-            end = time.time()
             if args.local_rank == 0 and (last_batch or batch_idx % args.log_interval == 0):
+                # only sync with the device at log steps, batch time is averaged over the steps since the last one
+                torch.cuda.synchronize()
+                batch_time_m.update((time.time() - end) / (batch_idx - log_idx), batch_idx - log_idx)
+                end, log_idx = time.time(), batch_idx
+                val, avg = metrics_m.compute(last=True), metrics_m.compute()
                 log_name = 'Test' + log_suffix
                 _logger.info(
                     '{0}: [{1:>4d}/{2}]  '
                     'Time: {batch_time.val:.3f} ({batch_time.avg:.3f})  '
-                    'Loss: {loss.val:>7.4f} ({loss.avg:>6.4f})  '
-                    'Acc@1: {top1.val:>7.4f} ({top1.avg:>7.4f})  '
-                    'Acc@5: {top5.val:>7.4f} ({top5.avg:>7.4f})'.format(
-                        log_name, batch_idx, last_idx, batch_time=batch_time_m,
-                        loss=losses_m, top1=top1_m, top5=top5_m))
+                    'Loss: {val[loss]:>7.4f} ({avg[loss]:>6.4f})  '
+                    'Acc@1: {val[top1]:>7.4f} ({avg[top1]:>7.4f})  '
+                    'Acc@5: {val[top5]:>7.4f} ({avg[top5]:>7.4f})'.format(
+                        log_name, batch_idx, last_idx, batch_time=batch_time_m, val=val, avg=avg))
 
-    metrics = OrderedDict([('loss', losses_m.avg), ('top1', top1_m.avg), ('top5', top5_m.avg)])
+    if args.distributed:
+        metrics_m.all_reduce()
+    results = metrics_m.compute()
+    metrics = OrderedDict([('loss', results['loss']), ('top1', results['top1']), ('top5', results['top5'])])
 
     return metrics
 
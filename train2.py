@@ -23,7 +23,6 @@ from collections import OrderedDict
 from contextlib import suppress
 import csv
 import os
-from shutil import copyfile
 import sys
 
 import torch
@@ -31,7 +30,8 @@ import torch.nn as nn
 import torchvision.utils
 from torch.nn.parallel import DistributedDataParallel as NativeDDP
 
-from timm.data import Dataset, create_loader, resolve_data_config, Mixup, FastCollateMixup, AugMixDataset
+from timm.data import Dataset, create_loader, resolve_data_config, Mixup, FastCollateMixup, AugMixDataset, \
+    create_feature_cache_loader, create_split_manifest
 from timm.models import create_model, resume_checkpoint, load_checkpoint, convert_splitbn_model
 from timm.utils import *
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy, JsdCrossEntropy
@@ -44,6 +44,7 @@ from torch.optim.lr_scheduler import OneCycleLR
 import math
 import torch.nn.functional as F
 import datetime
+import itertools
 
 try:
     from apex import amp
@@ -286,6 +287,26 @@ parser.add_argument('--load-path', default='', type=str, metavar='PATH',
                     help='Path for loading initial checkpoints')
 parser.add_argument('--partial_ho_actfun', default='', type=str,
                     help='Tells network when to apply higher order activations only to specific blocks')
+parser.add_argument('--feature-cache', default='', type=str, metavar='PATH',
+                    help='Cache the frozen backbone features of each split under PATH and train from them')
+parser.add_argument('--feature-cache-passes', type=int, default=1, metavar='N',
+                    help='Augmented passes of the train split to cache, epochs cycle through them (default: 1)')
+parser.add_argument('--split-manifest', default='', type=str, metavar='PATH',
+                    help='Load the train / val splits of the class folders in --data from this (path, label, split) '
+                         'CSV, it is created if missing (default: folders in --data/train and --data/val)')
+parser.add_argument('--split-seed', type=int, default=None, metavar='SEED',
+                    help='Seed to shuffle each class with when creating a split manifest (default: natural order)')
+parser.add_argument('--sweep-actfuns', default='', type=str, metavar='ACTFUNS',
+                    help='Train one MLP head per actfun of this util.get_actfuns group (e.g. all_pk), all fed from '
+                         'the same backbone features')
+parser.add_argument('--sweep-p', default=None, type=int, nargs='+', metavar='p',
+                    help='Numbers of permutations to train heads for (default: --p)')
+parser.add_argument('--sweep-k', default=None, type=int, nargs='+', metavar='k',
+                    help='Group sizes to train heads for (default: --k)')
+parser.add_argument('--sweep-g', default=None, type=int, nargs='+', metavar='g',
+                    help='Inter layer group sizes to train heads for (default: --g)')
+parser.add_argument('--sweep-seeds', default=None, type=int, nargs='+', metavar='SEED',
+                    help='Head init seeds to train heads for (default: --seed), the data order is shared')
 
 
 def _parse_args():
@@ -305,6 +326,138 @@ def _parse_args():
     return args, args_text
 
 
+def _head_configs(args):
+    """ (actfun, p, k, g, seed) of every MLP head, the grid of the --sweep-* args """
+    actfuns = util.get_actfuns(args.sweep_actfuns) if args.sweep_actfuns else [args.actfun]
+    return list(itertools.product(actfuns, args.sweep_p or [args.p], args.sweep_k or [args.k],
+                                  args.sweep_g or [args.g], args.sweep_seeds or [args.seed]))
+
+
+def _create_head(args, actfun, p, k, g, seed, device):
+    util.seed_all(seed)
+    model = MLP.MLP(actfun=actfun,
+                    input_dim=1280,
+                    output_dim=args.num_classes,
+                    k=k,
+                    p=p,
+                    g=g,
+                    num_params=1_000_000,
+                    permute_type='shuffle')
+    model.to(device)
+    return {'actfun': actfun, 'p': p, 'k': k, 'g': g, 'seed': seed, 'model': model}
+
+
+_NORM_BUFFERS = ('.running_mean', '.running_var', '.num_batches_tracked')
+
+
+def _upgrade_head_checkpoint(head_checkpoint):
+    """
+    Converts the optimizer state of a head checkpoint saved while the MLP's second layer was a list of per group
+    nn.Linear layers to the GroupedLinear parameters (GroupedLinear._load_from_state_dict converts the weights)
+    """
+    model_state = head_checkpoint['model_state_dict']
+    if 'linear_layers.l2.0.weight' not in model_state:
+        return head_checkpoint
+    # Adam(model.parameters()) state is indexed by parameter position, the state dict lists them in the same order
+    optimizer = head_checkpoint['optimizer']
+    param_group, = optimizer['param_groups']
+    names = [name for name in model_state if not name.endswith(_NORM_BUFFERS)]
+    old_state = {name: optimizer['state'].get(idx) for name, idx in zip(names, param_group['params'])}
+    new_names = []
+    for name in names:
+        if name.startswith('linear_layers.l2.'):
+            name = 'linear_layers.l2.' + name.rsplit('.', 1)[1]
+        if name not in new_names:
+            new_names.append(name)
+
+    state = {}
+    for idx, name in enumerate(new_names):
+        if name.startswith('linear_layers.l2.'):
+            suffix = '.' + name.rsplit('.', 1)[1]
+            group_states = [old_state[old_name] for old_name in names
+                            if old_name.startswith('linear_layers.l2.') and old_name.endswith(suffix)]
+            if any(group_state is None for group_state in group_states):
+                continue
+            state[idx] = {key: _merge_group_state([group_state[key] for group_state in group_states])
+                          for key in group_states[0]}
+        elif old_state[name] is not None:
+            state[idx] = old_state[name]
+    param_group = dict(param_group, params=list(range(len(new_names))))
+    return dict(head_checkpoint, optimizer=dict(optimizer, state=state, param_groups=[param_group]))
+
+
+def _merge_group_state(values):
+    # per group (out, in) weight and (out,) bias state to the (groups, in, out) weight and concatenated bias
+    if not torch.is_tensor(values[0]) or values[0].dim() == 0:
+        return values[0]
+    if values[0].dim() == 2:
+        return torch.stack([value.t() for value in values])
+    return torch.cat(values)
+
+
+def _load_checkpoint(checkpoint, pre_model, heads, device):
+    """ Restores the backbone and each head's model, optimizer and scheduler, returns the epoch to resume from """
+    pre_model.load_state_dict(checkpoint['pre_model_state_dict'])
+    pre_model.to(device)
+    # single head checkpoints keep the head state at the top level
+    for head, head_checkpoint in zip(heads, checkpoint.get('heads', [checkpoint])):
+        head_checkpoint = _upgrade_head_checkpoint(head_checkpoint)
+        head['model'].load_state_dict(head_checkpoint['model_state_dict'])
+        head['optimizer'].load_state_dict(head_checkpoint['optimizer'])
+        head['scheduler'].load_state_dict(head_checkpoint['scheduler'])
+        head['model'].to(device)
+    return checkpoint['epoch']
+
+
+def _run_heads(heads, backbone, loader, criterion, device, args, train=False):
+    """
+    One pass over loader that runs the backbone once per batch and feeds the features to every head. When train is
+    set, each head takes an optimizer and scheduler step per batch.
+    :return: list with the mean loss and the accuracy of each head
+    """
+    head_metrics = [MetricAccumulator() for _ in heads]
+    for batch_idx, (x, target) in enumerate(loader):
+        x, target = x.to(device), target.to(device)
+        with torch.no_grad():
+            if train and args.mix_pre:
+                with torch.cuda.amp.autocast():
+                    x = backbone(x)
+            else:
+                x = backbone(x)
+        for head_idx, (head, metrics) in enumerate(zip(heads, head_metrics)):
+            model, optimizer = head['model'], head['optimizer']
+            if not train:
+                with torch.no_grad():
+                    output = model(x)
+                    loss = criterion(output, target)
+            elif args.mix_pre:
+                optimizer.zero_grad()
+                with torch.cuda.amp.autocast():
+                    output = model(x)
+                    loss = criterion(output, target)
+                head['scaler'].scale(loss).backward()
+                head['scaler'].step(optimizer)
+                head['scaler'].update()
+            elif args.mix_pre_apex:
+                optimizer.zero_grad()
+                output = model(x)
+                loss = criterion(output, target)
+                with amp.scale_loss(loss, optimizer, loss_id=head_idx) as scaled_loss:
+                    scaled_loss.backward()
+                optimizer.step()
+            else:
+                optimizer.zero_grad()
+                output = model(x)
+                loss = criterion(output, target)
+                loss.backward()
+                optimizer.step()
+            if train:
+                head['scheduler'].step()
+            metrics.update(loss=loss, output=output, target=target)
+    results = [metrics.compute() for metrics in head_metrics]
+    return [(result['loss'], result.get('top1', 0.) / 100.) for result in results]
+
+
 def main():
     setup_default_logging()
     args, args_text = _parse_args()
@@ -358,75 +511,42 @@ def main():
     pre_model = torch.nn.Sequential(*pre_model_layers[:-1])
     pre_model.to(device)
 
-    model = MLP.MLP(actfun=args.actfun,
-                    input_dim=1280,
-                    output_dim=args.num_classes,
-                    k=args.k,
-                    p=args.p,
-                    g=args.g,
-                    num_params=1_000_000,
-                    permute_type='shuffle')
-    model.to(device)
+    # one MLP head per actfun / p / k / g / seed of the sweep, all trained from the same backbone features
+    heads = [_create_head(args, *config, device) for config in _head_configs(args)]
+    if len(heads) > 1:
+        _logger.info('Training {} heads: {}'.format(len(heads), ', '.join(
+            '{actfun} p={p} k={k} g={g} seed={seed}'.format(**head) for head in heads)))
 
     # ================================================================================= Loading dataset
     util.seed_all(args.seed)
-    if args.data == 'caltech101' and not os.path.exists('caltech101'):
-        dir_root = r'101_ObjectCategories'
-        dir_new = r'caltech101'
-        dir_new_train = os.path.join(dir_new, 'train')
-        dir_new_val = os.path.join(dir_new, 'val')
-        dir_new_test = os.path.join(dir_new, 'test')
-        if not os.path.exists(dir_new):
-            os.mkdir(dir_new)
-            os.mkdir(dir_new_train)
-            os.mkdir(dir_new_val)
-            os.mkdir(dir_new_test)
-
-        for dir2 in os.listdir(dir_root):
-            if dir2 != 'BACKGROUND_Google':
-                curr_path = os.path.join(dir_root, dir2)
-                new_path_train = os.path.join(dir_new_train, dir2)
-                new_path_val = os.path.join(dir_new_val, dir2)
-                new_path_test = os.path.join(dir_new_test, dir2)
-                if not os.path.exists(new_path_train):
-                    os.mkdir(new_path_train)
-                if not os.path.exists(new_path_val):
-                    os.mkdir(new_path_val)
-                if not os.path.exists(new_path_test):
-                    os.mkdir(new_path_test)
-
-                train_upper = int(0.8 * len(os.listdir(curr_path)))
-                val_upper = int(0.9 * len(os.listdir(curr_path)))
-                curr_files_all = os.listdir(curr_path)
-                curr_files_train = curr_files_all[:train_upper]
-                curr_files_val = curr_files_all[train_upper:val_upper]
-                curr_files_test = curr_files_all[val_upper:]
-
-                for file in curr_files_train:
-                    copyfile(os.path.join(curr_path, file),
-                             os.path.join(new_path_train, file))
-                for file in curr_files_val:
-                    copyfile(os.path.join(curr_path, file),
-                             os.path.join(new_path_val, file))
-                for file in curr_files_test:
-                    copyfile(os.path.join(curr_path, file),
-                             os.path.join(new_path_test, file))
-    time.sleep(5)
 
     # create the train and eval datasets
-    train_dir = os.path.join(args.data, 'train')
-    if not os.path.exists(train_dir):
-        _logger.error('Training folder does not exist at: {}'.format(train_dir))
-        exit(1)
-    dataset_train = Dataset(train_dir)
-
-    eval_dir = os.path.join(args.data, 'val')
-    if not os.path.isdir(eval_dir):
-        eval_dir = os.path.join(args.data, 'validation')
-        if not os.path.isdir(eval_dir):
-            _logger.error('Validation folder does not exist at: {}'.format(eval_dir))
+    data_root = args.data
+    if args.data == 'caltech101' and not os.path.isdir(args.data):
+        # caltech101 ships without splits, split its class folders in place through a manifest
+        data_root = '101_ObjectCategories'
+        args.split_manifest = args.split_manifest or 'caltech101_split{}.csv'.format(
+            '' if args.split_seed is None else '_{}'.format(args.split_seed))
+    if args.split_manifest:
+        if not os.path.exists(args.split_manifest):
+            create_split_manifest(data_root, args.split_manifest, seed=args.split_seed,
+                                  exclude=['BACKGROUND_Google'] if args.data == 'caltech101' else ())
+        dataset_train = Dataset(data_root, manifest=args.split_manifest, split='train')
+        dataset_eval = Dataset(data_root, manifest=args.split_manifest, split='val')
+    else:
+        train_dir = os.path.join(args.data, 'train')
+        if not os.path.exists(train_dir):
+            _logger.error('Training folder does not exist at: {}'.format(train_dir))
             exit(1)
-    dataset_eval = Dataset(eval_dir)
+        dataset_train = Dataset(train_dir)
+
+        eval_dir = os.path.join(args.data, 'val')
+        if not os.path.isdir(eval_dir):
+            eval_dir = os.path.join(args.data, 'validation')
+            if not os.path.isdir(eval_dir):
+                _logger.error('Validation folder does not exist at: {}'.format(eval_dir))
+                exit(1)
+        dataset_eval = Dataset(eval_dir)
 
     # setup augmentation batch splits for contrastive loss or split bn
     num_aug_splits = 0
@@ -437,7 +557,8 @@ def main():
     # enable split bn (separate bn stats per batch-portion)
     if args.split_bn:
         assert num_aug_splits > 1 or args.resplit
-        model = convert_splitbn_model(model, max(num_aug_splits, 2))
+        for head in heads:
+            head['model'] = convert_splitbn_model(head['model'], max(num_aug_splits, 2))
 
     # setup mixup / cutmix
     collate_fn = None
@@ -456,7 +577,7 @@ def main():
 
     # create data loaders w/ augmentation pipeline
     train_interpolation = args.train_interpolation
-    data_config = resolve_data_config(vars(args), model=model, verbose=args.local_rank == 0)
+    data_config = resolve_data_config(vars(args), model=heads[0]['model'], verbose=args.local_rank == 0)
     if args.no_aug or not train_interpolation:
         train_interpolation = data_config['interpolation']
     loader_train = create_loader(
@@ -504,13 +625,14 @@ def main():
 
     # ================================================================================= Optimizer / scheduler
     criterion = nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(model.parameters(), weight_decay=1e-5)
-    scheduler = OneCycleLR(optimizer,
-                           max_lr=args.lr,
-                           epochs=args.epochs,
-                           steps_per_epoch=int(math.floor(len(dataset_train) / args.batch_size)),
-                           cycle_momentum=False
-                           )
+    for head in heads:
+        head['optimizer'] = torch.optim.Adam(head['model'].parameters(), weight_decay=1e-5)
+        head['scheduler'] = OneCycleLR(head['optimizer'],
+                                       max_lr=args.lr,
+                                       epochs=args.epochs,
+                                       steps_per_epoch=int(math.floor(len(dataset_train) / args.batch_size)),
+                                       cycle_momentum=False
+                                       )
 
     # ================================================================================= Save file / checkpoints
     fieldnames = [
@@ -519,7 +641,8 @@ def main():
         'epoch_train_loss', 'epoch_train_acc', 'epoch_aug_train_loss', 'epoch_aug_train_acc',
         'epoch_val_loss', 'epoch_val_acc', 'curr_lr', 'found_lr', 'epochs'
     ]
-    filename = 'out_{}_{}_{}_{}'.format(datetime.date.today(), args.actfun, args.data, args.seed)
+    run_name = args.actfun if len(heads) == 1 else 'sweep'
+    filename = 'out_{}_{}_{}_{}'.format(datetime.date.today(), run_name, args.data, args.seed)
     outfile_path = os.path.join(args.output, filename) + '.csv'
     checkpoint_path = os.path.join(args.check_path, filename) + '.pth'
     if not os.path.exists(outfile_path):
@@ -530,195 +653,134 @@ def main():
     epoch = 1
     checkpoint = torch.load(checkpoint_path) if os.path.exists(checkpoint_path) else None
     if checkpoint is not None:
-        pre_model.load_state_dict(checkpoint['pre_model_state_dict'])
-        model.load_state_dict(checkpoint['model_state_dict'])
-        optimizer.load_state_dict(checkpoint['optimizer'])
-        scheduler.load_state_dict(checkpoint['scheduler'])
-        epoch = checkpoint['epoch']
-        pre_model.to(device)
-        model.to(device)
+        epoch = _load_checkpoint(checkpoint, pre_model, heads, device)
         print("*** LOADED CHECKPOINT ***"
               "\n{}"
               "\nSeed: {}"
               "\nEpoch: {}"
-              "\nActfun: {}"
-              "\np: {}"
-              "\nk: {}"
-              "\ng: {}"
-              "\nperm_method: {}".format(checkpoint_path, checkpoint['curr_seed'],
-                                         checkpoint['epoch'], checkpoint['actfun'],
-                                         checkpoint['p'], checkpoint['k'], checkpoint['g'],
+              "\nHeads: {}"
+              "\nperm_method: {}".format(checkpoint_path, checkpoint['curr_seed'], checkpoint['epoch'],
+                                         ', '.join('{actfun} p={p} k={k} g={g}'.format(**head_checkpoint)
+                                                   for head_checkpoint in checkpoint.get('heads', [checkpoint])),
                                          checkpoint['perm_method']))
 
+    # ================================================================================= Feature cache
+    # run the frozen backbone once per split (and augmentation pass), then train the heads from the stored features
+    backbone = pre_model
+    if args.feature_cache:
+        cache_autocast = torch.cuda.amp.autocast if args.control_amp == 'native' else suppress
+        cache_extra = dict(model=args.model, mixup=mixup_args if mixup_active else None)
+        loader_train = create_feature_cache_loader(
+            pre_model, loader_train, args.feature_cache, args.batch_size, is_training=True,
+            num_passes=args.feature_cache_passes, seed=args.seed, extra=dict(cache_extra, split='train'),
+            amp_autocast=cache_autocast)
+        loader_eval = create_feature_cache_loader(
+            pre_model, loader_eval, args.feature_cache, args.validation_batch_size_multiplier * args.batch_size,
+            seed=args.seed, extra=dict(cache_extra, split='eval'), amp_autocast=cache_autocast)
+        backbone = nn.Identity()
+
     args.mix_pre_apex = False
     if args.control_amp == 'apex':
         args.mix_pre_apex = True
-        model, optimizer = amp.initialize(model, optimizer, opt_level="O2")
+        models, optimizers = amp.initialize([head['model'] for head in heads], [head['optimizer'] for head in heads],
+                                            opt_level="O2", num_losses=len(heads))
+        for head, model, optimizer in zip(heads, models, optimizers):
+            head['model'], head['optimizer'] = model, optimizer
+    args.mix_pre = args.control_amp == 'native'
+    if args.mix_pre:
+        for head in heads:
+            head['scaler'] = torch.cuda.amp.GradScaler()
 
     # ================================================================================= Training
     while epoch <= args.epochs:
 
         if args.check_path != '':
             torch.save({'pre_model_state_dict': pre_model.state_dict(),
-                        'model_state_dict': model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                        'scheduler': scheduler.state_dict(),
+                        'heads': [{'model_state_dict': head['model'].state_dict(),
+                                   'optimizer': head['optimizer'].state_dict(),
+                                   'scheduler': head['scheduler'].state_dict(),
+                                   'actfun': head['actfun'],
+                                   'seed': head['seed'],
+                                   'p': head['p'], 'k': head['k'], 'g': head['g']} for head in heads],
                         'curr_seed': args.seed,
                         'epoch': epoch,
-                        'actfun': args.actfun,
-                        'p': args.p, 'k': args.k, 'g': args.g,
                         'perm_method': 'shuffle'
                         }, checkpoint_path)
 
         util.seed_all((args.seed * args.epochs) + epoch)
+        if hasattr(loader_train, 'set_epoch'):
+            loader_train.set_epoch(epoch - 1)
         start_time = time.time()
-        args.mix_pre = False
-        if args.control_amp == 'native':
-            args.mix_pre = True
-            scaler = torch.cuda.amp.GradScaler()
 
         # ---- Training
-        model.train()
-        total_train_loss, n, num_correct, num_total = 0, 0, 0, 0
-        for batch_idx, (x, targetx) in enumerate(loader_train):
-            x, targetx = x.to(device), targetx.to(device)
-            optimizer.zero_grad()
-            if args.mix_pre:
-                with torch.cuda.amp.autocast():
-                    with torch.no_grad():
-                        x = pre_model(x)
-                    output = model(x)
-                    train_loss = criterion(output, targetx)
-                total_train_loss += train_loss
-                n += 1
-                scaler.scale(train_loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
-            elif args.mix_pre_apex:
-                with torch.no_grad():
-                    x = pre_model(x)
-                output = model(x)
-                train_loss = criterion(output, targetx)
-                total_train_loss += train_loss
-                n += 1
-                with amp.scale_loss(train_loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-                optimizer.step()
-            else:
-                with torch.no_grad():
-                    x = pre_model(x)
-                output = model(x)
-                train_loss = criterion(output, targetx)
-                total_train_loss += train_loss
-                n += 1
-                train_loss.backward()
-                optimizer.step()
-            scheduler.step()
-            _, prediction = torch.max(output.data, 1)
-            num_correct += torch.sum(prediction == targetx.data)
-            num_total += len(prediction)
-        epoch_aug_train_loss = total_train_loss / n
-        epoch_aug_train_acc = num_correct * 1.0 / num_total
-
-        alpha_primes = []
-        alphas = []
-        if model.actfun == 'combinact':
-            for i, layer_alpha_primes in enumerate(model.all_alpha_primes):
-                curr_alpha_primes = torch.mean(layer_alpha_primes, dim=0)
-                curr_alphas = F.softmax(curr_alpha_primes, dim=0).data.tolist()
-                curr_alpha_primes = curr_alpha_primes.tolist()
-                alpha_primes.append(curr_alpha_primes)
-                alphas.append(curr_alphas)
-
-        model.eval()
+        for head in heads:
+            head['model'].train()
+        aug_train_metrics = _run_heads(heads, backbone, loader_train, criterion, device, args, train=True)
+
+        for head in heads:
+            head['model'].eval()
         with torch.no_grad():
-            total_val_loss, n, num_correct, num_total = 0, 0, 0, 0
-            for batch_idx, (y, targety) in enumerate(loader_eval):
-                y, targety = y.to(device), targety.to(device)
-                with torch.no_grad():
-                    y = pre_model(y)
-                output = model(y)
-                val_loss = criterion(output, targety)
-                total_val_loss += val_loss
-                n += 1
-                _, prediction = torch.max(output.data, 1)
-                num_correct += torch.sum(prediction == targety.data)
-                num_total += len(prediction)
-            epoch_val_loss = total_val_loss / n
-            epoch_val_acc = num_correct * 1.0 / num_total
-        lr_curr = 0
-        for param_group in optimizer.param_groups:
-            lr_curr = param_group['lr']
-        print(
-            "    Epoch {}: LR {:1.5f} ||| aug_train_acc {:1.4f} | val_acc {:1.4f} ||| "
-            "aug_train_loss {:1.4f} | val_loss {:1.4f} ||| time = {:1.4f}"
-                .format(epoch, lr_curr, epoch_aug_train_acc, epoch_val_acc,
-                        epoch_aug_train_loss, epoch_val_loss, (time.time() - start_time)),
-            flush=True
-        )
-
-        epoch_train_loss = 0
-        epoch_train_acc = 0
+            val_metrics = _run_heads(heads, backbone, loader_eval, criterion, device, args)
+
+        train_metrics = [(0, 0)] * len(heads)
         if epoch == args.epochs:
             with torch.no_grad():
-                total_train_loss, n, num_correct, num_total = 0, 0, 0, 0
-                for batch_idx, (x, targetx) in enumerate(loader_train):
-                    x, targetx = x.to(device), targetx.to(device)
-                    with torch.no_grad():
-                        x = pre_model(x)
-                    output = model(x)
-                    train_loss = criterion(output, targetx)
-                    total_train_loss += train_loss
-                    n += 1
-                    _, prediction = torch.max(output.data, 1)
-                    num_correct += torch.sum(prediction == targetx.data)
-                    num_total += len(prediction)
-                epoch_aug_train_loss = total_train_loss / n
-                epoch_aug_train_acc = num_correct * 1.0 / num_total
-
-                total_train_loss, n, num_correct, num_total = 0, 0, 0, 0
-                for batch_idx, (x, targetx) in enumerate(loader_eval):
-                    x, targetx = x.to(device), targetx.to(device)
-                    with torch.no_grad():
-                        x = pre_model(x)
-                    output = model(x)
-                    train_loss = criterion(output, targetx)
-                    total_train_loss += train_loss
-                    n += 1
-                    _, prediction = torch.max(output.data, 1)
-                    num_correct += torch.sum(prediction == targetx.data)
-                    num_total += len(prediction)
-                epoch_train_loss = total_val_loss / n
-                epoch_train_acc = num_correct * 1.0 / num_total
-
-        # Outputting data to CSV at end of epoch
-        with open(outfile_path, mode='a') as out_file:
-            writer = csv.DictWriter(out_file, fieldnames=fieldnames, lineterminator='\n')
-            writer.writerow({'dataset': args.data,
-                             'seed': args.seed,
-                             'epoch': epoch,
-                             'time': (time.time() - start_time),
-                             'actfun': model.actfun,
-                             'model': args.model,
-                             'batch_size': args.batch_size,
-                             'alpha_primes': alpha_primes,
-                             'alphas': alphas,
-                             'num_params': util.get_model_params(model),
-                             'k': args.k,
-                             'p': args.p,
-                             'g': args.g,
-                             'perm_method': 'shuffle',
-                             'gen_gap': float(epoch_val_loss - epoch_train_loss),
-                             'epoch_train_loss': float(epoch_train_loss),
-                             'epoch_train_acc': float(epoch_train_acc),
-                             'epoch_aug_train_loss': float(epoch_aug_train_loss),
-                             'epoch_aug_train_acc': float(epoch_aug_train_acc),
-                             'epoch_val_loss': float(epoch_val_loss),
-                             'epoch_val_acc': float(epoch_val_acc),
-                             'curr_lr': lr_curr,
-                             'found_lr': args.lr,
-                             'epochs': args.epochs
-                             })
+                aug_train_metrics = _run_heads(heads, backbone, loader_train, criterion, device, args)
+                train_metrics = _run_heads(heads, backbone, loader_eval, criterion, device, args)
+
+        epoch_time = time.time() - start_time
+        for head, (epoch_aug_train_loss, epoch_aug_train_acc), (epoch_val_loss, epoch_val_acc), \
+                (epoch_train_loss, epoch_train_acc) in zip(heads, aug_train_metrics, val_metrics, train_metrics):
+            model = head['model']
+            alpha_primes = []
+            alphas = []
+            if model.actfun == 'combinact':
+                for i, layer_alpha_primes in enumerate(model.all_alpha_primes):
+                    curr_alpha_primes = torch.mean(layer_alpha_primes, dim=0)
+                    curr_alphas = F.softmax(curr_alpha_primes, dim=0).data.tolist()
+                    curr_alpha_primes = curr_alpha_primes.tolist()
+                    alpha_primes.append(curr_alpha_primes)
+                    alphas.append(curr_alphas)
+
+            lr_curr = 0
+            for param_group in head['optimizer'].param_groups:
+                lr_curr = param_group['lr']
+            print(
+                "    Epoch {}: {} p={} k={} g={} seed={}: LR {:1.5f} ||| aug_train_acc {:1.4f} | val_acc {:1.4f} ||| "
+                "aug_train_loss {:1.4f} | val_loss {:1.4f} ||| time = {:1.4f}"
+                    .format(epoch, head['actfun'], head['p'], head['k'], head['g'], head['seed'], lr_curr,
+                            epoch_aug_train_acc, epoch_val_acc, epoch_aug_train_loss, epoch_val_loss, epoch_time),
+                flush=True
+            )
+
+            # Outputting data to CSV at end of epoch
+            with open(outfile_path, mode='a') as out_file:
+                writer = csv.DictWriter(out_file, fieldnames=fieldnames, lineterminator='\n')
+                writer.writerow({'dataset': args.data,
+                                 'seed': head['seed'],
+                                 'epoch': epoch,
+                                 'time': epoch_time,
+                                 'actfun': model.actfun,
+                                 'model': args.model,
+                                 'batch_size': args.batch_size,
+                                 'alpha_primes': alpha_primes,
+                                 'alphas': alphas,
+                                 'num_params': util.get_model_params(model),
+                                 'k': head['k'],
+                                 'p': head['p'],
+                                 'g': head['g'],
+                                 'perm_method': 'shuffle',
+                                 'gen_gap': float(epoch_val_loss - epoch_train_loss),
+                                 'epoch_train_loss': float(epoch_train_loss),
+                                 'epoch_train_acc': float(epoch_train_acc),
+                                 'epoch_aug_train_loss': float(epoch_aug_train_loss),
+                                 'epoch_aug_train_acc': float(epoch_aug_train_acc),
+                                 'epoch_val_loss': float(epoch_val_loss),
+                                 'epoch_val_acc': float(epoch_val_acc),
+                                 'curr_lr': lr_curr,
+                                 'found_lr': args.lr,
+                                 'epochs': args.epochs
+                                 })
 
         epoch += 1
 
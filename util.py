@@ -7,9 +7,11 @@ import torchvision.transforms as transforms
 import numpy as np
 import random
 import activation_functions as actfuns
+from timm.models.layers import GroupedLinear
 from collections import namedtuple
 import os
 import csv
+import copy
 
 try:
     from torch_lr_finder import LRFinder
@@ -140,6 +142,47 @@ def get_model_params(model):
     return pp
 
 
+def evaluate_accuracy(model, loader, pre_model=None, device=None):
+    """
+    :param model: Pytorch network model
+    :param loader: data loader to evaluate on
+    :param pre_model: optional frozen backbone applied to inputs before model
+    :param device: device to evaluate on
+    :return: top-1 accuracy of the model on the loader
+    """
+    model.eval()
+    num_correct, num_total = 0, 0
+    with torch.no_grad():
+        for x, target in loader:
+            x, target = x.to(device), target.to(device)
+            if pre_model is not None:
+                x = pre_model(x)
+            prediction = model(x).argmax(dim=1)
+            num_correct += int((prediction == target).sum())
+            num_total += len(target)
+    return num_correct / num_total
+
+
+def collapse_combinact(model, threshold=0.05, loader=None, pre_model=None, device=None):
+    """
+    Exports a trained combinact MLP for inference: each layer keeps only the actfuns whose alpha reaches threshold
+    in at least one cluster / permutation, and a layer left with a single actfun evaluates just that actfun.
+    :param model: trained combinact MLP, left unchanged
+    :param threshold: minimum alpha an actfun needs to be kept
+    :param loader: optional validation loader used to report the accuracy delta
+    :param pre_model: optional frozen backbone applied to inputs before model
+    :param device: device to evaluate on
+    :return: collapsed copy of the model, report of the kept / pruned actfuns and accuracies
+    """
+    collapsed = copy.deepcopy(model)
+    report = {'layers': collapsed.collapse_combinact(threshold)}
+    if loader is not None:
+        report['acc'] = evaluate_accuracy(model, loader, pre_model, device)
+        report['collapsed_acc'] = evaluate_accuracy(collapsed, loader, pre_model, device)
+        report['acc_delta'] = report['collapsed_acc'] - report['acc']
+    return collapsed, report
+
+
 def seed_all(seed=None, only_current_gpu=False, mirror_gpus=False):
     r"""
     Initialises the random number generators for random, numpy, and both CPU and GPU(s)
@@ -312,6 +355,10 @@ def linear_layer_params(in_dim, out_dim):
     return (in_dim + 1) * out_dim
 
 
+def grouped_linear_layer_params(in_dim, out_dim, g):
+    return g * linear_layer_params(int(in_dim / g), int(out_dim / g))
+
+
 def get_cnn_num_params(n, in_channels, out_channels, in_dim, pk_ratio, g):
     total_params = conv_layer_params(9, in_channels, n[0])
     total_params += conv_layer_params(9, (pk_ratio / g) * n[0], n[1])
@@ -320,9 +367,8 @@ def get_cnn_num_params(n, in_channels, out_channels, in_dim, pk_ratio, g):
     total_params += conv_layer_params(9, (pk_ratio / g) * n[2], n[3])
     total_params += conv_layer_params(9, (pk_ratio / g) * n[3], n[3])
 
-    for group in range(g):
-        total_params += linear_layer_params(int((n[3] * pk_ratio) * (int(in_dim / 8) ** 2) / g), int(n[5] / g))
-        total_params += linear_layer_params(int(n[5] * (pk_ratio / g)), int(n[4] / g))
+    total_params += grouped_linear_layer_params((n[3] * pk_ratio) * (int(in_dim / 8) ** 2), n[5], g)
+    total_params += grouped_linear_layer_params(n[5] * pk_ratio, n[4], g)
     total_params += linear_layer_params(int(n[4] * (pk_ratio / g)), int(out_channels))
 
     return total_params
@@ -352,21 +398,139 @@ def calc_cnn_preacts(required_num_params, in_channels, out_channels, in_dim, pk_
 
 
 def get_pk_ratio(actfun, p, k, g):
-    if actfun == 'groupsort':
-        pk_ratio = p
-    elif actfun == 'bin_part_full' or actfun == 'ail_part_full':
-        pk_ratio = (p * (2 + k)) / (3 * k)
-    elif actfun == 'bin_all_full' or actfun == 'ail_all_full':
-        pk_ratio = p * ((3 / k) + 1)
-    elif actfun == 'bin_all_max_min_sgm' or actfun == 'ail_all_or_and_xnor':
-        pk_ratio = p * ((3 / k))
-    elif actfun == 'bin_all_max_min' or actfun == 'ail_all_or_and':
-        pk_ratio = p * ((2 / k))
-    elif actfun == 'bin_all_max_sgm' or actfun == 'ail_all_or_xnor':
-        pk_ratio = p * ((2 / k))
+    return actfuns.get_pk_ratio(actfun, p, k, g)
+
+
+def _layer_cost(module, input_shape, output):
+    """
+    FLOPs and bytes of a conv / linear layer's forward and backward pass
+    :param module: nn.Conv2d, nn.Linear or GroupedLinear
+    :param input_shape: shape of the layer's input
+    :param output: output of the layer
+    :return: dict in the format of activation_functions.get_actfun_cost
+    """
+    element_size = output.element_size()
+    if isinstance(module, nn.Conv2d):
+        macs_per_output = (module.in_channels // module.groups) * module.kernel_size[0] * module.kernel_size[1]
+    elif isinstance(module, GroupedLinear):
+        macs_per_output = module.in_group_features
     else:
-        pk_ratio = (p / k)
-    return pk_ratio
+        macs_per_output = module.in_features
+    flops = 2 * macs_per_output * output.numel()
+    if module.bias is not None:
+        flops += output.numel()
+    num_in = int(np.prod(input_shape))
+    weight_bytes = sum(p.numel() for p in module.parameters(recurse=False)) * element_size
+    forward = {
+        'flops': flops,
+        'bytes_read': num_in * element_size + weight_bytes,
+        'bytes_written': output.numel() * element_size,
+        'intermediate_bytes': 0,
+    }
+    # Gradients w.r.t. the input and the weights each cost as much as the forward pass
+    backward = {
+        'flops': 2 * flops,
+        'bytes_read': (output.numel() + num_in) * element_size + weight_bytes,
+        'bytes_written': num_in * element_size + weight_bytes,
+        'intermediate_bytes': 0,
+        'saved_bytes': num_in * element_size,
+    }
+    return {'output_shape': tuple(output.shape), 'forward': forward, 'backward': backward}
+
+
+def get_model_cost(model, input_shape, device=None):
+    """
+    Walks an EfficientNet or MLP model with a dummy batch and totals the analytical cost of its higher-order
+    activations next to the cost of its conv and linear layers
+    :param model: EfficientNet (HigherOrderActivation modules) or MLP model
+    :param input_shape: shape of the model input, including the batch dimension
+    :param device: device to run the dummy batch on (defaults to the device of the model's parameters)
+    :return: dict with a 'layers' list (name, type, input shape and cost of every conv, linear and HOA layer) and
+             'totals' of forward / backward FLOPs and bytes per layer type
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    layers = []
+
+    def conv_linear_hook(name):
+        def hook(module, input, output):
+            cost = _layer_cost(module, tuple(input[0].shape), output)
+            layers.append(dict(name=name, type='conv' if isinstance(module, nn.Conv2d) else 'linear',
+                               input_shape=tuple(input[0].shape), **cost))
+        return hook
+
+    def hoa_hook(name):
+        def hook(module, input, output):
+            input_shape = tuple(input[0].shape)
+            cost = actfuns.get_actfun_cost(module.actfun, module.p, module.k, module.g, input_shape,
+                                           element_size=output.element_size())
+            layers.append(dict(name=name, type='hoa', input_shape=input_shape, **cost))
+        return hook
+
+    handles = []
+    for name, module in model.named_modules():
+        if isinstance(module, (nn.Conv2d, nn.Linear, GroupedLinear)):
+            handles.append(module.register_forward_hook(conv_linear_hook(name)))
+        elif isinstance(module, actfuns.HigherOrderActivation) and module.actfun is not None:
+            handles.append(module.register_forward_hook(hoa_hook(name)))
+
+    # MLP evaluates its activations through MLP.activate rather than through modules
+    mlp_activate = getattr(model, 'layer_actfuns', None) is not None and getattr(model, 'activate', None)
+    if mlp_activate:
+        def activate(x, layer):
+            cost = actfuns.get_actfun_cost(model.layer_actfuns[layer], model.layer_ps[layer], model.k, model.g,
+                                           tuple(x.shape), element_size=x.element_size())
+            layers.append(dict(name='activate.{}'.format(layer), type='hoa', input_shape=tuple(x.shape), **cost))
+            return mlp_activate(x, layer)
+        model.activate = activate
+
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.zeros(input_shape, device=device))
+    finally:
+        model.train(was_training)
+        for handle in handles:
+            handle.remove()
+        if mlp_activate:
+            del model.activate
+
+    totals = {}
+    for layer in layers:
+        total = totals.setdefault(layer['type'], {'count': 0, 'forward_flops': 0, 'backward_flops': 0,
+                                                   'forward_bytes': 0, 'backward_bytes': 0})
+        total['count'] += 1
+        for direction in ['forward', 'backward']:
+            total[direction + '_flops'] += layer[direction]['flops']
+            total[direction + '_bytes'] += layer[direction]['bytes_read'] + layer[direction]['bytes_written']
+    return {'layers': layers, 'totals': totals}
+
+
+def print_model_cost(cost, per_layer=False):
+    """
+    Prints the summary returned by get_model_cost
+    :param cost: summary from get_model_cost
+    :param per_layer: also print every layer
+    :return:
+    """
+    if per_layer:
+        for layer in cost['layers']:
+            print("{:<40} {:<6} {:<22} fwd {:>10.2f} MFLOPs {:>9.2f} MB  bwd {:>10.2f} MFLOPs {:>9.2f} MB".format(
+                layer['name'], layer['type'], str(layer['input_shape']),
+                layer['forward']['flops'] / 1e6,
+                (layer['forward']['bytes_read'] + layer['forward']['bytes_written']) / 2 ** 20,
+                layer['backward']['flops'] / 1e6,
+                (layer['backward']['bytes_read'] + layer['backward']['bytes_written']) / 2 ** 20))
+    total_flops = sum(t['forward_flops'] + t['backward_flops'] for t in cost['totals'].values())
+    print("=============================== Model cost:")
+    for layer_type, total in sorted(cost['totals'].items()):
+        print("{:<6} x{:<4} fwd {:>10.2f} MFLOPs {:>9.2f} MB  bwd {:>10.2f} MFLOPs {:>9.2f} MB  ({:.1%} of FLOPs)".format(
+            layer_type, total['count'],
+            total['forward_flops'] / 1e6, total['forward_bytes'] / 2 ** 20,
+            total['backward_flops'] / 1e6, total['backward_bytes'] / 2 ** 20,
+            (total['forward_flops'] + total['backward_flops']) / max(total_flops, 1)))
+    print("===================================================================")
 
 
 def test_nn_inputs(actfun, net_struct, in_size):
@@ -403,12 +567,18 @@ def test_nn_inputs(actfun, net_struct, in_size):
     return None
 
 
-def add_shuffle_map(shuffle_maps, num_nodes, p):
-    new_maps = []
-    for perm in range(p):
-        new_maps.append(torch.randperm(num_nodes))
-    shuffle_maps.append(new_maps)
-    return shuffle_maps
+def add_shuffle_map(module, name, num_nodes, p):
+    """
+    Registers p random permutations of a layer's nodes on a module as a persistent buffer, so that they move
+    with the module across devices and are saved in (and restored from) its state_dict
+    :param module: module that owns the permutations
+    :param name: name of the buffer
+    :param num_nodes: number of pre-activation nodes in the layer
+    :param p: number of permutations
+    :return: (p, num_nodes) tensor of permutations
+    """
+    module.register_buffer(name, torch.stack([torch.randperm(num_nodes) for _ in range(p)]))
+    return getattr(module, name)
 
 
 def permute(x, method, layer_type, k, offset, num_groups=2, shuffle_map=None):
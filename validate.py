@@ -21,7 +21,7 @@ from contextlib import suppress
 
 from timm.models import create_model, apply_test_time_pool, load_checkpoint, is_model, list_models
 from timm.data import Dataset, DatasetTar, create_loader, resolve_data_config, RealLabelsImagenet
-from timm.utils import accuracy, AverageMeter, natural_key, setup_default_logging, set_jit_legacy
+from timm.utils import MetricAccumulator, AverageMeter, natural_key, setup_default_logging, set_jit_legacy, quantize_int8
 
 has_apex = False
 try:
@@ -102,12 +102,30 @@ parser.add_argument('--real-labels', default='', type=str, metavar='FILENAME',
                     help='Real labels JSON file for imagenet evaluation')
 parser.add_argument('--valid-labels', default='', type=str, metavar='FILENAME',
                     help='Valid label indices txt file for validation of partial label space')
+parser.add_argument('--actfun', default='', type=str, metavar='ACTFUN',
+                    help='Activation function of the model (default: model default)')
+parser.add_argument('--p', type=int, default=1, metavar='p',
+                    help='Number of pre-activation permutations')
+parser.add_argument('--k', type=int, default=2, metavar='k',
+                    help='Higher order activation group size')
+parser.add_argument('--g', type=int, default=1, metavar='g',
+                    help='Inter layer group size')
+parser.add_argument('--quantize', action='store_true', default=False,
+                    help='Validate on CPU in fp32 and after int8 post-training quantization, and compare the two')
+parser.add_argument('--calib-batches', type=int, default=10, metavar='N',
+                    help='Number of batches to calibrate int8 activation ranges on (default: 10)')
+parser.add_argument('--calib-data', default='', type=str, metavar='DIR',
+                    help='Dataset to calibrate on (default: the validation dataset)')
+parser.add_argument('--quant-backend', default='fbgemm', type=str, metavar='NAME',
+                    help='Quantized engine, fbgemm (x86) or qnnpack (ARM)')
 
 
 def validate(args):
     # might as well try to validate something
     args.pretrained = args.pretrained or not args.checkpoint
-    args.prefetcher = not args.no_prefetcher
+    # the prefetcher moves batches to the GPU, int8 models run on the CPU
+    args.prefetcher = not args.no_prefetcher and not args.quantize
+    device = torch.device('cpu') if args.quantize else torch.device('cuda')
     amp_autocast = suppress  # do nothing
     if args.amp:
         if has_apex:
@@ -117,6 +135,7 @@ def validate(args):
         else:
             _logger.warning("Neither APEX or Native Torch AMP is available, using FP32.")
     assert not args.apex_amp or not args.native_amp, "Only one AMP mode should be set."
+    assert not args.quantize or not args.torchscript, "Quantize the model before scripting it, not after."
     if args.native_amp:
         amp_autocast = torch.cuda.amp.autocast
 
@@ -124,13 +143,15 @@ def validate(args):
         set_jit_legacy()
 
     # create model
+    model_kwargs = dict(actfun=args.actfun, p=args.p, k=args.k, g=args.g) if args.actfun else {}
     model = create_model(
         args.model,
         pretrained=args.pretrained,
         num_classes=args.num_classes,
         in_chans=3,
         global_pool=args.gp,
-        scriptable=args.torchscript)
+        scriptable=args.torchscript,
+        **model_kwargs)
 
     if args.checkpoint:
         load_checkpoint(model, args.checkpoint, args.use_ema)
@@ -145,22 +166,19 @@ def validate(args):
         torch.jit.optimized_execution(True)
         model = torch.jit.script(model)
 
-    model = model.cuda()
+    model = model.to(device)
     if args.apex_amp:
         model = amp.initialize(model, opt_level='O1')
 
     if args.channels_last:
         model = model.to(memory_format=torch.channels_last)
 
-    if args.num_gpu > 1:
+    if args.num_gpu > 1 and not args.quantize:
         model = torch.nn.DataParallel(model, device_ids=list(range(args.num_gpu)))
 
-    criterion = nn.CrossEntropyLoss().cuda()
+    criterion = nn.CrossEntropyLoss().to(device)
 
-    if os.path.splitext(args.data)[1] == '.tar' and os.path.isfile(args.data):
-        dataset = DatasetTar(args.data, load_bytes=args.tf_preprocessing, class_map=args.class_map)
-    else:
-        dataset = Dataset(args.data, load_bytes=args.tf_preprocessing, class_map=args.class_map)
+    dataset = _create_dataset(args.data, args)
 
     if args.valid_labels:
         with open(args.valid_labels, 'r') as f:
@@ -169,13 +187,48 @@ def validate(args):
     else:
         valid_labels = None
 
-    if args.real_labels:
-        real_labels = RealLabelsImagenet(dataset.filenames(basename=True), real_json=args.real_labels)
-    else:
-        real_labels = None
-
     crop_pct = 1.0 if test_time_pool else data_config['crop_pct']
-    loader = create_loader(
+    loader = _create_loader(dataset, data_config, crop_pct, args)
+
+    top1a, top5a, rate = _run_validation(
+        model, loader, data_config['input_size'], criterion, amp_autocast, valid_labels, dataset, args, device)
+    results = OrderedDict(
+        top1=round(top1a, 4), top1_err=round(100 - top1a, 4),
+        top5=round(top5a, 4), top5_err=round(100 - top5a, 4),
+        param_count=round(param_count / 1e6, 2),
+        img_size=data_config['input_size'][-1],
+        cropt_pct=crop_pct,
+        interpolation=data_config['interpolation'])
+
+    _logger.info(' * Acc@1 {:.3f} ({:.3f}) Acc@5 {:.3f} ({:.3f})'.format(
+       results['top1'], results['top1_err'], results['top5'], results['top5_err']))
+
+    if args.quantize:
+        calib_loader = loader
+        if args.calib_data:
+            calib_loader = _create_loader(_create_dataset(args.calib_data, args), data_config, crop_pct, args)
+        _logger.info('Calibrating int8 model on {} batches...'.format(args.calib_batches))
+        model = quantize_int8(model, calib_loader, num_batches=args.calib_batches, backend=args.quant_backend)
+        int8_top1, int8_top5, int8_rate = _run_validation(
+            model, loader, data_config['input_size'], criterion, suppress, valid_labels, dataset, args, device)
+        results.update(
+            int8_top1=round(int8_top1, 4), int8_top5=round(int8_top5, 4),
+            fp32_rate=round(rate, 2), int8_rate=round(int8_rate, 2))
+        _logger.info(' * fp32: Acc@1 {:.3f} Acc@5 {:.3f} {:.2f} img/s'.format(top1a, top5a, rate))
+        _logger.info(' * int8: Acc@1 {:.3f} ({:+.3f}) Acc@5 {:.3f} ({:+.3f}) {:.2f} img/s ({:.2f}x)'.format(
+            int8_top1, int8_top1 - top1a, int8_top5, int8_top5 - top5a, int8_rate, int8_rate / rate))
+
+    return results
+
+
+def _create_dataset(data, args):
+    if os.path.splitext(data)[1] == '.tar' and os.path.isfile(data):
+        return DatasetTar(data, load_bytes=args.tf_preprocessing, class_map=args.class_map)
+    return Dataset(data, load_bytes=args.tf_preprocessing, class_map=args.class_map)
+
+
+def _create_loader(dataset, data_config, crop_pct, args):
+    return create_loader(
         dataset,
         input_size=data_config['input_size'],
         batch_size=args.batch_size,
@@ -188,23 +241,32 @@ def validate(args):
         pin_memory=args.pin_mem,
         tf_preprocessing=args.tf_preprocessing)
 
+
+def _run_validation(model, loader, input_size, criterion, amp_autocast, valid_labels, dataset, args, device):
+    """ Returns top-1 and top-5 accuracy of model over loader, and its throughput in img/s """
+    if args.real_labels:
+        real_labels = RealLabelsImagenet(dataset.filenames(basename=True), real_json=args.real_labels)
+    else:
+        real_labels = None
+
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    metrics = MetricAccumulator(topk=(1, 5))
+    log_idx = -1
 
     model.eval()
     with torch.no_grad():
         # warmup, reduce variability of first batch time, especially for comparing torchscript vs non
-        input = torch.randn((args.batch_size,) + data_config['input_size']).cuda()
+        input = torch.randn((args.batch_size,) + input_size).to(device)
         if args.channels_last:
             input = input.contiguous(memory_format=torch.channels_last)
         model(input)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
         end = time.time()
         for batch_idx, (input, target) in enumerate(loader):
-            if args.no_prefetcher:
-                target = target.cuda()
-                input = input.cuda()
+            if not args.prefetcher:
+                target = target.to(device)
+                input = input.to(device)
             if args.channels_last:
                 input = input.contiguous(memory_format=torch.channels_last)
 
@@ -219,44 +281,33 @@ def validate(args):
             if real_labels is not None:
                 real_labels.add_result(output)
 
-            # measure accuracy and record loss
-            acc1, acc5 = accuracy(output.detach(), target, topk=(1, 5))
-            losses.update(loss.item(), input.size(0))
-            top1.update(acc1.item(), input.size(0))
-            top5.update(acc5.item(), input.size(0))
-
-            # measure elapsed time
-            batch_time.update(time.time() - end)
-            end = time.time()
-
-            if batch_idx % args.log_freq == 0:
+            # record loss and accuracy on device
+            metrics.update(loss=loss, output=output, target=target)
+
+            last_batch = batch_idx == len(loader) - 1
+            if last_batch or batch_idx % args.log_freq == 0:
+                # only sync with the device at log steps, batch time is averaged over the steps since the last one
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                batch_time.update((time.time() - end) / (batch_idx - log_idx), batch_idx - log_idx)
+                end, log_idx = time.time(), batch_idx
+                val, avg = metrics.compute(last=True), metrics.compute()
                 _logger.info(
                     'Test: [{0:>4d}/{1}]  '
                     'Time: {batch_time.val:.3f}s ({batch_time.avg:.3f}s, {rate_avg:>7.2f}/s)  '
-                    'Loss: {loss.val:>7.4f} ({loss.avg:>6.4f})  '
-                    'Acc@1: {top1.val:>7.3f} ({top1.avg:>7.3f})  '
-                    'Acc@5: {top5.val:>7.3f} ({top5.avg:>7.3f})'.format(
+                    'Loss: {val[loss]:>7.4f} ({avg[loss]:>6.4f})  '
+                    'Acc@1: {val[top1]:>7.3f} ({avg[top1]:>7.3f})  '
+                    'Acc@5: {val[top5]:>7.3f} ({avg[top5]:>7.3f})'.format(
                         batch_idx, len(loader), batch_time=batch_time,
-                        rate_avg=input.size(0) / batch_time.avg,
-                        loss=losses, top1=top1, top5=top5))
+                        rate_avg=input.size(0) / batch_time.avg, val=val, avg=avg))
 
+    results = metrics.compute()
     if real_labels is not None:
         # real labels mode replaces topk values at the end
         top1a, top5a = real_labels.get_accuracy(k=1), real_labels.get_accuracy(k=5)
     else:
-        top1a, top5a = top1.avg, top5.avg
-    results = OrderedDict(
-        top1=round(top1a, 4), top1_err=round(100 - top1a, 4),
-        top5=round(top5a, 4), top5_err=round(100 - top5a, 4),
-        param_count=round(param_count / 1e6, 2),
-        img_size=data_config['input_size'][-1],
-        cropt_pct=crop_pct,
-        interpolation=data_config['interpolation'])
-
-    _logger.info(' * Acc@1 {:.3f} ({:.3f}) Acc@5 {:.3f} ({:.3f})'.format(
-       results['top1'], results['top1_err'], results['top5'], results['top5_err']))
-
-    return results
+        top1a, top5a = results['top1'], results['top5']
+    return top1a, top5a, results['count'] / batch_time.sum
 
 
 def main():